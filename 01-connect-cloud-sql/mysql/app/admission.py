@@ -0,0 +1,117 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import time
+from typing import AsyncIterator, Optional
+
+from app.metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_QUEUE_WAIT_SECONDS, ADMISSION_REJECTIONS
+
+# Absolute time.monotonic() deadline of the current request, set by the app's deadline middleware.
+request_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted within its deadline. Served as 503 with Retry-After."""
+
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Caps concurrent database work and sheds load before the connection pool saturates.
+
+    Up to max_in_flight callers run at once and up to max_queue wait in FIFO order.
+    A caller is rejected straight away when the queue is full or when the wait,
+    estimated from the recent average service time, would outlast its deadline.
+    Long-running work such as bulk loads and exports holds a slot like anything
+    else but is left out of that average, so it does not get short reads shed.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, smoothing: float = 0.2) -> None:
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.queued = 0
+        # Exponentially weighted average of how long admitted work holds a slot.
+        self.service_time = 0.0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    def estimated_wait(self) -> float:
+        if self.in_flight < self.max_in_flight:
+            return 0.0
+        return (self.queued + 1) / self.max_in_flight * self.service_time
+
+    def _reject(self, reason: str, retry_after: float) -> Overloaded:
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        return Overloaded(reason, max(retry_after, 1.0))
+
+    async def acquire(self) -> None:
+        deadline = request_deadline.get()
+        estimated_wait = self.estimated_wait()
+        if self.queued >= self.max_queue:
+            raise self._reject("queue_full", estimated_wait)
+        if deadline is not None and time.monotonic() + estimated_wait > deadline:
+            raise self._reject("deadline", estimated_wait)
+
+        started = time.monotonic()
+        self.queued += 1
+        ADMISSION_QUEUE_DEPTH.set(self.queued)
+        # Not asyncio.wait_for: before Python 3.12 it can time out after the acquire
+        # went through and drop the slot on the floor.
+        acquiring = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            timeout = None if deadline is None else max(deadline - started, 0.0)
+            await asyncio.wait({acquiring}, timeout=timeout)
+        except BaseException:
+            self._abandon(acquiring)
+            raise
+        finally:
+            self.queued -= 1
+            ADMISSION_QUEUE_DEPTH.set(self.queued)
+            ADMISSION_QUEUE_WAIT_SECONDS.observe(time.monotonic() - started)
+        if not acquiring.done():
+            self._abandon(acquiring)
+            raise self._reject("deadline", self.estimated_wait())
+
+        self.in_flight += 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+
+    def _abandon(self, acquiring: asyncio.Future) -> None:
+        """Gives up on a semaphore acquire, handing back the slot if it got one or still gets one."""
+        if not acquiring.done():
+            acquiring.cancel()
+            acquiring.add_done_callback(lambda task: task.cancelled() or self._semaphore.release())
+        elif not acquiring.cancelled():
+            self._semaphore.release()
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        """Frees a slot. Pass the time it was held to fold it into the service time average."""
+        if service_time is not None:
+            self.service_time += self.smoothing * (service_time - self.service_time)
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        self._semaphore.release()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, observe: bool = True) -> AsyncIterator[None]:
+        await self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started if observe else None)
+
+
+def init_admission_controller() -> AdmissionController:
+    # Defaults to pool_size + max_overflow of the connect_* factories, so requests
+    # queue here with a deadline instead of inside the pool for pool_timeout.
+    pool_capacity = int(os.environ.get("DB_POOL_SIZE", 5)) + int(os.environ.get("DB_MAX_OVERFLOW", 2))
+    return AdmissionController(
+        max_in_flight=int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", pool_capacity)),
+        max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 64)),
+    )
@@ -0,0 +1,265 @@
+import argparse
+import csv
+import functools
+import io
+import json
+import logging
+import sys
+import tempfile
+import time
+from typing import IO, Iterable, Iterator, Optional
+
+from fastapi.concurrency import run_in_threadpool
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidRow(ValueError):
+    """Raised for an input row that is not a valid user, naming the line it was read from."""
+
+    def __init__(self, line: int, reason: str) -> None:
+        super().__init__(f"line {line}: {reason}")
+        self.line = line
+
+
+class ConflictingRows(Exception):
+    """Raised when the database rejects a batch with an integrity error, naming the lines the batch was read from."""
+
+    def __init__(self, first_line: int, last_line: int, reason: str) -> None:
+        super().__init__(f"lines {first_line}-{last_line}: {reason}")
+        self.first_line = first_line
+        self.last_line = last_line
+
+
+def _user(line: int, user: object) -> dict:
+    """Checks that a parsed row converts to a users row and tags it with its line number."""
+    if not isinstance(user, dict):
+        raise InvalidRow(line, f"expected an object, got {type(user).__name__}")
+    try:
+        user_id, position, status = _row(user)
+    except KeyError as e:
+        raise InvalidRow(line, f"missing {e}") from None
+    except (TypeError, ValueError) as e:
+        raise InvalidRow(line, str(e)) from None
+    return {"id": user_id, "position": position, "status": status, "line": line}
+
+
+def parse_ndjson(stream: IO[str]) -> Iterator[dict]:
+    for line_number, line in enumerate(stream, start=1):
+        if line.strip():
+            try:
+                user = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise InvalidRow(line_number, f"invalid JSON: {e.msg}") from None
+            yield _user(line_number, user)
+
+
+def parse_csv(stream: IO[str]) -> Iterator[dict]:
+    """Parses CSV with a header row naming at least the id and position columns."""
+    reader = csv.DictReader(stream)
+    for user in reader:
+        yield _user(reader.line_num, user)
+
+
+def parse(stream: IO[str], fmt: str) -> Iterator[dict]:
+    if fmt == "ndjson":
+        return parse_ndjson(stream)
+    if fmt == "csv":
+        return parse_csv(stream)
+    raise ValueError(f"Unknown bulk format '{fmt}'. Please use ndjson or csv")
+
+
+def _row(user: dict) -> tuple[int, str, int]:
+    return int(user["id"]), str(user["position"]), int(user.get("status") or 0)
+
+
+# Statements are cached per row count, since every full batch has the same shape.
+# A load only needs its full batch and its tail, so a few entries cover concurrent loads.
+@functools.lru_cache(maxsize=32)
+def _upsert_statement(size: int) -> sqlalchemy.TextClause:
+    values = ", ".join(f"(:id_{i}, :position_{i}, :status_{i})" for i in range(size))
+    return sqlalchemy.text(
+        f"INSERT INTO users (id, position, status) VALUES {values} "
+        "ON DUPLICATE KEY UPDATE position = VALUES(position), status = VALUES(status)"
+    )
+
+
+def _params(batch: list[tuple[int, str, int]]) -> dict:
+    params = {}
+    for i, (user_id, position, status) in enumerate(batch):
+        params[f"id_{i}"] = user_id
+        params[f"position_{i}"] = position
+        params[f"status_{i}"] = status
+    return params
+
+
+def _batches(users: Iterable[dict], batch_size: int) -> Iterator[tuple[range, list[tuple[int, str, int]]]]:
+    """Groups rows into batches, each with the range of input lines it covers (row numbers if untagged)."""
+    batch = []
+    first_line = line = 0
+    for index, user in enumerate(users, start=1):
+        line = user.get("line", index)
+        if not batch:
+            first_line = line
+        batch.append(_row(user))
+        if len(batch) == batch_size:
+            yield range(first_line, line + 1), batch
+            batch = []
+    if batch:
+        yield range(first_line, line + 1), batch
+
+
+def _conflict(lines: range, error: sqlalchemy.exc.IntegrityError) -> ConflictingRows:
+    return ConflictingRows(lines.start, lines.stop - 1, str(error.orig))
+
+
+class LoadResult:
+    def __init__(self, rows: int, seconds: float) -> None:
+        self.rows = rows
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "rows": self.rows,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.rows_per_second, 1),
+        }
+
+
+def load_users(
+    conn: sqlalchemy.engine.base.Connection,
+    users: Iterable[dict],
+    batch_size: int = 1000,
+    transaction_size: int = 10000,
+) -> LoadResult:
+    """
+    Upserts users with multi-row INSERT ... ON DUPLICATE KEY UPDATE statements.
+
+    Each statement carries up to batch_size rows, and the transaction is committed
+    roughly every transaction_size rows so a failure only loses the open batch.
+    """
+    started = time.perf_counter()
+    rows = uncommitted = 0
+    for lines, batch in _batches(users, batch_size):
+        try:
+            conn.execute(_upsert_statement(len(batch)), _params(batch))
+        except sqlalchemy.exc.IntegrityError as e:
+            raise _conflict(lines, e) from e
+        rows += len(batch)
+        uncommitted += len(batch)
+        if uncommitted >= transaction_size:
+            conn.commit()
+            uncommitted = 0
+    conn.commit()
+    return LoadResult(rows, time.perf_counter() - started)
+
+
+async def load_users_async(
+    conn: AsyncConnection,
+    users: Iterable[dict],
+    batch_size: int = 1000,
+    transaction_size: int = 10000,
+) -> LoadResult:
+    """
+    load_users for an AsyncConnection.
+
+    Reading and parsing the input blocks, so each batch is built on the threadpool
+    and only the statements run on the event loop.
+    """
+    started = time.perf_counter()
+    rows = uncommitted = 0
+    batches = _batches(users, batch_size)
+    while (item := await run_in_threadpool(next, batches, None)) is not None:
+        lines, batch = item
+        try:
+            await conn.execute(_upsert_statement(len(batch)), _params(batch))
+        except sqlalchemy.exc.IntegrityError as e:
+            raise _conflict(lines, e) from e
+        rows += len(batch)
+        uncommitted += len(batch)
+        if uncommitted >= transaction_size:
+            await conn.commit()
+            uncommitted = 0
+    await conn.commit()
+    return LoadResult(rows, time.perf_counter() - started)
+
+
+def load_users_infile(conn: sqlalchemy.engine.base.Connection, users: Iterable[dict]) -> LoadResult:
+    """
+    Loads users with LOAD DATA LOCAL INFILE from a spooled temporary file.
+
+    Fastest for very large loads, but REPLACE deletes and re-inserts existing rows,
+    which resets created_at. The connection must allow local_infile.
+    """
+    started = time.perf_counter()
+    rows = 0
+    with tempfile.NamedTemporaryFile("w", suffix=".tsv", newline="") as spool:
+        writer = csv.writer(spool, delimiter="\t", lineterminator="\n", quoting=csv.QUOTE_NONE, escapechar="\\")
+        for user in users:
+            writer.writerow(_row(user))
+            rows += 1
+        spool.flush()
+        conn.execute(
+            sqlalchemy.text(
+                "LOAD DATA LOCAL INFILE :path REPLACE INTO TABLE users "
+                "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' (id, position, status)"
+            ),
+            {"path": spool.name},
+        )
+        conn.commit()
+    return LoadResult(rows, time.perf_counter() - started)
+
+
+def enable_local_infile(engine: sqlalchemy.engine.base.Engine) -> None:
+    """Lets pymysql connections made by the TCP and Unix socket engines send local files."""
+
+    @sqlalchemy.event.listens_for(engine, "do_connect")
+    def _do_connect(dialect, conn_rec, cargs, cparams):
+        cparams["local_infile"] = True
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Bulk load users from NDJSON or CSV.")
+    parser.add_argument("path", help="input file, or - for stdin")
+    parser.add_argument("--format", choices=["ndjson", "csv"], help="defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows per INSERT statement")
+    parser.add_argument("--transaction-size", type=int, default=10000, help="rows per transaction")
+    parser.add_argument(
+        "--load-data",
+        action="store_true",
+        help="use LOAD DATA LOCAL INFILE (INSTANCE_HOST or INSTANCE_UNIX_SOCKET only, server needs local_infile=ON)",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    fmt = args.format or ("csv" if args.path.endswith(".csv") else "ndjson")
+    stream = (
+        io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+        if args.path == "-"
+        else open(args.path, encoding="utf-8", newline="")
+    )
+
+    from app.main import init_connection_pool
+
+    engine = init_connection_pool()
+    if args.load_data:
+        enable_local_infile(engine)
+
+    with stream, engine.connect() as conn:
+        users = parse(stream, fmt)
+        if args.load_data:
+            result = load_users_infile(conn, users)
+        else:
+            result = load_users(conn, users, args.batch_size, args.transaction_size)
+
+    logger.info("Loaded %d rows in %.1fs (%.0f rows/s)", result.rows, result.seconds, result.rows_per_second)
+
+
+if __name__ == "__main__":
+    main()
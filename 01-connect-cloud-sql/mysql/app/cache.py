@@ -0,0 +1,244 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Iterable, Optional
+
+import sqlalchemy
+from sqlalchemy.util.concurrency import await_only
+
+# Tables a SELECT reads from, used to tag cached results for invalidation.
+_READ_TABLES = re.compile(r"\b(?:FROM|JOIN)\s+`?(\w+)`?", re.IGNORECASE)
+
+# Tables a statement writes to. CREATE/ALTER/DROP count too, since they change what a SELECT returns.
+_WRITE_TABLES = re.compile(
+    r"\b(?:INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?"
+    r"|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ALTER\s+TABLE|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)\s+`?(\w+)`?",
+    re.IGNORECASE,
+)
+
+
+def read_tables(sql: str) -> set[str]:
+    return {table.lower() for table in _READ_TABLES.findall(sql)}
+
+
+def written_tables(sql: str) -> set[str]:
+    return {table.lower() for table in _WRITE_TABLES.findall(sql)}
+
+
+def cache_key(sql: str, params: Optional[dict[str, Any]] = None) -> str:
+    """Builds a cache key from the whitespace-normalized SQL text and its bound parameters."""
+    normalized = " ".join(sql.split())
+    payload = json.dumps([normalized, params or {}], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class QueryCache:
+    """Base class for query result caches. Rows are stored as lists of plain tuples."""
+
+    # True when get/set do network I/O, so async callers must run them on the threadpool.
+    blocking = False
+
+    # Seconds after a write to a table during which replica reads of it are not cached, because
+    # the replica may not have applied the write yet. Set to the replica router's max_lag.
+    write_window = 0.0
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[list[tuple]]:
+        raise NotImplementedError
+
+    def set(self, key: str, rows: list[tuple], tables: Iterable[str]) -> None:
+        raise NotImplementedError
+
+    def invalidate(self, *tables: str) -> None:
+        raise NotImplementedError
+
+    def recently_written(self, tables: Iterable[str]) -> bool:
+        """Whether any of the tables was invalidated within the last write_window seconds."""
+        raise NotImplementedError
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
+
+
+class NullCache(QueryCache):
+    def get(self, key: str) -> Optional[list[tuple]]:
+        self.misses += 1
+        return None
+
+    def set(self, key: str, rows: list[tuple], tables: Iterable[str]) -> None:
+        pass
+
+    def invalidate(self, *tables: str) -> None:
+        pass
+
+    def recently_written(self, tables: Iterable[str]) -> bool:
+        return False
+
+
+class LRUCache(QueryCache):
+    """In-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60.0) -> None:
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, list[tuple], frozenset[str]]] = OrderedDict()
+        self._written: dict[str, float] = {}
+        # Sync engine queries and write hooks run on threadpool workers.
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[list[tuple]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, rows: list[tuple], tables: Iterable[str]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, rows, frozenset(tables))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *tables: str) -> None:
+        targets = {table.lower() for table in tables}
+        with self._lock:
+            stale = [key for key, (_, _, entry_tables) in self._entries.items() if entry_tables & targets]
+            for key in stale:
+                del self._entries[key]
+            now = time.monotonic()
+            for table in targets:
+                self._written[table] = now
+            self.invalidations += 1
+
+    def recently_written(self, tables: Iterable[str]) -> bool:
+        since = time.monotonic() - self.write_window
+        with self._lock:
+            return any(self._written.get(table.lower(), since) > since for table in tables)
+
+
+class RedisCache(QueryCache):
+    """
+    Cache backed by a Redis-compatible server, shared by every instance that points at it.
+
+    Each table keeps a set of the keys that read from it, so invalidation only
+    drops the affected results. Rows must be JSON serializable.
+    """
+
+    blocking = True
+
+    def __init__(self, url: str, ttl: float = 60.0, prefix: str = "querycache") -> None:
+        import redis
+
+        super().__init__()
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[list[tuple]]:
+        value = self.client.get(f"{self.prefix}:result:{key}")
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [tuple(row) for row in json.loads(value)]
+
+    def set(self, key: str, rows: list[tuple], tables: Iterable[str]) -> None:
+        result_key = f"{self.prefix}:result:{key}"
+        pipe = self.client.pipeline()
+        pipe.set(result_key, json.dumps(rows, default=str), px=int(self.ttl * 1000))
+        for table in tables:
+            # The index outlives every result it lists, and expires once none of them can still be cached.
+            table_key = f"{self.prefix}:table:{table}"
+            pipe.sadd(table_key, result_key)
+            pipe.pexpire(table_key, int(self.ttl * 1000))
+        pipe.execute()
+
+    def invalidate(self, *tables: str) -> None:
+        # Two round trips whatever the number of tables: read every index, then drop them with their results.
+        tables = sorted({table.lower() for table in tables})
+        table_keys = [f"{self.prefix}:table:{table}" for table in tables]
+        pipe = self.client.pipeline(transaction=False)
+        for table_key in table_keys:
+            pipe.smembers(table_key)
+        result_keys = set().union(*pipe.execute()) if table_keys else set()
+        pipe = self.client.pipeline(transaction=False)
+        pipe.unlink(*table_keys, *result_keys)
+        if self.write_window > 0:
+            # Shared with every instance, so a write on one stops the others caching stale replica reads.
+            for table in tables:
+                pipe.set(f"{self.prefix}:written:{table}", 1, px=int(self.write_window * 1000))
+        pipe.execute()
+        self.invalidations += 1
+
+    def recently_written(self, tables: Iterable[str]) -> bool:
+        keys = [f"{self.prefix}:written:{table.lower()}" for table in tables]
+        return bool(keys) and self.client.exists(*keys) > 0
+
+
+def init_query_cache() -> QueryCache:
+    backend = os.environ.get("QUERY_CACHE", "memory")
+    ttl = float(os.environ.get("QUERY_CACHE_TTL", 60))
+
+    if backend == "memory":
+        return LRUCache(max_entries=int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", 1024)), ttl=ttl)
+
+    if backend == "redis":
+        return RedisCache(os.environ.get("REDIS_URL", "redis://localhost:6379/0"), ttl=ttl)
+
+    if backend == "none":
+        return NullCache()
+
+    raise ValueError(f"Unknown QUERY_CACHE backend '{backend}'. Please use one of memory, redis or none")
+
+
+def install_invalidation_hooks(engine: sqlalchemy.engine.base.Engine, cache: QueryCache) -> None:
+    """
+    Invalidates cached results whenever a statement on the engine writes to a table.
+
+    The tables a transaction writes are collected and invalidated once on commit,
+    so a read that re-populated the cache mid-transaction does not outlive the
+    commit. An in-process cache is also invalidated as each write executes, which
+    costs nothing. For an AsyncEngine pass its sync_engine.
+    """
+
+    def _invalidate(conn: sqlalchemy.engine.base.Connection, tables: set[str]) -> None:
+        if cache.blocking and conn.dialect.is_async:
+            # Async engine events run on the event loop, inside the greenlet of the awaiting
+            # call, so the commit waits for the invalidation without blocking the loop.
+            await_only(asyncio.get_running_loop().run_in_executor(None, cache.invalidate, *tables))
+        else:
+            cache.invalidate(*tables)
+
+    @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        tables = written_tables(statement)
+        if tables:
+            if not cache.blocking:
+                cache.invalidate(*tables)
+            conn.info.setdefault("cache_written_tables", set()).update(tables)
+
+    @sqlalchemy.event.listens_for(engine, "commit")
+    def _commit(conn):
+        tables = conn.info.pop("cache_written_tables", None)
+        if tables:
+            _invalidate(conn, tables)
+
+    @sqlalchemy.event.listens_for(engine, "rollback")
+    def _rollback(conn):
+        conn.info.pop("cache_written_tables", None)
@@ -14,33 +14,38 @@
 
 # [START cloud_sql_mysql_sqlalchemy_connect_connector]
 import os
+from typing import Mapping, Optional
 
 from google.cloud.sql.connector import Connector, IPTypes
 import pymysql
 
 import sqlalchemy
 
+from app.metrics import observe_connector_handshake
 
-def connect_with_connector() -> sqlalchemy.engine.base.Engine:
+
+def connect_with_connector(environ: Optional[Mapping[str, str]] = None) -> sqlalchemy.engine.base.Engine:
     """
     Initializes a connection pool for a Cloud SQL instance of MySQL.
 
     Uses the Cloud SQL Python Connector package.
     """
+    environ = os.environ if environ is None else environ
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
 
-    instance_connection_name = os.environ["INSTANCE_CONNECTION_NAME"]  # e.g. 'project:region:instance'
-    db_user = os.environ.get("DB_USER", "")  # e.g. 'my-db-user'
-    db_pass = os.environ["DB_PASS"]  # e.g. 'my-db-password'
-    db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
+    instance_connection_name = environ["INSTANCE_CONNECTION_NAME"]  # e.g. 'project:region:instance'
+    db_user = environ.get("DB_USER", "")  # e.g. 'my-db-user'
+    db_pass = environ["DB_PASS"]  # e.g. 'my-db-password'
+    db_name = environ["DB_NAME"]  # e.g. 'my-database'
 
-    ip_type = IPTypes.PRIVATE if os.environ.get("PRIVATE_IP") else IPTypes.PUBLIC
+    ip_type = IPTypes.PRIVATE if environ.get("PRIVATE_IP") else IPTypes.PUBLIC
 
     connector = Connector(ip_type)
 
+    @observe_connector_handshake("connector")
     def getconn() -> pymysql.connections.Connection:
         conn: pymysql.connections.Connection = connector.connect(
             instance_connection_name,
@@ -56,10 +61,10 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
         creator=getconn,
         # [START_EXCLUDE]
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=int(environ.get("DB_POOL_SIZE", 5)),
 
         # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
+        max_overflow=int(environ.get("DB_MAX_OVERFLOW", 2)),
 
         # The total number of concurrent connections for your application will be
         # a total of pool_size and max_overflow.
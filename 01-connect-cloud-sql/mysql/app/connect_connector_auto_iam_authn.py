@@ -14,32 +14,39 @@
 
 # [START cloud_sql_mysql_sqlalchemy_auto_iam_authn]
 import os
+from typing import Mapping, Optional
 
 from google.cloud.sql.connector import Connector, IPTypes
 import pymysql
 
 import sqlalchemy
 
+from app.metrics import observe_connector_handshake
 
-def connect_with_connector_auto_iam_authn() -> sqlalchemy.engine.base.Engine:
+
+def connect_with_connector_auto_iam_authn(
+    environ: Optional[Mapping[str, str]] = None,
+) -> sqlalchemy.engine.base.Engine:
     """
     Initializes a connection pool for a Cloud SQL instance of MySQL.
 
     Uses the Cloud SQL Python Connector with Automatic IAM Database Authentication.
     """
+    environ = os.environ if environ is None else environ
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
-    instance_connection_name = os.environ["INSTANCE_CONNECTION_NAME"]  # e.g. 'project:region:instance'
-    db_iam_user = os.environ["DB_IAM_USER"]  # e.g. 'sa-name@project-id.iam'
-    db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
+    instance_connection_name = environ["INSTANCE_CONNECTION_NAME"]  # e.g. 'project:region:instance'
+    db_iam_user = environ["DB_IAM_USER"]  # e.g. 'sa-name@project-id.iam'
+    db_name = environ["DB_NAME"]  # e.g. 'my-database'
 
-    ip_type = IPTypes.PRIVATE if os.environ.get("PRIVATE_IP") else IPTypes.PUBLIC
+    ip_type = IPTypes.PRIVATE if environ.get("PRIVATE_IP") else IPTypes.PUBLIC
 
     # initialize Cloud SQL Python Connector object
     connector = Connector()
 
+    @observe_connector_handshake("connector_iam")
     def getconn() -> pymysql.connections.Connection:
         conn: pymysql.connections.Connection = connector.connect(
             instance_connection_name,
@@ -58,10 +65,10 @@ def connect_with_connector_auto_iam_authn() -> sqlalchemy.engine.base.Engine:
         creator=getconn,
         # [START_EXCLUDE]
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=int(environ.get("DB_POOL_SIZE", 5)),
 
         # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
+        max_overflow=int(environ.get("DB_MAX_OVERFLOW", 2)),
 
         # The total number of concurrent connections for your application will be
         # a total of pool_size and max_overflow.
@@ -17,31 +17,35 @@
 # [START cloud_sql_mysql_sqlalchemy_sslcerts]
 # [START cloud_sql_mysql_sqlalchemy_connect_tcp_sslcerts]
 import os
+import ssl
+from typing import Mapping, Optional
 
 import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
 
-def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
+def connect_tcp_socket(environ: Optional[Mapping[str, str]] = None) -> sqlalchemy.engine.base.Engine:
     """ Initializes a TCP connection pool for a Cloud SQL instance of MySQL. """
+    environ = os.environ if environ is None else environ
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
-    db_host = os.environ["INSTANCE_HOST"]  # e.g. '127.0.0.1' ('172.17.0.1' if deployed to GAE Flex)
-    db_user = os.environ["DB_USER"]  # e.g. 'my-db-user'
-    db_pass = os.environ["DB_PASS"]  # e.g. 'my-db-password'
-    db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
-    db_port = os.environ["DB_PORT"]  # e.g. 3306
+    db_host = environ["INSTANCE_HOST"]  # e.g. '127.0.0.1' ('172.17.0.1' if deployed to GAE Flex)
+    db_user = environ["DB_USER"]  # e.g. 'my-db-user'
+    db_pass = environ["DB_PASS"]  # e.g. 'my-db-password'
+    db_name = environ["DB_NAME"]  # e.g. 'my-database'
+    db_port = environ["DB_PORT"]  # e.g. 3306
 
     # [END cloud_sql_mysql_sqlalchemy_connect_tcp]
     connect_args = {}
     # For deployments that connect directly to a Cloud SQL instance without
     # using the Cloud SQL Proxy, configuring SSL certificates will ensure the
     # connection is encrypted.
-    if os.environ.get("DB_ROOT_CERT"):
-        db_root_cert = os.environ["DB_ROOT_CERT"]  # e.g. '/path/to/my/server-ca.pem'
-        db_cert = os.environ["DB_CERT"]  # e.g. '/path/to/my/client-cert.pem'
-        db_key = os.environ["DB_KEY"]  # e.g. '/path/to/my/client-key.pem'
+    if environ.get("DB_ROOT_CERT"):
+        db_root_cert = environ["DB_ROOT_CERT"]  # e.g. '/path/to/my/server-ca.pem'
+        db_cert = environ["DB_CERT"]  # e.g. '/path/to/my/client-cert.pem'
+        db_key = environ["DB_KEY"]  # e.g. '/path/to/my/client-key.pem'
 
         ssl_args = {
             "ssl_ca": db_root_cert,
@@ -68,9 +72,9 @@ def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
         # [START_EXCLUDE]
         # [START cloud_sql_mysql_sqlalchemy_limit]
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=int(environ.get("DB_POOL_SIZE", 5)),
         # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
+        max_overflow=int(environ.get("DB_MAX_OVERFLOW", 2)),
         # The total number of concurrent connections for your application will be
         # a total of pool_size and max_overflow.
         # [END cloud_sql_mysql_sqlalchemy_limit]
@@ -100,3 +104,41 @@ def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
 # [END cloud_sql_mysql_sqlalchemy_connect_tcp_sslcerts]
 # [END cloud_sql_mysql_sqlalchemy_sslcerts]
 # [END cloud_sql_mysql_sqlalchemy_connect_tcp]
+
+
+def connect_tcp_socket_async(environ: Optional[Mapping[str, str]] = None) -> AsyncEngine:
+    """ Initializes an async TCP connection pool for a Cloud SQL instance of MySQL. """
+    environ = os.environ if environ is None else environ
+    db_host = environ["INSTANCE_HOST"]  # e.g. '127.0.0.1' ('172.17.0.1' if deployed to GAE Flex)
+    db_user = environ["DB_USER"]  # e.g. 'my-db-user'
+    db_pass = environ["DB_PASS"]  # e.g. 'my-db-password'
+    db_name = environ["DB_NAME"]  # e.g. 'my-database'
+    db_port = environ["DB_PORT"]  # e.g. 3306
+
+    connect_args = {}
+    # aiomysql takes an SSLContext instead of the certificate paths pymysql accepts.
+    if environ.get("DB_ROOT_CERT"):
+        ssl_context = ssl.create_default_context(cafile=environ["DB_ROOT_CERT"])
+        ssl_context.load_cert_chain(environ["DB_CERT"], environ["DB_KEY"])
+        # Cloud SQL server certificates are issued for the instance name, not its IP.
+        ssl_context.check_hostname = False
+        connect_args = {"ssl": ssl_context}
+
+    pool = create_async_engine(
+        # Equivalent URL:
+        # mysql+aiomysql://<db_user>:<db_pass>@<db_host>:<db_port>/<db_name>
+        sqlalchemy.engine.url.URL.create(
+            drivername="mysql+aiomysql",
+            username=db_user,
+            password=db_pass,
+            host=db_host,
+            port=db_port,
+            database=db_name,
+        ),
+        connect_args=connect_args,
+        pool_size=int(environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(environ.get("DB_MAX_OVERFLOW", 2)),
+        pool_timeout=30,  # 30 seconds
+        pool_recycle=1800,  # 30 minutes
+    )
+    return pool
@@ -14,20 +14,23 @@
 
 # [START cloud_sql_mysql_sqlalchemy_connect_unix]
 import os
+from typing import Mapping, Optional
 
 import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
 
-def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
+def connect_unix_socket(environ: Optional[Mapping[str, str]] = None) -> sqlalchemy.engine.base.Engine:
     """ Initializes a Unix socket connection pool for a Cloud SQL instance of MySQL. """
+    environ = os.environ if environ is None else environ
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
-    db_user = os.environ["DB_USER"]  # e.g. 'my-database-user'
-    db_pass = os.environ["DB_PASS"]  # e.g. 'my-database-password'
-    db_name = os.environ["DB_NAME"]  # e.g. 'my-database'
-    unix_socket_path = os.environ["INSTANCE_UNIX_SOCKET"]  # e.g. '/cloudsql/project:region:instance'
+    db_user = environ["DB_USER"]  # e.g. 'my-database-user'
+    db_pass = environ["DB_PASS"]  # e.g. 'my-database-password'
+    db_name = environ["DB_NAME"]  # e.g. 'my-database'
+    unix_socket_path = environ["INSTANCE_UNIX_SOCKET"]  # e.g. '/cloudsql/project:region:instance'
 
     pool = sqlalchemy.create_engine(
         # Equivalent URL:
@@ -41,10 +44,10 @@ def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
         ),
         # [START_EXCLUDE]
         # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
+        pool_size=int(environ.get("DB_POOL_SIZE", 5)),
 
         # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
+        max_overflow=int(environ.get("DB_MAX_OVERFLOW", 2)),
 
         # The total number of concurrent connections for your application will be
         # a total of pool_size and max_overflow.
@@ -63,3 +66,29 @@ def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
     return pool
 
 # [END cloud_sql_mysql_sqlalchemy_connect_unix]
+
+
+def connect_unix_socket_async(environ: Optional[Mapping[str, str]] = None) -> AsyncEngine:
+    """ Initializes an async Unix socket connection pool for a Cloud SQL instance of MySQL. """
+    environ = os.environ if environ is None else environ
+    db_user = environ["DB_USER"]  # e.g. 'my-database-user'
+    db_pass = environ["DB_PASS"]  # e.g. 'my-database-password'
+    db_name = environ["DB_NAME"]  # e.g. 'my-database'
+    unix_socket_path = environ["INSTANCE_UNIX_SOCKET"]  # e.g. '/cloudsql/project:region:instance'
+
+    pool = create_async_engine(
+        # Equivalent URL:
+        # mysql+aiomysql://<db_user>:<db_pass>@/<db_name>?unix_socket=<socket_path>/<cloud_sql_instance_name>
+        sqlalchemy.engine.url.URL.create(
+            drivername="mysql+aiomysql",
+            username=db_user,
+            password=db_pass,
+            database=db_name,
+            query={"unix_socket": unix_socket_path},
+        ),
+        pool_size=int(environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(environ.get("DB_MAX_OVERFLOW", 2)),
+        pool_timeout=30,  # 30 seconds
+        pool_recycle=1800,  # 30 minutes
+    )
+    return pool
@@ -1,55 +1,242 @@
+import asyncio
+import io
+import json
+import math
 import os
+import tempfile
+import time
+from typing import Any, AsyncIterator, Iterator, Mapping, Optional, Union
 
-from fastapi import FastAPI
+import anyio
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine
 
+from app import bulk
+from app.admission import init_admission_controller, Overloaded, request_deadline
+from app.cache import cache_key, init_query_cache, install_invalidation_hooks, read_tables
 from app.connect_connector import connect_with_connector
 from app.connect_connector_auto_iam_authn import connect_with_connector_auto_iam_authn
-from app.connect_tcp import connect_tcp_socket
-from app.connect_unix import connect_unix_socket
+from app.connect_tcp import connect_tcp_socket, connect_tcp_socket_async
+from app.connect_unix import connect_unix_socket, connect_unix_socket_async
+from app.metrics import instrument_pool, register_query_cache
+from app.migrations import run_migrations
+from app.replicas import init_replica_router, ReplicaRouter
+from app.warmup import warm_pool, warm_pool_async
 
 app = FastAPI()
 
+# Set DB_ASYNC=true to serve requests from an aiomysql AsyncEngine instead of
+# blocking pymysql connections on the threadpool.
+DB_ASYNC = os.environ.get("DB_ASYNC", "").lower() in ("1", "true", "yes")
 
-def init_connection_pool() -> sqlalchemy.engine.base.Engine:
-    if os.environ.get("INSTANCE_HOST"):
-        return connect_tcp_socket()
+# Set MIGRATE_ON_STARTUP=false when migrations run as a separate job (python -m app.migrations).
+MIGRATE_ON_STARTUP = os.environ.get("MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
 
-    if os.environ.get("INSTANCE_UNIX_SOCKET"):
-        return connect_unix_socket()
+# Set POOL_WARMUP=true to open pool_size connections before the instance accepts traffic.
+POOL_WARMUP = os.environ.get("POOL_WARMUP", "").lower() in ("1", "true", "yes")
 
-    if os.environ.get("INSTANCE_CONNECTION_NAME"):
-        return connect_with_connector_auto_iam_authn() if os.environ.get("DB_IAM_USER") else connect_with_connector()
+# Seconds a request may spend on database work unless the client sends X-Request-Timeout.
+REQUEST_BUDGET = float(os.environ.get("REQUEST_BUDGET", 10))
+
+# Seconds between replication lag checks of the replicas listed in DB_REPLICAS.
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get("REPLICA_LAG_CHECK_INTERVAL", 5))
+
+# Request bodies for /users/bulk are kept in memory up to this size, then spooled to disk.
+BULK_SPOOL_MAX_BYTES = int(os.environ.get("BULK_SPOOL_MAX_BYTES", 16 * 1024 * 1024))
+
+# Number of rows fetched from the server-side cursor per NDJSON chunk in /items/export.
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 1000))
+
+
+def init_connection_pool(
+    environ: Optional[Mapping[str, str]] = None, name: Optional[str] = None
+) -> sqlalchemy.engine.base.Engine:
+    environ = os.environ if environ is None else environ
+    # Pool metrics are labelled by connection mode, prefixed with the replica name if there is one.
+    prefix = f"{name}:" if name else ""
+
+    if environ.get("INSTANCE_HOST"):
+        pool = connect_tcp_socket(environ)
+        instrument_pool(pool, f"{prefix}tcp")
+        return pool
+
+    if environ.get("INSTANCE_UNIX_SOCKET"):
+        pool = connect_unix_socket(environ)
+        instrument_pool(pool, f"{prefix}unix")
+        return pool
+
+    if environ.get("INSTANCE_CONNECTION_NAME"):
+        if environ.get("DB_IAM_USER"):
+            pool = connect_with_connector_auto_iam_authn(environ)
+            instrument_pool(pool, f"{prefix}connector_iam")
+        else:
+            pool = connect_with_connector(environ)
+            instrument_pool(pool, f"{prefix}connector")
+        return pool
 
     raise ValueError(
         "Missing database connection type. Please define one of INSTANCE_HOST, INSTANCE_UNIX_SOCKET, or INSTANCE_CONNECTION_NAME"
     )
 
 
+def init_async_connection_pool(environ: Optional[Mapping[str, str]] = None, name: Optional[str] = None) -> AsyncEngine:
+    environ = os.environ if environ is None else environ
+    prefix = f"{name}:" if name else ""
+
+    if environ.get("INSTANCE_HOST"):
+        pool = connect_tcp_socket_async(environ)
+        instrument_pool(pool.sync_engine, f"{prefix}tcp")
+        return pool
+
+    if environ.get("INSTANCE_UNIX_SOCKET"):
+        pool = connect_unix_socket_async(environ)
+        instrument_pool(pool.sync_engine, f"{prefix}unix")
+        return pool
+
+    if environ.get("INSTANCE_CONNECTION_NAME"):
+        # The Cloud SQL Python Connector only provides async connections for asyncpg (PostgreSQL).
+        raise ValueError(
+            "DB_ASYNC is not supported with INSTANCE_CONNECTION_NAME. "
+            "Use INSTANCE_UNIX_SOCKET (Cloud Run's built-in Cloud SQL connection) or the Cloud SQL Auth Proxy instead"
+        )
+
+    raise ValueError(
+        "Missing database connection type. Please define one of INSTANCE_HOST or INSTANCE_UNIX_SOCKET"
+    )
+
+
 def migrate_db(db: sqlalchemy.engine.base.Engine) -> None:
-    sql = """
-        CREATE TABLE IF NOT EXISTS users (
-            id INT PRIMARY KEY,
-            position VARCHAR(255) NOT NULL,
-            status TINYINT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        ) ENGINE=INNODB;
-    """
-    sql2 = 'INSERT IGNORE INTO users VALUES (12345, "店長", 0, now());'
     with db.connect() as conn:
-        conn.execute(sqlalchemy.text(sql))
-        conn.execute(sqlalchemy.text(sql2))
-        conn.commit()
+        run_migrations(conn)
+
 
+async def migrate_db_async(db: AsyncEngine) -> None:
+    async with db.connect() as conn:
+        await conn.run_sync(run_migrations)
 
-db = None
+
+db: Optional[Union[sqlalchemy.engine.base.Engine, AsyncEngine]] = None
+router: Optional[ReplicaRouter] = None
+lag_monitor: Optional[asyncio.Task] = None
+query_cache = init_query_cache()
+register_query_cache(query_cache)
+admission = init_admission_controller()
+
+
+async def fetch_all(sql: str, params: Optional[dict[str, Any]] = None) -> list[tuple]:
+    """
+    Runs a SELECT on whichever engine is active without blocking the event loop.
+
+    Results are read through query_cache, keyed by the SQL text and params, and
+    misses run on a read replica when DB_REPLICAS is set. A miss on a table that
+    was written within the last max_lag seconds runs on the primary instead, since
+    a replica may not have applied that write yet, so callers read their own writes.
+    """
+    key = cache_key(sql, params)
+    tables = read_tables(sql)
+
+    def _lookup() -> tuple[Optional[list[tuple]], bool]:
+        rows = query_cache.get(key)
+        return rows, rows is None and bool(router.replicas) and query_cache.recently_written(tables)
+
+    if query_cache.blocking:
+        rows, recently_written = await run_in_threadpool(_lookup)
+    else:
+        rows, recently_written = _lookup()
+    if rows is not None:
+        return rows
+
+    statement = sqlalchemy.text(sql)
+    async with admission.admit():
+        target, engine = ("primary", router.primary) if recently_written else router.choose()
+        started = time.perf_counter()
+        if isinstance(engine, AsyncEngine):
+            async with engine.connect() as conn:
+                result = await conn.execute(statement, params or {})
+                rows = [tuple(row) for row in result.fetchall()]
+        else:
+
+            def _fetch_all() -> list[tuple]:
+                with engine.connect() as conn:
+                    return [tuple(row) for row in conn.execute(statement, params or {}).fetchall()]
+
+            rows = await run_in_threadpool(_fetch_all)
+        router.observe(target, time.perf_counter() - started)
+
+    def _store() -> None:
+        # A write may have landed while a replica was answering.
+        if target == "primary" or not query_cache.recently_written(tables):
+            query_cache.set(key, rows, tables)
+
+    if query_cache.blocking:
+        await run_in_threadpool(_store)
+    else:
+        _store()
+    return rows
 
 
 @app.on_event("startup")
-def init_db() -> sqlalchemy.engine.base.Engine:
-    global db
-    db = init_connection_pool()
-    migrate_db(db)
+async def init_db() -> None:
+    global db, router, lag_monitor
+    if DB_ASYNC:
+        db = init_async_connection_pool()
+        install_invalidation_hooks(db.sync_engine, query_cache)
+        router = init_replica_router(db, init_async_connection_pool)
+        if MIGRATE_ON_STARTUP:
+            await migrate_db_async(db)
+        if POOL_WARMUP:
+            await asyncio.gather(*(warm_pool_async(engine) for engine in [db, *router.engines()]))
+    else:
+        db = init_connection_pool()
+        install_invalidation_hooks(db, query_cache)
+        router = init_replica_router(db, init_connection_pool)
+        if MIGRATE_ON_STARTUP:
+            await run_in_threadpool(migrate_db, db)
+        if POOL_WARMUP:
+            await asyncio.gather(*(run_in_threadpool(warm_pool, engine) for engine in [db, *router.engines()]))
+
+    query_cache.write_window = router.max_lag
+    if router.replicas:
+        await router.check_lag()
+        lag_monitor = asyncio.create_task(router.monitor_lag(REPLICA_LAG_CHECK_INTERVAL))
+
+
+@app.on_event("shutdown")
+async def close_db() -> None:
+    if lag_monitor is not None:
+        lag_monitor.cancel()
+    engines = [db, *router.engines()] if router is not None else [db]
+    for engine in engines:
+        if isinstance(engine, AsyncEngine):
+            await engine.dispose()
+        elif engine is not None:
+            engine.dispose()
+
+
+@app.middleware("http")
+async def propagate_deadline(request: Request, call_next):
+    try:
+        budget = float(request.headers.get("X-Request-Timeout", REQUEST_BUDGET))
+    except ValueError:
+        budget = REQUEST_BUDGET
+    # float() also accepts "nan" and "inf", which would disable the deadline checks.
+    if not math.isfinite(budget) or budget <= 0:
+        budget = REQUEST_BUDGET
+    request_deadline.set(time.monotonic() + budget)
+    return await call_next(request)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Service overloaded ({exc.reason})"},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
 
 
 @app.get("/")
@@ -57,14 +244,140 @@ def read_root():
     return {"Hello": "World"}
 
 
+@app.get("/cache/stats")
+def read_cache_stats():
+    return query_cache.stats()
+
+
+@app.get("/metrics")
+def read_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def _users_to_ndjson(rows: list[sqlalchemy.engine.Row]) -> str:
+    return "".join(json.dumps({"id": row[0], "position": row[1]}, ensure_ascii=False) + "\n" for row in rows)
+
+
+def stream_users() -> AsyncIterator[str]:
+    """Streams every user as NDJSON chunks over a server-side cursor, so memory stays flat."""
+    statement = sqlalchemy.text("SELECT id, position FROM users ORDER BY id")
+    _, engine = router.choose()
+    if isinstance(engine, AsyncEngine):
+
+        async def _stream_async() -> AsyncIterator[str]:
+            async with engine.connect() as conn:
+                result = await conn.stream(statement)
+                async for rows in result.partitions(EXPORT_CHUNK_SIZE):
+                    yield _users_to_ndjson(rows)
+
+        return _stream_async()
+
+    def _stream() -> Iterator[str]:
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(statement)
+            for rows in result.partitions(EXPORT_CHUNK_SIZE):
+                yield _users_to_ndjson(rows)
+
+    async def _stream_in_threadpool() -> AsyncIterator[str]:
+        chunks = _stream()
+        try:
+            async for chunk in iterate_in_threadpool(chunks):
+                yield chunk
+        finally:
+            # iterate_in_threadpool does not close the generator it wraps, so a cancelled
+            # export would keep its connection checked out.
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(chunks.close)
+
+    return _stream_in_threadpool()
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    Streams a response that holds an admission slot, releasing it however the response ends.
+
+    The slot is freed when the app calls the response, so it is not lost when the
+    client disconnects before the body starts. The body iterator is closed first
+    so its connection goes back to the pool.
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+            # Exports run far longer than reads, so they stay out of the service time average.
+            admission.release()
+
+
 @app.get("/items")
-def read_item():
-    users = []
-    with db.connect() as conn:
+async def read_item(
+    after_id: Optional[int] = None,
+    limit: int = Query(default=5, ge=1, le=1000),
+):
+    # Keyset pagination on the primary key keeps every page an index range scan,
+    # no matter how deep into the table the client is.
+    if after_id is None:
+        sql = """
+            SELECT id, position FROM users ORDER BY id LIMIT :limit;
+        """
+    else:
         sql = """
-            SELECT id, position FROM users LIMIT 5;
+            SELECT id, position FROM users WHERE id > :after_id ORDER BY id LIMIT :limit;
         """
-        recent_users = conn.execute(sqlalchemy.text(sql)).fetchall()
-        for row in recent_users:
-            users.append({"id": row[0], "position": row[1]})
-    return {"users": users}
+    recent_users = await fetch_all(sql, {"after_id": after_id, "limit": limit})
+    users = [{"id": row[0], "position": row[1]} for row in recent_users]
+    next_after_id = users[-1]["id"] if len(users) == limit else None
+    return {"users": users, "next_after_id": next_after_id}
+
+
+@app.get("/items/export")
+async def export_items():
+    # Admit before the response starts so an overloaded instance can still answer 503.
+    await admission.acquire()
+    try:
+        return AdmittedStreamingResponse(stream_users(), media_type="application/x-ndjson")
+    except BaseException:
+        admission.release()
+        raise
+
+
+@app.post("/users/bulk")
+async def bulk_load_users(
+    request: Request,
+    batch_size: int = Query(default=1000, ge=1, le=10000),
+    transaction_size: int = Query(default=10000, ge=1),
+):
+    """Upserts users from an NDJSON (default) or CSV (Content-Type: text/csv) request body."""
+    fmt = "csv" if request.headers.get("content-type", "").startswith("text/csv") else "ndjson"
+
+    # Spool the upload first so the connection is only held while rows are written.
+    # Large uploads roll over to disk, so writes go through the threadpool.
+    with tempfile.SpooledTemporaryFile(max_size=BULK_SPOOL_MAX_BYTES) as spool:
+        async for chunk in request.stream():
+            await run_in_threadpool(spool.write, chunk)
+        spool.seek(0)
+
+        def _load_sync() -> bulk.LoadResult:
+            with db.connect() as conn, io.TextIOWrapper(spool, encoding="utf-8", newline="") as stream:
+                return bulk.load_users(conn, bulk.parse(stream, fmt), batch_size, transaction_size)
+
+        async with admission.admit(observe=False):
+            try:
+                if isinstance(db, AsyncEngine):
+                    async with db.connect() as conn:
+                        with io.TextIOWrapper(spool, encoding="utf-8", newline="") as stream:
+                            users = bulk.parse(stream, fmt)
+                            result = await bulk.load_users_async(conn, users, batch_size, transaction_size)
+                else:
+                    result = await run_in_threadpool(_load_sync)
+            # Transactions committed before the bad row are kept.
+            except bulk.ConflictingRows as e:
+                raise HTTPException(status_code=409, detail=f"Conflicting rows at {e}")
+            except bulk.InvalidRow as e:
+                raise HTTPException(status_code=400, detail=f"Invalid row at {e}")
+            except (ValueError, KeyError, TypeError) as e:
+                raise HTTPException(status_code=400, detail=f"Invalid row: {e!r}")
+
+    return result.to_dict()
@@ -0,0 +1,150 @@
+import functools
+import time
+from typing import Callable, TypeVar
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, REGISTRY
+from prometheus_client.registry import Collector
+import sqlalchemy
+
+from app.cache import QueryCache
+
+T = TypeVar("T")
+
+# Buckets reach past the default pool_timeout of 30 seconds so saturation shows up.
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_seconds",
+    "Time to get a connection from the pool, including queueing and opening new connections.",
+    ["pool"],
+    buckets=_LATENCY_BUCKETS,
+)
+POOL_CONNECT_SECONDS = Histogram(
+    "db_pool_connect_seconds",
+    "Time for the database driver to open a new connection.",
+    ["pool"],
+    buckets=_LATENCY_BUCKETS,
+)
+CONNECTOR_HANDSHAKE_SECONDS = Histogram(
+    "db_connector_handshake_seconds",
+    "Time for the Cloud SQL Python Connector to open a new connection, including certificate refresh and TLS.",
+    ["pool"],
+    buckets=_LATENCY_BUCKETS,
+)
+POOL_SIZE = Gauge("db_pool_size", "Configured number of permanent connections.", ["pool"])
+POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections currently checked out of the pool.", ["pool"])
+POOL_OVERFLOW = Gauge(
+    "db_pool_overflow", "Connections open beyond pool_size. Negative while the pool is filling.", ["pool"]
+)
+POOL_CHECKOUTS = Counter("db_pool_checkouts", "Connections checked out of the pool.", ["pool"])
+POOL_RECYCLES = Counter("db_pool_recycles", "Connections closed because they outlived pool_recycle.", ["pool"])
+POOL_INVALIDATIONS = Counter(
+    "db_pool_invalidations", "Connections invalidated after an error or disconnect.", ["pool"]
+)
+
+REPLICA_QUERY_SECONDS = Histogram(
+    "db_replica_query_seconds",
+    "Latency of routed read queries by target, including reads that fell back to the primary.",
+    ["target"],
+    buckets=_LATENCY_BUCKETS,
+)
+REPLICA_LAG_SECONDS = Gauge("db_replica_lag_seconds", "Last measured replication lag. NaN when unknown.", ["replica"])
+
+ADMISSION_IN_FLIGHT = Gauge("admission_in_flight", "Requests currently running database work.")
+ADMISSION_QUEUE_DEPTH = Gauge("admission_queue_depth", "Requests waiting to be admitted.")
+ADMISSION_QUEUE_WAIT_SECONDS = Histogram(
+    "admission_queue_wait_seconds",
+    "Time requests spent waiting to be admitted, including those that timed out.",
+    buckets=_LATENCY_BUCKETS,
+)
+ADMISSION_REJECTIONS = Counter("admission_rejections", "Requests rejected with 503.", ["reason"])
+
+
+def instrument_pool(engine: sqlalchemy.engine.base.Engine, name: str) -> None:
+    """
+    Records checkout, connect and recycle telemetry for a QueuePool-backed engine.
+
+    Everything hangs off the engine rather than its pool, because dispose()
+    replaces the pool. For an AsyncEngine pass its sync_engine.
+    """
+    POOL_SIZE.labels(name).set_function(lambda: engine.pool.size())
+    POOL_CHECKED_OUT.labels(name).set_function(lambda: engine.pool.checkedout())
+    POOL_OVERFLOW.labels(name).set_function(lambda: engine.pool.overflow())
+
+    checkout_seconds = POOL_CHECKOUT_SECONDS.labels(name)
+    raw_connection = engine.raw_connection
+
+    # Pool events only fire once a connection is handed out, so the time spent
+    # waiting for one is measured around Engine.raw_connection, which every
+    # Connection checks out through.
+    @functools.wraps(raw_connection)
+    def _timed_raw_connection():
+        started = time.perf_counter()
+        try:
+            return raw_connection()
+        finally:
+            checkout_seconds.observe(time.perf_counter() - started)
+
+    engine.raw_connection = _timed_raw_connection
+
+    # do_connect is not fired for engines built with creator=, such as the
+    # connector factories; those report through observe_connector_handshake.
+    @sqlalchemy.event.listens_for(engine, "do_connect")
+    def _do_connect(dialect, conn_rec, cargs, cparams):
+        conn_rec.info["connect_started"] = time.perf_counter()
+
+    # Pool events registered on the engine carry over to the pool dispose() creates.
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        started = connection_record.info.pop("connect_started", None)
+        if started is not None:
+            POOL_CONNECT_SECONDS.labels(name).observe(time.perf_counter() - started)
+        connection_record.info["connected_at"] = time.monotonic()
+
+    @sqlalchemy.event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_CHECKOUTS.labels(name).inc()
+
+    @sqlalchemy.event.listens_for(engine, "invalidate")
+    def _invalidate(dbapi_connection, connection_record, exception):
+        connection_record.info["invalidated"] = True
+        POOL_INVALIDATIONS.labels(name).inc()
+
+    @sqlalchemy.event.listens_for(engine, "close")
+    def _close(dbapi_connection, connection_record):
+        connected_at = connection_record.info.pop("connected_at", None)
+        recycle = getattr(engine.pool, "_recycle", -1)
+        if connection_record.info.pop("invalidated", False) or connected_at is None or recycle < 0:
+            return
+        if time.monotonic() - connected_at >= recycle:
+            POOL_RECYCLES.labels(name).inc()
+
+
+def observe_connector_handshake(name: str) -> Callable[[Callable[[], T]], Callable[[], T]]:
+    """Decorates a Cloud SQL Python Connector getconn() to record its handshake latency."""
+
+    def decorator(getconn: Callable[[], T]) -> Callable[[], T]:
+        @functools.wraps(getconn)
+        def wrapper() -> T:
+            with CONNECTOR_HANDSHAKE_SECONDS.labels(name).time():
+                return getconn()
+
+        return wrapper
+
+    return decorator
+
+
+class QueryCacheCollector(Collector):
+    """Exports the hit/miss/invalidation counters of a QueryCache."""
+
+    def __init__(self, cache: QueryCache) -> None:
+        self.cache = cache
+
+    def collect(self):
+        for stat, value in self.cache.stats().items():
+            yield CounterMetricFamily(f"query_cache_{stat}", f"Query cache {stat}.", value=value)
+
+
+def register_query_cache(cache: QueryCache) -> None:
+    REGISTRY.register(QueryCacheCollector(cache))
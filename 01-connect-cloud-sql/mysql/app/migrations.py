@@ -0,0 +1,114 @@
+import hashlib
+import logging
+
+import sqlalchemy
+
+logger = logging.getLogger(__name__)
+
+# Append new migrations to the end; never edit one that has already been applied.
+MIGRATIONS: list[tuple[int, str, list[str]]] = [
+    (
+        1,
+        "create users",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id INT PRIMARY KEY,
+                position VARCHAR(255) NOT NULL,
+                status TINYINT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=INNODB;
+            """,
+        ],
+    ),
+    (
+        2,
+        "seed users",
+        [
+            'INSERT IGNORE INTO users VALUES (12345, "店長", 0, now());',
+        ],
+    ),
+]
+
+# Serializes migration runs across instances that boot at the same time.
+MIGRATION_LOCK = "schema_migrations"
+MIGRATION_LOCK_TIMEOUT = 60  # seconds
+
+
+def checksum(statements: list[str]) -> str:
+    normalized = "\n".join(" ".join(statement.split()) for statement in statements)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def _applied(conn: sqlalchemy.engine.base.Connection) -> dict[int, str]:
+    rows = conn.execute(sqlalchemy.text("SELECT version, checksum FROM schema_migrations")).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def _pending(applied: dict[int, str]) -> list[tuple[int, str, list[str]]]:
+    pending = []
+    for version, name, statements in MIGRATIONS:
+        if version not in applied:
+            pending.append((version, name, statements))
+        elif applied[version] != checksum(statements):
+            raise RuntimeError(f"Migration {version} ({name}) was modified after it was applied")
+    return pending
+
+
+def run_migrations(conn: sqlalchemy.engine.base.Connection) -> int:
+    """
+    Applies pending migrations and records their checksums in schema_migrations.
+
+    When every migration is already applied this costs two cheap queries and
+    takes no lock, so instances boot without touching the users table.
+    Returns the number of migrations applied.
+    """
+    conn.execute(
+        sqlalchemy.text(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                checksum CHAR(64) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            ) ENGINE=INNODB;
+            """
+        )
+    )
+    if not _pending(_applied(conn)):
+        conn.commit()
+        return 0
+
+    locked = conn.execute(
+        sqlalchemy.text("SELECT GET_LOCK(:name, :timeout)"),
+        {"name": MIGRATION_LOCK, "timeout": MIGRATION_LOCK_TIMEOUT},
+    ).scalar()
+    if locked != 1:
+        raise RuntimeError("Timed out waiting for another instance to finish migrating")
+
+    try:
+        # Another instance may have migrated while this one waited for the lock.
+        pending = _pending(_applied(conn))
+        for version, name, statements in pending:
+            logger.info("Applying migration %d (%s)", version, name)
+            for statement in statements:
+                conn.execute(sqlalchemy.text(statement))
+            conn.execute(
+                sqlalchemy.text("INSERT INTO schema_migrations (version, checksum) VALUES (:version, :checksum)"),
+                {"version": version, "checksum": checksum(statements)},
+            )
+            conn.commit()
+        return len(pending)
+    finally:
+        conn.execute(sqlalchemy.text("SELECT RELEASE_LOCK(:name)"), {"name": MIGRATION_LOCK})
+        conn.commit()
+
+
+if __name__ == "__main__":
+    # Run as a Cloud Run job (python -m app.migrations) together with MIGRATE_ON_STARTUP=false
+    # to take migrations off the instance start-up path entirely.
+    from app.main import init_connection_pool
+
+    logging.basicConfig(level=logging.INFO)
+    engine = init_connection_pool()
+    with engine.connect() as connection:
+        logger.info("Applied %d migration(s)", run_migrations(connection))
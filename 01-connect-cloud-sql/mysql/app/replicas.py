@@ -0,0 +1,153 @@
+import asyncio
+import itertools
+import logging
+import os
+from typing import Callable, Mapping, Optional, Union
+
+from fastapi.concurrency import run_in_threadpool
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.metrics import REPLICA_LAG_SECONDS, REPLICA_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+Engine = Union[sqlalchemy.engine.base.Engine, AsyncEngine]
+
+# Connection type variables are never inherited from the primary, so a replica
+# configured with REPLICA_<NAME>_INSTANCE_CONNECTION_NAME does not pick up INSTANCE_HOST.
+_CONNECTION_TYPES = ("INSTANCE_HOST", "INSTANCE_UNIX_SOCKET", "INSTANCE_CONNECTION_NAME")
+
+
+def replica_environ(name: str, environ: Optional[Mapping[str, str]] = None) -> dict[str, str]:
+    """
+    Builds the environment a connect_* factory sees for replica <name>.
+
+    REPLICA_<NAME>_<VAR> overrides <VAR>, so credentials shared with the primary
+    (DB_USER, DB_PASS, DB_NAME, ...) only need to be set once.
+    """
+    environ = os.environ if environ is None else environ
+    prefix = f"REPLICA_{name.upper()}_"
+    replica = {key: value for key, value in environ.items() if key not in _CONNECTION_TYPES}
+    replica.update({key[len(prefix):]: value for key, value in environ.items() if key.startswith(prefix)})
+    return replica
+
+
+def _replication_lag(conn: sqlalchemy.engine.base.Connection) -> Optional[float]:
+    # SHOW REPLICA STATUS and Seconds_Behind_Source need MySQL 8.0.22+. Older servers reject
+    # the statement as a syntax error and report SHOW SLAVE STATUS / Seconds_Behind_Master.
+    # Both need the REPLICATION CLIENT privilege and return no row on a server that is not replicating.
+    try:
+        row = conn.execute(sqlalchemy.text("SHOW REPLICA STATUS")).mappings().first()
+    except sqlalchemy.exc.ProgrammingError:
+        row = conn.execute(sqlalchemy.text("SHOW SLAVE STATUS")).mappings().first()
+    if row is None:
+        return None
+    lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+    return None if lag is None else float(lag)
+
+
+def _check_lag_sync(engine: sqlalchemy.engine.base.Engine) -> Optional[float]:
+    with engine.connect() as conn:
+        return _replication_lag(conn)
+
+
+class Replica:
+    def __init__(self, name: str, engine: Engine) -> None:
+        self.name = name
+        self.engine = engine
+        # None until the first successful lag check, or while replication is stopped.
+        self.lag: Optional[float] = None
+
+    @property
+    def checked_out(self) -> int:
+        pool = self.engine.sync_engine.pool if isinstance(self.engine, AsyncEngine) else self.engine.pool
+        return pool.checkedout()
+
+
+class ReplicaRouter:
+    """
+    Sends read-only work to read replicas and everything else to the primary.
+
+    Replicas are picked round-robin or by fewest checked-out connections. A replica
+    whose replication lag is unknown or above max_lag is skipped, and reads fall
+    back to the primary when no replica qualifies.
+    """
+
+    def __init__(
+        self,
+        primary: Engine,
+        replicas: list[Replica],
+        strategy: str = "round_robin",
+        max_lag: float = 10.0,
+    ) -> None:
+        if strategy not in ("round_robin", "least_connections"):
+            raise ValueError(
+                f"Unknown replica routing strategy '{strategy}'. Please use round_robin or least_connections"
+            )
+        self.primary = primary
+        self.replicas = replicas
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self._round_robin = itertools.cycle(replicas) if replicas else None
+
+    def engines(self) -> list[Engine]:
+        return [replica.engine for replica in self.replicas]
+
+    def _healthy(self, replica: Replica) -> bool:
+        return replica.lag is not None and replica.lag <= self.max_lag
+
+    def choose(self) -> tuple[str, Engine]:
+        """Returns the (name, engine) to run the next read on."""
+        if self.strategy == "least_connections":
+            candidates = [replica for replica in self.replicas if self._healthy(replica)]
+            if candidates:
+                replica = min(candidates, key=lambda replica: replica.checked_out)
+                return replica.name, replica.engine
+        elif self._round_robin is not None:
+            for _ in range(len(self.replicas)):
+                replica = next(self._round_robin)
+                if self._healthy(replica):
+                    return replica.name, replica.engine
+        return "primary", self.primary
+
+    def observe(self, name: str, seconds: float) -> None:
+        REPLICA_QUERY_SECONDS.labels(name).observe(seconds)
+
+    async def check_lag(self) -> None:
+        for replica in self.replicas:
+            try:
+                if isinstance(replica.engine, AsyncEngine):
+                    async with replica.engine.connect() as conn:
+                        replica.lag = await conn.run_sync(_replication_lag)
+                else:
+                    replica.lag = await run_in_threadpool(_check_lag_sync, replica.engine)
+            except Exception:
+                logger.exception("Replication lag check failed for replica %s", replica.name)
+                replica.lag = None
+            REPLICA_LAG_SECONDS.labels(replica.name).set(float("nan") if replica.lag is None else replica.lag)
+
+    async def monitor_lag(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_lag()
+
+
+def init_replica_router(
+    primary: Engine,
+    init_pool: Callable[[Mapping[str, str], str], Engine],
+) -> ReplicaRouter:
+    """
+    Builds a router from DB_REPLICAS, a comma-separated list of replica names.
+
+    init_pool is init_connection_pool or init_async_connection_pool, so every
+    replica is built by the same connect_* factories as the primary.
+    """
+    names = [name.strip() for name in os.environ.get("DB_REPLICAS", "").split(",") if name.strip()]
+    replicas = [Replica(name, init_pool(replica_environ(name), name)) for name in names]
+    return ReplicaRouter(
+        primary,
+        replicas,
+        strategy=os.environ.get("REPLICA_ROUTING", "round_robin"),
+        max_lag=float(os.environ.get("REPLICA_MAX_LAG", 10)),
+    )
@@ -0,0 +1,42 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+def warm_pool(engine: sqlalchemy.engine.base.Engine) -> None:
+    """
+    Opens pool_size connections concurrently so the first requests skip the TLS/connector handshake.
+
+    Every connection is held until all of them are open; otherwise the pool would
+    keep handing back the first one.
+    """
+    size = engine.pool.size()
+    opened = threading.Barrier(size)
+
+    def _checkout() -> None:
+        try:
+            with engine.connect():
+                opened.wait()
+        except BaseException:
+            # Release the other workers instead of leaving them waiting on the barrier.
+            opened.abort()
+            raise
+
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        for future in [executor.submit(_checkout) for _ in range(size)]:
+            future.result()
+
+
+async def warm_pool_async(engine: AsyncEngine) -> None:
+    """Async variant of warm_pool."""
+    connections = [engine.connect() for _ in range(engine.sync_engine.pool.size())]
+    results = await asyncio.gather(*(conn.start() for conn in connections), return_exceptions=True)
+    await asyncio.gather(
+        *(conn.close() for conn, result in zip(connections, results) if not isinstance(result, BaseException))
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
@@ -0,0 +1,308 @@
+"""
+Benchmarks the TCP, Unix socket and Cloud SQL connector pool modes.
+
+Each combination of mode, pool size and concurrency runs three scenarios:
+
+- connect: opens fresh connections one at a time to measure connect overhead
+- checkout: concurrent workers check a connection out of the pool and run SELECT 1
+- items: concurrent GET /items against the app in-process (or --url for a deployed service)
+
+Run against the MySQL from docker-compose.yaml (docker compose up -d mysql):
+
+    INSTANCE_HOST=127.0.0.1 DB_PORT=3306 DB_USER=user DB_PASS=password DB_NAME=db \\
+        python -m benchmarks.pool_bench --modes tcp --pool-sizes 5,10 --concurrency 8,32 --output results.json
+
+Modes are taken from the usual connection variables: tcp needs INSTANCE_HOST, unix needs
+INSTANCE_UNIX_SOCKET, connector needs INSTANCE_CONNECTION_NAME (plus DB_IAM_USER for
+connector_iam). Results are written as JSON so runs can be diffed to spot regressions.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+from typing import Callable, Optional
+
+# The app reads these at import time; benchmark the database, not the cache or the load shedder.
+os.environ.setdefault("QUERY_CACHE", "none")
+os.environ.setdefault("REQUEST_BUDGET", "3600")
+
+import httpx  # noqa: E402
+import sqlalchemy  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncEngine  # noqa: E402
+
+from app import main as app_main  # noqa: E402
+from app.admission import AdmissionController  # noqa: E402
+from app.replicas import ReplicaRouter  # noqa: E402
+
+# Connection variables each mode needs, and those it must not see.
+MODES = {
+    "tcp": ("INSTANCE_HOST", ()),
+    "unix": ("INSTANCE_UNIX_SOCKET", ()),
+    "connector": ("INSTANCE_CONNECTION_NAME", ("DB_IAM_USER",)),
+    "connector_iam": ("INSTANCE_CONNECTION_NAME", ()),
+}
+_CONNECTION_VARS = ("INSTANCE_HOST", "INSTANCE_UNIX_SOCKET", "INSTANCE_CONNECTION_NAME")
+
+
+def mode_environ(mode: str, pool_size: int, max_overflow: int) -> Optional[dict[str, str]]:
+    """Returns the environment that makes init_connection_pool() pick mode, or None if it is not configured."""
+    required, excluded = MODES[mode]
+    if not os.environ.get(required) or (mode == "connector_iam" and not os.environ.get("DB_IAM_USER")):
+        return None
+    environ = {key: value for key, value in os.environ.items() if key not in _CONNECTION_VARS + excluded}
+    environ[required] = os.environ[required]
+    environ["DB_POOL_SIZE"] = str(pool_size)
+    environ["DB_MAX_OVERFLOW"] = str(max_overflow)
+    return environ
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def summarize(latencies: list[float], errors: int, seconds: float) -> dict:
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def bench_connect(engine: sqlalchemy.engine.base.Engine, iterations: int) -> dict:
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        # Disposing the pool forces the next checkout to open a new connection.
+        engine.dispose()
+        op_started = time.perf_counter()
+        try:
+            with engine.connect():
+                pass
+            latencies.append(time.perf_counter() - op_started)
+        except Exception:
+            errors += 1
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def bench_checkout(engine: sqlalchemy.engine.base.Engine, concurrency: int, requests: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    def worker() -> None:
+        nonlocal errors
+        for _ in iter(lambda: next(remaining, None), None):
+            op_started = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    conn.execute(sqlalchemy.text("SELECT 1"))
+                elapsed = time.perf_counter() - op_started
+                with lock:
+                    latencies.append(elapsed)
+            except Exception:
+                with lock:
+                    errors += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def bench_checkout_async(engine: AsyncEngine, concurrency: int, requests: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for _ in iter(lambda: next(remaining, None), None):
+            op_started = time.perf_counter()
+            try:
+                async with engine.connect() as conn:
+                    await conn.execute(sqlalchemy.text("SELECT 1"))
+                latencies.append(time.perf_counter() - op_started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def bench_items(client: httpx.AsyncClient, concurrency: int, requests: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for _ in iter(lambda: next(remaining, None), None):
+            op_started = time.perf_counter()
+            try:
+                response = await client.get("/items")
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - op_started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def items_client(engine, url: Optional[str], max_in_flight: int) -> httpx.AsyncClient:
+    if url:
+        return httpx.AsyncClient(base_url=url, timeout=60)
+    # Drive the ASGI app in-process on the engine under test, skipping its startup hook.
+    # A new admission controller per run, since its semaphore binds to the running event loop.
+    app_main.db = engine
+    app_main.router = ReplicaRouter(engine, [])
+    app_main.admission = AdmissionController(max_in_flight=max_in_flight, max_queue=100000)
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app_main.app), base_url="http://bench", timeout=60)
+
+
+async def bench_connect_async(engine: AsyncEngine, iterations: int) -> dict:
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await engine.dispose()
+        op_started = time.perf_counter()
+        try:
+            async with engine.connect():
+                pass
+            latencies.append(time.perf_counter() - op_started)
+        except Exception:
+            errors += 1
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run_scenarios_async(
+    engine: AsyncEngine,
+    concurrency: int,
+    requests: int,
+    connect_iterations: int,
+    url: Optional[str],
+    max_in_flight: int,
+) -> dict[str, dict]:
+    results = {"connect": await bench_connect_async(engine, connect_iterations)}
+    results["checkout"] = await bench_checkout_async(engine, concurrency, requests)
+    async with items_client(engine, url, max_in_flight) as client:
+        results["items"] = await bench_items(client, concurrency, requests)
+    await engine.dispose()
+    return results
+
+
+async def _bench_items(engine, concurrency: int, requests: int, url: Optional[str], max_in_flight: int) -> dict:
+    async with items_client(engine, url, max_in_flight) as client:
+        return await bench_items(client, concurrency, requests)
+
+
+def run_scenarios(
+    engine: sqlalchemy.engine.base.Engine,
+    concurrency: int,
+    requests: int,
+    connect_iterations: int,
+    url: Optional[str],
+    max_in_flight: int,
+) -> dict[str, dict]:
+    results = {"connect": bench_connect(engine, connect_iterations)}
+    results["checkout"] = bench_checkout(engine, concurrency, requests)
+    results["items"] = asyncio.run(_bench_items(engine, concurrency, requests, url, max_in_flight))
+    engine.dispose()
+    return results
+
+
+def run(args: argparse.Namespace) -> list[dict]:
+    init_pool: Callable = app_main.init_async_connection_pool if args.use_async else app_main.init_connection_pool
+    results = []
+    for mode in args.modes:
+        for pool_size in args.pool_sizes:
+            environ = mode_environ(mode, pool_size, args.max_overflow)
+            if environ is None:
+                print(f"skipping {mode}: not configured")
+                break
+            for concurrency in args.concurrency:
+                # A fresh engine per run keeps pools from warming each other up, and
+                # async engines are bound to the event loop that opened their connections.
+                engine = init_pool(environ, f"bench-{mode}")
+                max_in_flight = pool_size + args.max_overflow
+                bench_args = (concurrency, args.requests, args.connect_iterations, args.url, max_in_flight)
+                if args.use_async:
+                    scenarios = asyncio.run(run_scenarios_async(engine, *bench_args))
+                else:
+                    scenarios = run_scenarios(engine, *bench_args)
+                for scenario, summary in scenarios.items():
+                    result = {
+                        "mode": mode,
+                        "async": args.use_async,
+                        "pool_size": pool_size,
+                        "max_overflow": args.max_overflow,
+                        "concurrency": concurrency,
+                        "scenario": scenario,
+                        **summary,
+                    }
+                    print(json.dumps(result))
+                    results.append(result)
+    return results
+
+
+def _ints(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", type=lambda value: value.split(","), default=list(MODES))
+    parser.add_argument("--pool-sizes", type=_ints, default=[5])
+    parser.add_argument("--max-overflow", type=int, default=2)
+    parser.add_argument("--concurrency", type=_ints, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=2000, help="operations per scenario")
+    parser.add_argument("--connect-iterations", type=int, default=50)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the aiomysql engines")
+    parser.add_argument("--url", help="benchmark /items on a running service instead of in-process")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    "revision": _git_revision(),
+                    "python": platform.python_version(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import asyncio
+import time
+import types
+import unittest
+from unittest import mock
+
+from app import main
+from app.admission import AdmissionController, Overloaded, request_deadline
+
+
+class AdmissionControllerTest(unittest.IsolatedAsyncioTestCase):
+    def assertSlots(self, controller: AdmissionController, in_flight: int) -> None:
+        self.assertEqual(controller.in_flight, in_flight)
+        self.assertEqual(controller.queued, 0)
+        self.assertEqual(controller._semaphore._value, controller.max_in_flight - in_flight)
+
+    async def test_sheds_when_queue_is_full(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=1)
+        await controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        with self.assertRaises(Overloaded) as raised:
+            await controller.acquire()
+        self.assertEqual(raised.exception.reason, "queue_full")
+
+        controller.release()
+        await waiter
+        self.assertSlots(controller, 1)
+        controller.release()
+        self.assertSlots(controller, 0)
+
+    async def test_sheds_when_estimated_wait_outlasts_deadline(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=10)
+        controller.service_time = 5.0
+        await controller.acquire()
+        request_deadline.set(time.monotonic() + 1.0)
+        with self.assertRaises(Overloaded) as raised:
+            await controller.acquire()
+        self.assertEqual(raised.exception.reason, "deadline")
+        self.assertEqual(raised.exception.retry_after, 5.0)
+        self.assertSlots(controller, 1)
+
+    async def test_deadline_expires_while_queued(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=10)
+        await controller.acquire()
+        request_deadline.set(time.monotonic() + 0.05)
+        with self.assertRaises(Overloaded) as raised:
+            await controller.acquire()
+        self.assertEqual(raised.exception.reason, "deadline")
+        self.assertSlots(controller, 1)
+
+        controller.release()
+        request_deadline.set(None)
+        await asyncio.wait_for(controller.acquire(), 1.0)
+        self.assertSlots(controller, 1)
+
+    async def test_cancelled_waiter_hands_back_a_slot_it_was_given(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=10)
+        await controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        # The slot goes to the waiter, which is cancelled before it gets to run.
+        controller.release()
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0)
+        self.assertSlots(controller, 0)
+        await asyncio.wait_for(controller.acquire(), 1.0)
+        self.assertSlots(controller, 1)
+
+    async def test_admit_folds_service_time_into_average(self):
+        controller = AdmissionController(max_in_flight=2, max_queue=10, smoothing=0.5)
+        async with controller.admit():
+            await asyncio.sleep(0.02)
+        self.assertGreater(controller.service_time, 0.0)
+        async with controller.admit(observe=False):
+            service_time = controller.service_time
+        self.assertEqual(controller.service_time, service_time)
+        self.assertSlots(controller, 0)
+
+
+class RequestDeadlineTest(unittest.IsolatedAsyncioTestCase):
+    async def deadline_for(self, header: str) -> float:
+        request = types.SimpleNamespace(headers={"X-Request-Timeout": header})
+
+        async def call_next(request):
+            return request_deadline.get() - time.monotonic()
+
+        return await main.propagate_deadline(request, call_next)
+
+    async def test_uses_header_budget(self):
+        self.assertAlmostEqual(await self.deadline_for("2.5"), 2.5, delta=0.5)
+
+    async def test_rejects_unusable_budgets(self):
+        for header in ("nan", "inf", "-inf", "0", "-3", "soon"):
+            with self.subTest(header=header):
+                self.assertAlmostEqual(await self.deadline_for(header), main.REQUEST_BUDGET, delta=0.5)
+
+
+class AdmittedStreamingResponseTest(unittest.IsolatedAsyncioTestCase):
+    async def test_releases_slot_when_client_goes_away(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=10)
+        closed = []
+
+        async def body():
+            try:
+                yield b"{}\n"
+                await asyncio.sleep(10)
+                yield b"{}\n"
+            finally:
+                closed.append(True)
+
+        first_chunk_sent = asyncio.Event()
+
+        async def receive():
+            await first_chunk_sent.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                first_chunk_sent.set()
+
+        await controller.acquire()
+        response = main.AdmittedStreamingResponse(body())
+        with mock.patch.object(main, "admission", controller):
+            await asyncio.wait_for(response({"type": "http"}, receive, send), 1.0)
+        self.assertEqual(closed, [True])
+        self.assertSlots(controller)
+
+    async def test_releases_slot_when_body_never_starts(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=10)
+
+        async def body():
+            yield b"{}\n"
+
+        async def receive():
+            await asyncio.sleep(10)
+
+        async def send(message):
+            raise OSError("client went away")
+
+        await controller.acquire()
+        response = main.AdmittedStreamingResponse(body())
+        with mock.patch.object(main, "admission", controller):
+            # Raised on its own or inside an ExceptionGroup, depending on the Starlette version.
+            with self.assertRaises((OSError, ExceptionGroup)):
+                await response({"type": "http"}, receive, send)
+        self.assertSlots(controller)
+
+    def assertSlots(self, controller: AdmissionController) -> None:
+        self.assertEqual(controller.in_flight, 0)
+        self.assertEqual(controller._semaphore._value, 1)
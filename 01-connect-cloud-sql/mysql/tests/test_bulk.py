@@ -0,0 +1,103 @@
+import io
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+import sqlalchemy
+
+from app import bulk, main
+
+
+def sqlite_upsert(size: int) -> sqlalchemy.TextClause:
+    # SQLite spelling of the MySQL INSERT ... ON DUPLICATE KEY UPDATE built by _upsert_statement.
+    values = ", ".join(f"(:id_{i}, :position_{i}, :status_{i})" for i in range(size))
+    return sqlalchemy.text(
+        f"INSERT INTO users (id, position, status) VALUES {values} "
+        "ON CONFLICT (id) DO UPDATE SET position = excluded.position, status = excluded.status"
+    )
+
+
+class ParseTest(unittest.TestCase):
+    def parse(self, text: str, fmt: str = "ndjson") -> list[dict]:
+        return list(bulk.parse(io.StringIO(text), fmt))
+
+    def test_rows_are_converted_and_tagged_with_their_line(self):
+        users = self.parse('{"id": "1", "position": "a"}\n\n{"id": 2, "position": "b", "status": 3}\n')
+        self.assertEqual(
+            users,
+            [{"id": 1, "position": "a", "status": 0, "line": 1}, {"id": 2, "position": "b", "status": 3, "line": 3}],
+        )
+
+    def test_invalid_ndjson_rows_name_their_line(self):
+        cases = {
+            '{"id": 1, "position": "a"}\n[1, "a"]\n': "line 2: expected an object, got list",
+            '{"id": 1, "position": "a"}\n{"id": 2,\n': "line 2: invalid JSON",
+            '\n{"position": "a"}\n': "line 2: missing 'id'",
+            '{"id": [1], "position": "a"}\n': "line 1: int()",
+            '{"id": "x", "position": "a"}\n': "line 1: invalid literal",
+        }
+        for text, message in cases.items():
+            with self.subTest(text=text), self.assertRaises(bulk.InvalidRow) as raised:
+                self.parse(text)
+            self.assertTrue(str(raised.exception).startswith(message), raised.exception)
+
+    def test_invalid_csv_rows_name_their_line(self):
+        with self.assertRaises(bulk.InvalidRow) as raised:
+            self.parse("id,position\n1,a\nx,b\n", "csv")
+        self.assertEqual(raised.exception.line, 3)
+
+
+class BulkLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine(
+            "sqlite://", poolclass=sqlalchemy.pool.StaticPool, connect_args={"check_same_thread": False}
+        )
+        with self.engine.begin() as conn:
+            conn.execute(
+                sqlalchemy.text(
+                    "CREATE TABLE users (id INTEGER PRIMARY KEY, position TEXT NOT NULL CHECK (position <> ''), "
+                    "status INTEGER NOT NULL DEFAULT 0)"
+                )
+            )
+        # Startup is not run, so no MySQL connection is made.
+        patches = [
+            mock.patch.object(main, "db", self.engine),
+            mock.patch.object(bulk, "_upsert_statement", sqlite_upsert),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def users(self) -> list[tuple]:
+        with self.engine.connect() as conn:
+            return conn.execute(sqlalchemy.text("SELECT id, position, status FROM users ORDER BY id")).all()
+
+    def post(self, body: str, content_type: str = "application/x-ndjson", **params):
+        return self.client.post("/users/bulk", content=body, headers={"Content-Type": content_type}, params=params)
+
+    def test_upserts_ndjson_and_csv(self):
+        response = self.post('{"id": 1, "position": "a"}\n{"id": 2, "position": "b", "status": 1}\n')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["rows"], 2)
+        response = self.post("id,position,status\n2,c,2\n3,d,\n", "text/csv")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.users(), [(1, "a", 0), (2, "c", 2), (3, "d", 0)])
+
+    def test_row_that_is_not_an_object_is_a_bad_request(self):
+        response = self.post('{"id": 1, "position": "a"}\n"oops"\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("line 2", response.json()["detail"])
+        self.assertEqual(self.users(), [])
+
+    def test_integrity_error_is_a_conflict_naming_the_batch_lines(self):
+        body = "".join(f'{{"id": {i}, "position": "{"" if i == 4 else "p"}"}}\n' for i in range(1, 6))
+        response = self.post(body, batch_size=2, transaction_size=2)
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("lines 3-4", response.json()["detail"])
+        # The transaction holding the first batch was committed before the conflict.
+        self.assertEqual(self.users(), [(1, "p", 0), (2, "p", 0)])
+        self.assertEqual(main.admission.in_flight, 0)
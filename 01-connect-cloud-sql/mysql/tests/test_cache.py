@@ -0,0 +1,226 @@
+import sys
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import sqlalchemy
+from sqlalchemy.util.concurrency import greenlet_spawn
+
+from app.cache import cache_key, install_invalidation_hooks, LRUCache, read_tables, RedisCache, written_tables
+
+
+class TableParsingTest(unittest.TestCase):
+    def test_read_tables(self):
+        sql = "SELECT u.id FROM `users` u JOIN orders o ON o.user_id = u.id"
+        self.assertEqual(read_tables(sql), {"users", "orders"})
+
+    def test_written_tables(self):
+        self.assertEqual(written_tables("INSERT IGNORE INTO Users (id) VALUES (1)"), {"users"})
+        self.assertEqual(written_tables("UPDATE users SET position = 'x'"), {"users"})
+        self.assertEqual(written_tables("DELETE FROM `users` WHERE id = 1"), {"users"})
+        self.assertEqual(written_tables("SELECT id FROM users"), set())
+
+    def test_cache_key_ignores_whitespace(self):
+        self.assertEqual(cache_key("SELECT  1\n FROM t", {"a": 1}), cache_key("SELECT 1 FROM t", {"a": 1}))
+        self.assertNotEqual(cache_key("SELECT 1 FROM t", {"a": 1}), cache_key("SELECT 1 FROM t", {"a": 2}))
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", [(1,)], ["t"])
+        cache.set("b", [(2,)], ["t"])
+        cache.get("a")
+        cache.set("c", [(3,)], ["t"])
+        self.assertEqual(cache.get("a"), [(1,)])
+        self.assertIsNone(cache.get("b"))
+
+    def test_expires_after_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set("a", [(1,)], ["t"])
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 1, "invalidations": 0})
+
+    def test_invalidate_drops_only_affected_tables(self):
+        cache = LRUCache()
+        cache.set("users", [(1,)], ["users"])
+        cache.set("orders", [(2,)], ["orders"])
+        cache.invalidate("USERS")
+        self.assertIsNone(cache.get("users"))
+        self.assertEqual(cache.get("orders"), [(2,)])
+
+    def test_recently_written(self):
+        cache = LRUCache()
+        cache.write_window = 60
+        cache.invalidate("users")
+        self.assertTrue(cache.recently_written(["orders", "users"]))
+        self.assertFalse(cache.recently_written(["orders"]))
+        cache.write_window = 0
+        self.assertFalse(cache.recently_written(["users"]))
+
+
+class InvalidationHooksTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite://")
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE TABLE users (id INTEGER PRIMARY KEY, position TEXT)"))
+        self.cache = LRUCache()
+        install_invalidation_hooks(self.engine, self.cache)
+        self.cache.set("users", [(1, "a")], ["users"])
+        self.cache.set("orders", [(2,)], ["orders"])
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_write_invalidates_on_execute(self):
+        with self.engine.connect() as conn:
+            conn.execute(sqlalchemy.text("INSERT INTO users (id, position) VALUES (1, 'a')"))
+            self.assertIsNone(self.cache.get("users"))
+            conn.commit()
+        self.assertEqual(self.cache.get("orders"), [(2,)])
+
+    def test_commit_invalidates_results_cached_mid_transaction(self):
+        with self.engine.connect() as conn:
+            conn.execute(sqlalchemy.text("UPDATE users SET position = 'b'"))
+            self.cache.set("users", [(1, "a")], ["users"])
+            conn.commit()
+        self.assertIsNone(self.cache.get("users"))
+
+    def test_rollback_forgets_written_tables(self):
+        with self.engine.connect() as conn:
+            conn.execute(sqlalchemy.text("DELETE FROM users"))
+            conn.rollback()
+            self.cache.set("users", [(1, "a")], ["users"])
+            conn.commit()
+        self.assertEqual(self.cache.get("users"), [(1, "a")])
+
+    def test_reads_do_not_invalidate(self):
+        with self.engine.connect() as conn:
+            conn.execute(sqlalchemy.text("SELECT id FROM users"))
+            conn.commit()
+        self.assertEqual(self.cache.get("users"), [(1, "a")])
+        self.assertEqual(self.cache.invalidations, 0)
+
+
+class BlockingCache(LRUCache):
+    """An LRUCache that asks to be kept off the event loop, like RedisCache, and records where it ran."""
+
+    blocking = True
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls: list[tuple[frozenset[str], int]] = []
+
+    def invalidate(self, *tables: str) -> None:
+        self.calls.append((frozenset(tables), threading.get_ident()))
+        super().invalidate(*tables)
+
+
+class BlockingInvalidationHooksTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite://", poolclass=sqlalchemy.pool.StaticPool)
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE TABLE users (id INTEGER PRIMARY KEY, position TEXT)"))
+            conn.execute(sqlalchemy.text("CREATE TABLE orders (id INTEGER PRIMARY KEY)"))
+        self.cache = BlockingCache()
+        install_invalidation_hooks(self.engine, self.cache)
+        self.cache.set("users", [(1, "a")], ["users"])
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def write(self) -> None:
+        with self.engine.connect() as conn:
+            conn.execute(sqlalchemy.text("INSERT INTO users (id, position) VALUES (1, 'a')"))
+            conn.execute(sqlalchemy.text("UPDATE users SET position = 'b'"))
+            conn.execute(sqlalchemy.text("INSERT INTO orders (id) VALUES (1)"))
+            self.assertEqual(self.cache.get("users"), [(1, "a")])
+            conn.commit()
+
+    def test_invalidates_once_on_commit(self):
+        self.write()
+        self.assertEqual([tables for tables, _ in self.cache.calls], [frozenset({"users", "orders"})])
+        self.assertIsNone(self.cache.get("users"))
+
+    async def test_async_engine_invalidates_off_the_event_loop(self):
+        # What AsyncConnection does: run the sync connection inside a greenlet on the loop.
+        self.engine.dialect.is_async = True
+        await greenlet_spawn(self.write)
+        [(tables, thread)] = self.cache.calls
+        self.assertEqual(tables, frozenset({"users", "orders"}))
+        self.assertNotEqual(thread, threading.get_ident())
+        self.assertIsNone(self.cache.get("users"))
+
+
+class FakePipeline:
+    def __init__(self, client: "FakeRedis") -> None:
+        self.client = client
+        self.commands: list[tuple] = []
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self) -> list:
+        self.client.round_trips += 1
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakeRedis:
+    """Just enough of redis.Redis for RedisCache, counting round trips."""
+
+    def __init__(self) -> None:
+        self.data: dict[bytes, object] = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    def set(self, key: str, value, px: int = None) -> None:
+        self.data[key.encode()] = value
+
+    def get(self, key: str):
+        self.round_trips += 1
+        return self.data.get(key.encode())
+
+    def sadd(self, key: str, member: str) -> None:
+        self.data.setdefault(key.encode(), set()).add(member.encode())
+
+    def pexpire(self, key: str, ms: int) -> None:
+        pass
+
+    def smembers(self, key: str) -> set:
+        return set(self.data.get(key.encode(), set()))
+
+    def unlink(self, *keys) -> None:
+        for key in keys:
+            self.data.pop(key if isinstance(key, bytes) else key.encode(), None)
+
+
+class RedisCacheTest(unittest.TestCase):
+    def setUp(self):
+        redis = types.ModuleType("redis")
+        redis.Redis = mock.Mock()
+        redis.Redis.from_url.return_value = FakeRedis()
+        with mock.patch.dict(sys.modules, {"redis": redis}):
+            self.cache = RedisCache("redis://test")
+        self.client = self.cache.client
+
+    def test_round_trip(self):
+        self.cache.set("a", [(1, "x")], ["users"])
+        self.assertEqual(self.cache.get("a"), [(1, "x")])
+
+    def test_invalidate_takes_two_round_trips_for_any_number_of_tables(self):
+        self.cache.set("users", [(1,)], ["users"])
+        self.cache.set("join", [(1,)], ["users", "orders"])
+        self.cache.set("items", [(1,)], ["items"])
+        self.client.round_trips = 0
+        self.cache.write_window = 10
+        self.cache.invalidate("USERS", "orders", "missing")
+        self.assertEqual(self.client.round_trips, 2)
+        self.assertIsNone(self.cache.get("users"))
+        self.assertIsNone(self.cache.get("join"))
+        self.assertEqual(self.cache.get("items"), [(1,)])
+        self.assertIn(b"querycache:written:users", self.client.data)
@@ -0,0 +1,56 @@
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+import sqlalchemy
+
+from app import main
+from app.cache import NullCache
+from app.replicas import ReplicaRouter
+
+
+class KeysetPaginationTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine(
+            "sqlite://", poolclass=sqlalchemy.pool.StaticPool, connect_args={"check_same_thread": False}
+        )
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text("CREATE TABLE users (id INTEGER PRIMARY KEY, position TEXT)"))
+            conn.execute(
+                sqlalchemy.text("INSERT INTO users (id, position) VALUES (:id, :position)"),
+                [{"id": user_id, "position": f"p{user_id}"} for user_id in (3, 1, 7, 4, 9)],
+            )
+        # Startup is not run, so no MySQL connection is made.
+        patches = [
+            mock.patch.object(main, "router", ReplicaRouter(self.engine, [])),
+            mock.patch.object(main, "query_cache", NullCache()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = TestClient(main.app)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_pages_follow_next_after_id(self):
+        pages = []
+        params = {"limit": 2}
+        while True:
+            body = self.client.get("/items", params=params).json()
+            pages.append([user["id"] for user in body["users"]])
+            if body["next_after_id"] is None:
+                break
+            params["after_id"] = body["next_after_id"]
+        self.assertEqual(pages, [[1, 3], [4, 7], [9]])
+
+    def test_full_last_page_points_past_the_end(self):
+        body = self.client.get("/items", params={"after_id": 4, "limit": 2}).json()
+        self.assertEqual(body["users"], [{"id": 7, "position": "p7"}, {"id": 9, "position": "p9"}])
+        self.assertEqual(body["next_after_id"], 9)
+        body = self.client.get("/items", params={"after_id": 9, "limit": 2}).json()
+        self.assertEqual(body, {"users": [], "next_after_id": None})
+
+    def test_limit_is_bounded(self):
+        self.assertEqual(self.client.get("/items", params={"limit": 0}).status_code, 422)
+        self.assertEqual(self.client.get("/items", params={"limit": 1001}).status_code, 422)
@@ -0,0 +1,149 @@
+import unittest
+from typing import Optional
+from unittest import mock
+
+import sqlalchemy
+
+from app import main, replicas
+from app.cache import install_invalidation_hooks, LRUCache
+from app.replicas import Replica, ReplicaRouter
+
+
+class FakeResult:
+    def __init__(self, row: Optional[dict]) -> None:
+        self.row = row
+
+    def mappings(self) -> "FakeResult":
+        return self
+
+    def first(self) -> Optional[dict]:
+        return self.row
+
+
+class FakeConnection:
+    """Answers the replication status statements in rows and rejects the rest as a syntax error."""
+
+    def __init__(self, rows: dict[str, Optional[dict]]) -> None:
+        self.rows = rows
+        self.statements: list[str] = []
+
+    def execute(self, statement: sqlalchemy.TextClause) -> FakeResult:
+        self.statements.append(statement.text)
+        if statement.text not in self.rows:
+            raise sqlalchemy.exc.ProgrammingError(statement.text, {}, Exception(1064, "You have an error in your SQL"))
+        return FakeResult(self.rows[statement.text])
+
+
+class ReplicationLagTest(unittest.TestCase):
+    def test_mysql_8_reports_seconds_behind_source(self):
+        conn = FakeConnection({"SHOW REPLICA STATUS": {"Seconds_Behind_Source": 3}})
+        self.assertEqual(replicas._replication_lag(conn), 3.0)
+        self.assertEqual(conn.statements, ["SHOW REPLICA STATUS"])
+
+    def test_older_servers_fall_back_to_slave_status(self):
+        conn = FakeConnection({"SHOW SLAVE STATUS": {"Seconds_Behind_Master": 7}})
+        self.assertEqual(replicas._replication_lag(conn), 7.0)
+        self.assertEqual(conn.statements, ["SHOW REPLICA STATUS", "SHOW SLAVE STATUS"])
+
+    def test_not_replicating(self):
+        self.assertIsNone(replicas._replication_lag(FakeConnection({"SHOW REPLICA STATUS": None})))
+        # Seconds_Behind_Source is NULL while the replication threads are stopped.
+        conn = FakeConnection({"SHOW REPLICA STATUS": {"Seconds_Behind_Source": None}})
+        self.assertIsNone(replicas._replication_lag(conn))
+
+
+def sqlite_engine() -> sqlalchemy.engine.base.Engine:
+    return sqlalchemy.create_engine(
+        "sqlite://", poolclass=sqlalchemy.pool.StaticPool, connect_args={"check_same_thread": False}
+    )
+
+
+class ReplicaRouterTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.primary = sqlite_engine()
+        # QueuePool, so checked-out connections are counted per connect().
+        self.replicas = [
+            Replica(name, sqlalchemy.create_engine("sqlite://", poolclass=sqlalchemy.pool.QueuePool))
+            for name in ("a", "b", "c")
+        ]
+
+    def tearDown(self):
+        for engine in [self.primary, *(replica.engine for replica in self.replicas)]:
+            engine.dispose()
+
+    def set_lags(self, *lags: Optional[float]) -> None:
+        for replica, lag in zip(self.replicas, lags):
+            replica.lag = lag
+
+    def test_round_robin_skips_lagging_and_unknown_replicas(self):
+        router = ReplicaRouter(self.primary, self.replicas, max_lag=10)
+        self.set_lags(1, 30, None)
+        self.assertEqual([router.choose()[0] for _ in range(3)], ["a", "a", "a"])
+        self.set_lags(1, 10, None)
+        self.assertEqual(sorted(router.choose()[0] for _ in range(4)), ["a", "a", "b", "b"])
+
+    def test_falls_back_to_primary_when_every_replica_lags(self):
+        for strategy in ("round_robin", "least_connections"):
+            with self.subTest(strategy=strategy):
+                router = ReplicaRouter(self.primary, self.replicas, strategy=strategy, max_lag=10)
+                self.set_lags(11, None, 60)
+                self.assertEqual(router.choose(), ("primary", self.primary))
+
+    def test_least_connections_picks_the_idlest_healthy_replica(self):
+        router = ReplicaRouter(self.primary, self.replicas, strategy="least_connections", max_lag=10)
+        self.set_lags(0, 0, 30)
+        with self.replicas[0].engine.connect():
+            self.assertEqual(router.choose()[0], "b")
+            with self.replicas[1].engine.connect(), self.replicas[1].engine.connect():
+                self.assertEqual(router.choose()[0], "a")
+
+    async def test_check_lag_marks_failed_checks_unknown(self):
+        router = ReplicaRouter(self.primary, self.replicas[:2])
+        with mock.patch.object(replicas, "_check_lag_sync", side_effect=[2.0, RuntimeError("denied")]):
+            with self.assertLogs(replicas.logger, "ERROR"):
+                await router.check_lag()
+        self.assertEqual([replica.lag for replica in router.replicas], [2.0, None])
+
+
+class ReadYourWritesTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.primary = sqlite_engine()
+        self.replica = sqlite_engine()
+        for engine in (self.primary, self.replica):
+            with engine.begin() as conn:
+                conn.execute(sqlalchemy.text("CREATE TABLE users (id INTEGER PRIMARY KEY, position TEXT)"))
+                conn.execute(sqlalchemy.text("INSERT INTO users (id, position) VALUES (1, 'old')"))
+        self.cache = LRUCache()
+        self.cache.write_window = 10
+        install_invalidation_hooks(self.primary, self.cache)
+        router = ReplicaRouter(self.primary, [Replica("replica", self.replica)], max_lag=10)
+        router.replicas[0].lag = 0
+        patches = [mock.patch.object(main, "router", router), mock.patch.object(main, "query_cache", self.cache)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.primary.dispose()
+        self.replica.dispose()
+
+    async def read(self) -> list[tuple]:
+        return await main.fetch_all("SELECT id, position FROM users WHERE id = :id", {"id": 1})
+
+    def write(self) -> None:
+        # The replica has not applied this yet.
+        with self.primary.begin() as conn:
+            conn.execute(sqlalchemy.text("UPDATE users SET position = 'new' WHERE id = 1"))
+
+    async def test_reads_after_a_write_go_to_the_primary(self):
+        self.assertEqual(await self.read(), [(1, "old")])
+        self.write()
+        self.assertEqual(await self.read(), [(1, "new")])
+        # Served from the cache, which the primary's result was stored in.
+        self.assertEqual(await self.read(), [(1, "new")])
+        self.assertEqual(self.cache.hits, 1)
+
+    async def test_reads_go_back_to_replicas_once_the_write_window_passes(self):
+        self.write()
+        self.cache.write_window = 0
+        self.assertEqual(await self.read(), [(1, "old")])
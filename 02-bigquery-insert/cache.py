@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+
+
+class ResponseCache:
+    """
+    related_queries() の結果をディスクに保存するキャッシュ
+
+    キーは (キーワードのシャード, timeframe, 取得時刻の 1 時間単位のバケット)。ジョブが途中で失敗しても、
+    同じ時間帯のリトライでは Google トレンドへ問い合わせずに前回の結果と取得時刻を再利用する。
+    Cloud Run ジョブのタスク間で共有するには directory に Cloud Storage ボリュームなどをマウントする。
+    """
+
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, keywords, timeframe, now):
+        bucket = now.strftime("%Y%m%d%H")
+        key = json.dumps([list(keywords), timeframe, bucket], ensure_ascii=False)
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".pickle")
+
+    def get(self, keywords, timeframe, now):
+        """キャッシュがあれば (取得時刻, related_queries) を返す"""
+        path = self._path(keywords, timeframe, now)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def set(self, keywords, timeframe, now, related_queries):
+        # 途中で落ちても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((now, related_queries), f)
+            os.replace(tmp, self._path(keywords, timeframe, now))
+        except BaseException:
+            os.remove(tmp)
+            raise
@@ -0,0 +1,147 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from pytrends.exceptions import TooManyRequestsError
+from pytrends.request import TrendReq
+
+# Google トレンドは 1 回のペイロードに 5 キーワードまでしか受け付けない
+MAX_KEYWORDS_PER_PAYLOAD = 5
+
+
+class TokenBucket:
+    """スレッド間で共有するトークンバケット。rate 件/秒、最大 capacity 件までまとめて送れる"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def shard(keywords, size=MAX_KEYWORDS_PER_PAYLOAD):
+    return [keywords[i:i + size] for i in range(0, len(keywords), size)]
+
+
+class TrendsFetcher:
+    """キーワードをシャードに分けてスレッドプールで並行に related_queries() を取得する"""
+
+    def __init__(self, bucket, workers=4, max_retries=5, backoff=2.0, hl='ja-JP', tz=360, cache=None):
+        self.bucket = bucket
+        self.cache = cache
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.hl = hl
+        self.tz = tz
+        # TrendReq はペイロードを内部に持つのでスレッドごとに作る
+        self._local = threading.local()
+
+    def _pytrends(self):
+        if not hasattr(self._local, "pytrends"):
+            # TrendReq の初期化でも Cookie 取得のリクエストが 1 回飛ぶ
+            self.bucket.acquire()
+            self._local.pytrends = TrendReq(hl=self.hl, tz=self.tz)
+        return self._local.pytrends
+
+    def fetch_shard(self, keywords, timeframe):
+        for attempt in range(self.max_retries + 1):
+            try:
+                pytrends = self._pytrends()
+                self.bucket.acquire()
+                pytrends.build_payload(keywords, timeframe=timeframe)
+                # related_queries() はキーワードごとに 1 リクエスト送る
+                self.bucket.acquire(len(keywords))
+                return pytrends.related_queries()
+            except TooManyRequestsError:
+                if attempt == self.max_retries:
+                    raise
+                # 指数バックオフ (ジッター付き)
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def fetch_cached(self, keywords, timeframe, now):
+        """キャッシュがあればそれを、なければ取得して (取得時刻, related_queries) を返す"""
+        if self.cache is not None:
+            cached = self.cache.get(keywords, timeframe, now)
+            if cached is not None:
+                return cached
+        related_queries = self.fetch_shard(keywords, timeframe)
+        if self.cache is not None:
+            self.cache.set(keywords, timeframe, now, related_queries)
+        return now, related_queries
+
+    def fetch(self, keywords, timeframe, now):
+        """
+        シャードが取得できた順に (shard, 取得時刻, related_queries) を返す。失敗したシャードは例外を返す
+
+        キャッシュから返したシャードの取得時刻は、前回取得したときの now になる
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch_cached, s, timeframe, now): s for s in shard(keywords)}
+            for future in as_completed(futures):
+                try:
+                    fetched_at, related_queries = future.result()
+                    yield futures[future], fetched_at, related_queries
+                except Exception as e:
+                    yield futures[future], now, e
+
+
+def load_fixture(path):
+    """save_fixture() で記録した related_queries() の結果を読み込む"""
+    with open(path, encoding="utf-8") as f:
+        recorded = json.load(f)
+    return {
+        keyword: {
+            query_type: None if records is None else pd.DataFrame(records, columns=["query", "value"])
+            for query_type, records in data.items()
+        }
+        for keyword, data in recorded.items()
+    }
+
+
+def save_fixture(path, related_queries):
+    """related_queries() の結果を JSON で記録する。既存のファイルがあればキーワード単位でマージする"""
+    recorded = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            recorded = json.load(f)
+    for keyword, data in related_queries.items():
+        recorded[keyword] = {
+            query_type: None if df is None else df[["query", "value"]].to_dict(orient="records")
+            for query_type, df in data.items()
+        }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(recorded, f, ensure_ascii=False, indent=2)
+
+
+class FixtureFetcher:
+    """Google トレンドへ問い合わせずに、記録済みの結果を TrendsFetcher.fetch() と同じ形で返す"""
+
+    def __init__(self, related_queries):
+        self.related_queries = related_queries
+
+    def fetch(self, keywords, timeframe, now):
+        for keyword_shard in shard(keywords):
+            missing = [keyword for keyword in keyword_shard if keyword not in self.related_queries]
+            if missing:
+                yield keyword_shard, now, KeyError("No recorded related queries for {}".format(missing))
+                continue
+            yield keyword_shard, now, {keyword: self.related_queries[keyword] for keyword in keyword_shard}
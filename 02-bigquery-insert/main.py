@@ -1,78 +1,161 @@
+import argparse
 import os, pytz
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 
-from pytrends.request import TrendReq
-from google.cloud import bigquery
+import pandas as pd
 from datetime import datetime
 
-# pytrendsを初期化
-pytrends = TrendReq(hl='ja-JP', tz=360)
+from cache import ResponseCache
+from fetch import FixtureFetcher, TokenBucket, TrendsFetcher, load_fixture, save_fixture
+from sinks import DTYPES, FakeSink, init_sink, row_message_class, serialize_rows
 
-# トレンドを取得したいキーワードを設定
-keywords = os.getenv("KEYWORDS", "Google").split(",")
+# --dry-run で使う、記録済みの related_queries() の結果
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata", "related_queries.json")
 
-# Googleトレンドデータを取得
-pytrends.build_payload(keywords, timeframe='now 7-d')
 
-# 関連クエリを取得
-related_queries = pytrends.related_queries()
+def to_dataframe(related_queries, now):
+    """related_queries() の結果を keyword, type, query, value, datetime の 1 つの DataFrame にまとめる"""
+    # top / rising の DataFrame を (keyword, type) をキーにして一度に連結する
+    frames = {
+        (keyword, query_type): data[query_type]
+        for keyword, data in related_queries.items()
+        for query_type in ("top", "rising")
+        if data.get(query_type) is not None
+    }
+    if not frames:
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in DTYPES.items()})
 
-# BigQuery へ insert
-#-------------------------
-client = bigquery.Client()
-project_id = os.environ.get("PROJECT_ID")
-dataset = os.environ.get("DATASET")
-table = os.environ.get("TABLE")
-table_id = '{}.{}.{}'.format(project_id, dataset, table)
+    df = pd.concat(frames, names=["keyword", "type", None])[["query", "value"]]
+    df = df.reset_index(level=["keyword", "type"]).reset_index(drop=True)
+    df["datetime"] = pd.Timestamp(now)
+    return df[list(DTYPES)].astype(DTYPES)
 
-now = datetime.now(pytz.timezone("Asia/Tokyo")).strftime("%Y-%m-%dT%H:%M:%S")
-#now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ") # TIMESTAMP 型の場合
-rows_to_insert = []
 
-for keyword, data in related_queries.items():
-    result_dict = {
-        "keyword": keyword,
-        "top": [],
-        "rising": []
-    }
+class Timings:
+    """ステージごとの経過時間を積算する"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - started
+
+    def report(self):
+        return "\n".join("{:<10} {:8.3f}s".format(name, seconds) for name, seconds in self.seconds.items())
+
+
+def init_fetcher():
+    # 5 キーワードずつのシャードに分け、レート制限をかけながら並行に取得する
+    return TrendsFetcher(
+        TokenBucket(rate=float(os.getenv("TRENDS_RATE", 1.0)), capacity=int(os.getenv("TRENDS_BURST", 5))),
+        workers=int(os.getenv("TRENDS_WORKERS", 4)),
+        max_retries=int(os.getenv("TRENDS_MAX_RETRIES", 5)),
+        # 取得結果をディスクにキャッシュし、同じ時間帯のリトライでは再取得しない
+        cache=ResponseCache(
+            os.getenv("TRENDS_CACHE_DIR", "/tmp/trends-cache"),
+            ttl=int(os.getenv("TRENDS_CACHE_TTL", 3600)),
+        ),
+    )
+
+
+def run(fetcher, writer, keywords, timeframe, now, timings, record=None, serialize=False):
+    """取得・変換・書き込みを行い、取得に失敗したシャードのリストを返す"""
+    row_class = row_message_class()[1] if serialize else None
+    failed = []
+    results = fetcher.fetch(keywords, timeframe=timeframe, now=now)
+    # シャードの取得が終わるたびに変換して writer へ流す
+    # キャッシュから返したシャードは前回の取得時刻で記録するので、既に書き込んだ行は dedupe() で除かれる
+    while True:
+        with timings.stage("fetch"):
+            item = next(results, None)
+        if item is None:
+            break
+        keyword_shard, fetched_at, related_queries = item
+        if isinstance(related_queries, Exception):
+            print("Failed to fetch {}: {}".format(keyword_shard, related_queries))
+            failed.append(keyword_shard)
+            continue
+        if record:
+            save_fixture(record, related_queries)
+        with timings.stage("transform"):
+            df = writer.dedupe(to_dataframe(related_queries, fetched_at))
+        if row_class is not None:
+            # Storage Write API に送るときと同じ protobuf へのシリアライズにかかる時間を測る
+            with timings.stage("serialize"):
+                for _ in serialize_rows(df, row_class):
+                    pass
+        with timings.stage("load"):
+            writer.write(df)
+    with timings.stage("load"):
+        writer.close()
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Google トレンドの関連キーワードを BigQuery に書き込む")
+    parser.add_argument("--keywords", default=os.getenv("KEYWORDS", "Google"), help="カンマ区切りのキーワード")
+    parser.add_argument("--timeframe", default="now 7-d")
+    parser.add_argument(
+        "--sink",
+        default=os.getenv("SINK", "load"),
+        choices=["load", "storage_write", "fake"],
+        help="load (ロードジョブ) / storage_write (Storage Write API) / fake (書き込まない)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Google トレンドにも BigQuery にも接続せず、--fixture の記録済みデータで各ステージの時間を測る",
+    )
+    parser.add_argument("--fixture", default=DEFAULT_FIXTURE, help="--dry-run で使う記録済みの related_queries()")
+    parser.add_argument("--record", help="取得した related_queries() をこのファイルに記録する")
+    parser.add_argument("--output", help="--dry-run で書き込むはずだった行を NDJSON で書き出す")
+    args = parser.parse_args(argv)
+
+    keywords = args.keywords.split(",")
+    # DATETIME 型 (タイムゾーンなし) として日本時間で記録する
+    now = datetime.now(pytz.timezone("Asia/Tokyo")).replace(tzinfo=None, microsecond=0)
+    timings = Timings()
+
+    if args.dry_run:
+        fetcher = FixtureFetcher(load_fixture(args.fixture))
+        writer = FakeSink(args.output)
+    else:
+        fetcher = init_fetcher()
+        # BigQuery へ load
+        #-------------------------
+        writer = init_sink(
+            args.sink,
+            os.environ.get("PROJECT_ID"),
+            os.environ.get("DATASET"),
+            os.environ.get("TABLE"),
+            flush_rows=int(os.getenv("FLUSH_ROWS", 50000)),
+        )
+
+    try:
+        failed = run(fetcher, writer, keywords, args.timeframe, now, timings, args.record, serialize=args.dry_run)
+    except Exception as e:
+        print(e)
+        return 1
+    if args.dry_run:
+        print("{} rows would have been added to BigQuery.".format(writer.rows))
+        print(timings.report())
+    else:
+        print("{} new rows have been added to BigQuery.".format(writer.rows))
+    if writer.rejected_rows:
+        # 拒否された行は書き込まれていないので、失敗として終了する
+        print("{} rows were rejected by BigQuery:".format(len(writer.rejected_rows)))
+        for _, message in writer.rejected_rows[:5]:
+            print("  {}".format(message))
+    return 1 if failed or writer.rejected_rows else 0
+
 
-    top_data = data['top'].to_dict()
-    rising_data = data['rising'].to_dict()
-
-    # Top queries (key = query or value)
-    tmp_array = {}
-    for key, values in top_data.items():
-        for i, val in values.items():
-            tmp_array.setdefault(i, {"type": "top"})
-            tmp_array[i].update({key: val})
-
-    for _, d in tmp_array.items():
-        rows_to_insert.append({
-            "keyword": keyword,
-            "type": d["type"],
-            "query": d["query"],
-            "value": d["value"],
-            "datetime": now
-        })
-
-    # Rising queries (key = query or value)
-    tmp_array = {}
-    for key, values in rising_data.items():
-        for i, val in values.items():
-            tmp_array.setdefault(i, {"type": "rising"})
-            tmp_array[i].update({key: val})
-
-    for _, d in tmp_array.items():
-        rows_to_insert.append({
-            "keyword": keyword,
-            "type": d["type"],
-            "query": d["query"],
-            "value": d["value"],
-            "datetime": now
-        })
-
-errors = client.insert_rows_json(table_id, rows_to_insert)
-if errors == []:
-    print("New rows have been added to BigQuery. {}".format(rows_to_insert))
-else:
-    print(errors)
-    exit(1)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
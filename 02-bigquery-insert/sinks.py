@@ -0,0 +1,326 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import pandas as pd
+from google.api_core import exceptions
+from google.cloud import bigquery
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+# BigQuery テーブルのスキーマ
+SCHEMA = [
+    bigquery.SchemaField("keyword", "STRING"),
+    bigquery.SchemaField("type", "STRING"),
+    bigquery.SchemaField("query", "STRING"),
+    bigquery.SchemaField("value", "INTEGER"),
+    bigquery.SchemaField("datetime", "DATETIME"),
+]
+# SCHEMA に対応する pandas の型
+DTYPES = {"keyword": "string", "type": "string", "query": "string", "value": "Int64", "datetime": "datetime64[ns]"}
+
+
+def row_keys(df):
+    """(keyword, type, query, datetime) から決まる行のキー。再実行しても同じ行には同じキーが付く"""
+    parts = df["keyword"].astype(str) + "\x1f" + df["type"].astype(str) + "\x1f" + df["query"].astype(str)
+    parts = parts + "\x1f" + df["datetime"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    return parts.map(lambda part: hashlib.sha256(part.encode("utf-8")).hexdigest())
+
+
+class Sink:
+    """
+    変換済みの DataFrame の書き込み先。write() を何度か呼んだあと close() する
+
+    dedupe() を通した行は、この実行で書いた行とテーブルに既にある行を除くので、リトライしても二重に書き込まれない
+    """
+
+    def __init__(self):
+        self.rows = 0
+        # 書き込み先に拒否された (行, エラーメッセージ)
+        self.rejected_rows = []
+        self._seen = set()
+        self._checked = set()
+
+    def existing_rows(self, datetimes):
+        """datetime が datetimes のいずれかに一致する、書き込み先に既にある行を DataFrame で返す"""
+        return None
+
+    def dedupe(self, df):
+        unchecked = set(df["datetime"].dropna().unique()) - self._checked
+        if unchecked:
+            existing = self.existing_rows(sorted(unchecked))
+            if existing is not None and len(existing):
+                self._seen.update(row_keys(existing))
+            self._checked.update(unchecked)
+        keys = row_keys(df)
+        # 同じ DataFrame 内の重複も除く
+        df = df[~keys.isin(self._seen) & ~keys.duplicated()]
+        self._seen.update(keys[df.index])
+        return df
+
+    def write(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def query_existing_rows(client, table_id, datetimes):
+    """テーブルから datetime が一致する行を取得する。テーブルがまだなければ None を返す"""
+    values = [pd.Timestamp(dt).to_pydatetime() for dt in datetimes]
+    parameter = bigquery.ArrayQueryParameter("datetimes", "DATETIME", values)
+    job_config = bigquery.QueryJobConfig(query_parameters=[parameter])
+    query = "SELECT keyword, type, query, datetime FROM `{}` WHERE datetime IN UNNEST(@datetimes)".format(table_id)
+    try:
+        return client.query(query, job_config=job_config).to_dataframe().astype(
+            {"keyword": "string", "type": "string", "query": "string", "datetime": "datetime64[ns]"}
+        )
+    except exceptions.NotFound:
+        return None
+
+
+class LoadJobSink(Sink):
+    """DataFrame をバッファし、flush_rows 行たまったらロードジョブで書き込む"""
+
+    def __init__(self, client, table_id, flush_rows=50000):
+        super().__init__()
+        self.client = client
+        self.table_id = table_id
+        self.flush_rows = flush_rows
+        self._frames = []
+        self._buffered = 0
+
+    def existing_rows(self, datetimes):
+        return query_existing_rows(self.client, self.table_id, datetimes)
+
+    def write(self, df):
+        self._frames.append(df)
+        self._buffered += len(df)
+        if self._buffered >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._buffered:
+            return
+        df = pd.concat(self._frames, ignore_index=True)
+        # Arrow (Parquet) 形式のロードジョブで書き込む。ストリーミング挿入と違って料金がかからない
+        job_config = bigquery.LoadJobConfig(schema=SCHEMA, write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        self.client.load_table_from_dataframe(df, self.table_id, job_config=job_config).result()
+        self.rows += len(df)
+        self._frames = []
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+def row_message_class():
+    """SCHEMA に対応する protobuf メッセージを動的に作る。NULL を送れるよう proto2 の optional にする"""
+    field_types = {
+        "STRING": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+        "INTEGER": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+        # DATETIME は "YYYY-MM-DD HH:MM:SS" 形式の文字列で送れる
+        "DATETIME": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+    }
+    file_proto = descriptor_pb2.FileDescriptorProto(name="trends_row.proto", package="trends", syntax="proto2")
+    message_proto = file_proto.message_type.add(name="TrendsRow")
+    for number, field in enumerate(SCHEMA, start=1):
+        message_proto.field.add(
+            name=field.name,
+            number=number,
+            type=field_types[field.field_type],
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+        )
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    descriptor = pool.FindMessageTypeByName("trends.TrendsRow")
+    return descriptor, message_factory.GetMessageClass(descriptor)
+
+
+def serialize_rows(df, row_class):
+    """DataFrame の各行を row_class (row_message_class() で作ったメッセージ) にシリアライズする"""
+    for keyword, query_type, query, value, dt in df[list(DTYPES)].itertuples(index=False):
+        row = row_class(keyword=keyword, type=query_type, query=query)
+        if not pd.isna(value):
+            row.value = int(value)
+        if not pd.isna(dt):
+            row.datetime = dt.strftime("%Y-%m-%d %H:%M:%S")
+        yield row.SerializeToString()
+
+
+class StorageWriteSink(Sink):
+    """
+    Storage Write API の default stream に protobuf で書き込む
+
+    行はシリアライズ後のサイズで chunk_bytes ごとのリクエストにまとめ、最大 max_in_flight 件を
+    同時に送る。default stream では失敗したリクエストの行は書き込まれないので、そのリクエストだけ
+    (不正な行があればそれを除いて) 送り直す。ストリームが閉じたときは送信中のリクエストもすべて
+    失敗するので、一度だけ開き直して失敗したリクエストと送信中のリクエストを順に送り直す。
+    """
+
+    def __init__(self, project_id, dataset, table, chunk_bytes=8 * 1024 * 1024, max_in_flight=4, max_retries=5):
+        from google.cloud import bigquery_storage_v1
+
+        super().__init__()
+        self.write_client = bigquery_storage_v1.BigQueryWriteClient()
+        self.table_id = "{}.{}.{}".format(project_id, dataset, table)
+        self._client = None
+        self.stream_name = "{}/streams/_default".format(self.write_client.table_path(project_id, dataset, table))
+        self.chunk_bytes = chunk_bytes
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self._descriptor, self._row_class = row_message_class()
+        self._append_stream = None
+        self._stream_closed = threading.Event()
+        self._in_flight = deque()
+        self._chunk = []
+        self._chunk_size = 0
+
+    def _open_stream(self):
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        proto_descriptor = descriptor_pb2.DescriptorProto()
+        self._descriptor.CopyToProto(proto_descriptor)
+        template = types.AppendRowsRequest(
+            write_stream=self.stream_name,
+            proto_rows=types.AppendRowsRequest.ProtoData(
+                writer_schema=types.ProtoSchema(proto_descriptor=proto_descriptor),
+            ),
+        )
+        stream = writer.AppendRowsStream(self.write_client, template)
+        # サーバー側の切断などで閉じたことを知るため。コールバックは送信中の future がすべて失敗したあとに呼ばれる
+        closed = threading.Event()
+        stream.add_close_callback(lambda manager, reason: closed.set())
+        self._stream_closed = closed
+        return stream
+
+    def existing_rows(self, datetimes):
+        if self._client is None:
+            self._client = bigquery.Client()
+        return query_existing_rows(self._client, self.table_id, datetimes)
+
+    def write(self, df):
+        for row in serialize_rows(df, self._row_class):
+            if self._chunk and self._chunk_size + len(row) > self.chunk_bytes:
+                self._send(self._chunk)
+                self._chunk = []
+                self._chunk_size = 0
+            self._chunk.append(row)
+            self._chunk_size += len(row)
+
+    def _send(self, rows, attempt=0):
+        from google.cloud.bigquery_storage_v1 import exceptions as bqstorage_exceptions, types
+
+        # 送信中のリクエストが上限に達したら、一番古いものの完了を待つ
+        while len(self._in_flight) >= self.max_in_flight:
+            self._wait_oldest()
+        if self._append_stream is None:
+            self._append_stream = self._open_stream()
+        request = types.AppendRowsRequest(
+            proto_rows=types.AppendRowsRequest.ProtoData(rows=types.ProtoRows(serialized_rows=rows)),
+        )
+        try:
+            future = self._append_stream.send(request)
+        except bqstorage_exceptions.StreamClosedError as e:
+            # 送る直前にストリームが閉じた。失敗したリクエストとして _wait_oldest() で送り直す
+            future = Future()
+            future.set_exception(e)
+        self._in_flight.append((future, rows, attempt))
+
+    def _wait_oldest(self):
+        future, rows, attempt = self._in_flight.popleft()
+        try:
+            future.result()
+            self.rows += len(rows)
+            return
+        except exceptions.GoogleAPICallError as e:
+            row_errors = getattr(e.response, "row_errors", None)
+            if row_errors:
+                # 不正な行だけを除いて送り直す
+                bad = {error.index for error in row_errors}
+                self.rejected_rows.extend((rows[error.index], error.message) for error in row_errors)
+                rows = [row for i, row in enumerate(rows) if i not in bad]
+                if rows:
+                    self._send(rows, attempt)
+                return
+            error = e
+        except Exception as e:
+            error = e
+
+        if attempt >= self.max_retries:
+            raise error
+        time.sleep(2 ** attempt * random.uniform(0.5, 1.5))
+        if not self._stream_closed.is_set():
+            # ストリームは生きているので、このリクエストだけ送り直す
+            self._send(rows, attempt + 1)
+            return
+
+        # ストリームが閉じると送信中のリクエストもすべて失敗している (閉じる前に完了したものは除く)。
+        # 開き直して、失敗したリクエストと送信中だったリクエストを元の順に送り直す
+        pending = [(rows, attempt + 1)]
+        while self._in_flight:
+            future, rows, attempt = self._in_flight.popleft()
+            if future.done() and future.exception() is None:
+                self.rows += len(rows)
+            else:
+                pending.append((rows, attempt))
+        self._reset_stream()
+        for rows, attempt in pending:
+            self._send(rows, attempt)
+
+    def _reset_stream(self):
+        if self._append_stream is not None:
+            try:
+                self._append_stream.close()
+            except Exception as e:
+                print("Failed to close the append stream: {}".format(e))
+            self._append_stream = None
+
+    def close(self):
+        if self._chunk:
+            self._send(self._chunk)
+            self._chunk = []
+            self._chunk_size = 0
+        while self._in_flight:
+            self._wait_oldest()
+        self._reset_stream()
+
+
+class FakeSink(Sink):
+    """GCP に接続せずに書き込まれた行を保持するシンク。path を指定すると NDJSON でも書き出す"""
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+        self.frames = []
+
+    def existing_rows(self, datetimes):
+        if not self.frames:
+            return None
+        df = pd.concat(self.frames, ignore_index=True)
+        return df[df["datetime"].isin(datetimes)]
+
+    def write(self, df):
+        self.frames.append(df)
+        self.rows += len(df)
+
+    def close(self):
+        if self.path is None or not self.frames:
+            return
+        df = pd.concat(self.frames, ignore_index=True)
+        with open(self.path, "w") as f:
+            for record in df.to_dict(orient="records"):
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+
+def init_sink(sink, project_id, dataset, table, flush_rows=50000):
+    if sink == "load":
+        return LoadJobSink(bigquery.Client(), "{}.{}.{}".format(project_id, dataset, table), flush_rows=flush_rows)
+    if sink == "storage_write":
+        return StorageWriteSink(project_id, dataset, table)
+    if sink == "fake":
+        return FakeSink()
+    raise ValueError("Unknown SINK '{}'. Please use one of load, storage_write or fake".format(sink))
@@ -0,0 +1,93 @@
+import io
+import unittest
+from concurrent.futures import Future
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+from unittest import mock
+
+from google.api_core import exceptions
+
+import main
+import sinks
+
+
+class FakeAppendStream:
+    """AppendRowsStream の代わり。送られた行を記録し、outcomes の順に結果を返す"""
+
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+        self.sent = []
+
+    def add_close_callback(self, callback):
+        pass
+
+    def send(self, request):
+        rows = list(request.proto_rows.rows.serialized_rows)
+        self.sent.append(rows)
+        future = Future()
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if outcome is None:
+            future.set_result(None)
+        else:
+            future.set_exception(outcome)
+        return future
+
+    def close(self):
+        pass
+
+
+def row_errors(*errors):
+    response = SimpleNamespace(row_errors=[SimpleNamespace(index=index, message=message) for index, message in errors])
+    return exceptions.InvalidArgument("Rows are invalid", response=response)
+
+
+class StorageWriteSinkTest(unittest.TestCase):
+    def create_sink(self, outcomes):
+        with mock.patch("google.cloud.bigquery_storage_v1.BigQueryWriteClient"):
+            sink = sinks.StorageWriteSink("project", "dataset", "table", max_retries=0)
+        stream = FakeAppendStream(outcomes)
+        sink._open_stream = lambda: stream
+        return sink, stream
+
+    def test_rejected_rows_are_kept_and_the_rest_resent(self):
+        sink, stream = self.create_sink([row_errors((1, "invalid value"))])
+        sink._send([b"a", b"b", b"c"])
+        sink.close()
+        self.assertEqual(stream.sent, [[b"a", b"b", b"c"], [b"a", b"c"]])
+        self.assertEqual(sink.rows, 2)
+        self.assertEqual(sink.rejected_rows, [(b"b", "invalid value")])
+
+    def test_all_rows_rejected_are_not_resent(self):
+        sink, stream = self.create_sink([row_errors((0, "bad"), (1, "worse"))])
+        sink._send([b"a", b"b"])
+        sink.close()
+        self.assertEqual(len(stream.sent), 1)
+        self.assertEqual(sink.rows, 0)
+        self.assertEqual([message for _, message in sink.rejected_rows], ["bad", "worse"])
+
+
+class RejectingSink(sinks.FakeSink):
+    def close(self):
+        super().close()
+        self.rejected_rows = [(b"row", "error {}".format(i)) for i in range(7)]
+
+
+class MainTest(unittest.TestCase):
+    def run_main(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            code = main.main(["--dry-run"])
+        return code, output.getvalue()
+
+    def test_dry_run_succeeds(self):
+        code, output = self.run_main()
+        self.assertEqual(code, 0)
+        self.assertNotIn("rejected", output)
+
+    def test_rejected_rows_fail_the_run(self):
+        with mock.patch.object(main, "FakeSink", RejectingSink):
+            code, output = self.run_main()
+        self.assertEqual(code, 1)
+        self.assertIn("7 rows were rejected by BigQuery:", output)
+        self.assertIn("error 4", output)
+        self.assertNotIn("error 5", output)
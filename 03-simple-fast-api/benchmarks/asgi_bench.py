@@ -0,0 +1,280 @@
+"""
+ASGI アプリをネットワークを通さずに呼び出す負荷生成・レイテンシ計測ツール
+
+ルートごとに指定した並行数でリクエストを送り、p50 / p99 レイテンシ、req/s、
+1 リクエストあたりのピークメモリ割り当て量 (tracemalloc) を出す。--baseline を指定すると
+結果を比較し、--tolerance (p99 は --p99-tolerance) を超えて悪化したら終了コード 1 で終わるので CI で使える。
+各指標は --repeat 回計測した中央値で比べ、悪化したルートは --retries 回まで測り直してから判定する。
+アプリのレスポンスキャッシュは RESPONSE_CACHE_MAX_ENTRIES=0 で無効にして計測する
+(キャッシュのヒットではなくルートの処理を測るため。環境変数で上書きできる)。
+
+    python -m benchmarks.asgi_bench --route "GET /" --route "POST /" --concurrency 16 \\
+        --baseline benchmarks/baseline.json
+
+他の FastAPI アプリにも --app と --app-dir で使える:
+
+    python -m benchmarks.asgi_bench --app-dir ../04-langchain-new-app --app app.server:app --route "GET /docs"
+
+call() と percentile() は標準ライブラリだけで書いてあり、04-langchain-new-app の
+benchmarks/latency_bench.py もこのファイルを import して使う。
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+
+
+def load_app(spec: str, app_dir: Optional[str] = None) -> Any:
+    if app_dir:
+        sys.path.insert(0, app_dir)
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr or "app")
+
+
+def parse_route(spec: str) -> tuple[str, str]:
+    method, _, path = spec.partition(" ")
+    return method.upper(), path or "/"
+
+
+async def call(
+    app,
+    method: str,
+    path: str,
+    body: bytes = b"",
+    headers: Optional[list] = None,
+    on_body: Optional[Callable[[bytes], None]] = None,
+) -> tuple[int, bytes]:
+    """
+    ASGI アプリを 1 回呼び、ステータスコードとレスポンスボディを返す。
+    on_body を渡すとボディのチャンクを受け取るたびに呼ぶ (ストリーミングの計測用)
+    """
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [
+            (b"host", b"bench"),
+            (b"content-length", str(len(body)).encode()),
+            (b"content-type", b"application/json"),
+            *(headers or []),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    status = 0
+    chunks = []
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            # レスポンスを返し終えるまで切断を通知しない
+            await asyncio.Event().wait()
+        request_sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(event):
+        nonlocal status
+        if event["type"] == "http.response.start":
+            status = event["status"]
+        elif event["type"] == "http.response.body":
+            chunks.append(event.get("body", b""))
+            if on_body is not None:
+                on_body(chunks[-1])
+
+    await app(scope, receive, send)
+    return status, b"".join(chunks)
+
+
+class Lifespan:
+    """ASGI の lifespan プロトコルで startup / shutdown を実行する"""
+
+    def __init__(self, app) -> None:
+        self.app = app
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.replies: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        try:
+            scope = {"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}
+            await self.app(scope, self.events.get, self.replies.put)
+        except Exception:
+            # lifespan に対応していないアプリ
+            await self.replies.put({"type": "lifespan.unsupported"})
+
+    async def __aenter__(self) -> "Lifespan":
+        self.task = asyncio.create_task(self._run())
+        await self.events.put({"type": "lifespan.startup"})
+        reply = await self.replies.get()
+        if reply["type"] == "lifespan.startup.failed":
+            raise RuntimeError(reply.get("message", "lifespan startup failed"))
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if not self.task.done():
+            await self.events.put({"type": "lifespan.shutdown"})
+            await self.replies.get()
+        await self.task
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+async def bench_route(app, method: str, path: str, body: bytes, concurrency: int, requests: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for _ in iter(lambda: next(remaining, None), None):
+            started = time.perf_counter()
+            status, _ = await call(app, method, path, body)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors += 1
+
+    # ウォームアップ
+    for _ in range(min(requests, 200)):
+        await call(app, method, path, body)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / seconds, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "peak_alloc_bytes": await peak_alloc_per_request(app, method, path, body, min(requests, 200)),
+    }
+
+
+async def peak_alloc_per_request(app, method: str, path: str, body: bytes, samples: int) -> int:
+    """1 リクエストを処理する間に tracemalloc で観測したメモリ割り当てのピーク (中央値)"""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await call(app, method, path, body)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+    finally:
+        tracemalloc.stop()
+    return int(percentile(peaks, 50))
+
+
+# 悪化と判定する向き。rps は下がると、それ以外は上がると悪化
+_HIGHER_IS_BETTER = {"rps": True, "p50_ms": False, "p99_ms": False, "peak_alloc_bytes": False}
+
+
+def compare(results: dict, baseline: dict, tolerance: float, p99_tolerance: Optional[float] = None) -> list[str]:
+    """
+    ベースラインより tolerance (相対値) を超えて悪化した指標を返す。
+    p99 は外れ値に引っ張られやすいので p99_tolerance で別に指定できる
+    """
+    regressions = []
+    for route, result in results.items():
+        if route not in baseline:
+            continue
+        for metric, higher_is_better in _HIGHER_IS_BETTER.items():
+            expected = baseline[route].get(metric)
+            if expected is None:
+                continue
+            actual = result[metric]
+            allowed = p99_tolerance if metric == "p99_ms" and p99_tolerance is not None else tolerance
+            limit = expected * (1 - allowed) if higher_is_better else expected * (1 + allowed)
+            if (actual < limit) if higher_is_better else (actual > limit):
+                regressions.append(f"{route} {metric}: {actual} (baseline {expected}, limit {limit:.3f})")
+    return regressions
+
+
+def median_of(runs: list[dict]) -> dict:
+    return {metric: sorted(run[metric] for run in runs)[len(runs) // 2] for metric in runs[0]}
+
+
+async def run(app, routes: list[tuple[str, str]], body: bytes, concurrency: int, requests: int, repeat: int) -> dict:
+    """ルートごとに repeat 回計測し、指標ごとの中央値を返す"""
+    results = {}
+    async with Lifespan(app):
+        for method, path in routes:
+            runs = [await bench_route(app, method, path, body, concurrency, requests) for _ in range(repeat)]
+            results[f"{method} {path}"] = median_of(runs)
+    return results
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="main:app", help="module:attribute of the ASGI app")
+    parser.add_argument("--app-dir", help="directory to import the app from")
+    parser.add_argument("--route", action="append", help='"METHOD /path", can be repeated (default: GET / and POST /)')
+    parser.add_argument("--body", default="", help="request body sent to every route")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=5000, help="requests per route")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per route, the median of each metric is reported")
+    parser.add_argument("--baseline", help="JSON file to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    parser.add_argument("--p99-tolerance", type=float, default=0.3, help="allowed relative regression of p99_ms")
+    parser.add_argument("--retries", type=int, default=1, help="times to re-measure routes that regressed")
+    args = parser.parse_args(argv)
+
+    # キャッシュの設定はアプリの import 時に読まれる
+    os.environ.setdefault("RESPONSE_CACHE_MAX_ENTRIES", "0")
+    app = load_app(args.app, args.app_dir)
+    routes = [parse_route(spec) for spec in args.route or ["GET /", "POST /"]]
+
+    def measure(routes: list[tuple[str, str]]) -> dict:
+        return asyncio.run(run(app, routes, args.body.encode(), args.concurrency, args.requests, args.repeat))
+
+    results = measure(routes)
+    for route, result in results.items():
+        print(json.dumps({"route": route, "concurrency": args.concurrency, **result}))
+
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    for _ in range(args.retries):
+        # 他のプロセスに CPU を取られただけのこともあるので、悪化したルートだけ測り直す
+        regressed = [
+            route for route, result in results.items()
+            if compare({route: result}, baseline, args.tolerance, args.p99_tolerance)
+        ]
+        if not regressed:
+            break
+        print(f"re-measuring {', '.join(regressed)}", file=sys.stderr)
+        results.update(measure([parse_route(route) for route in regressed]))
+        for route in regressed:
+            print(json.dumps({"route": route, "concurrency": args.concurrency, **results[route]}))
+    regressions = compare(results, baseline, args.tolerance, args.p99_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""
+GET / と POST / のレスポンスのシリアライズ方法ごとのスループットを比べるマイクロベンチマーク
+
+ネットワークを通さずに ASGI アプリを直接呼ぶ。レスポンスキャッシュは無効にして計測する。baseline は response_model のモデルをそのまま返す
+(FastAPI が再検証し jsonable_encoder + json.dumps でシリアライズする) 変更前のルート。
+
+    python -m benchmarks.json_bench --requests 20000
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from fastapi import FastAPI
+
+# レスポンスキャッシュの設定は main の import 時に読まれる。
+# 有効だと GET / は 2 回目以降キャッシュから返り、シリアライズ方法を切り替えても差が出ない
+os.environ.setdefault("RESPONSE_CACHE_MAX_ENTRIES", "0")
+
+import responses  # noqa: E402
+from benchmarks.asgi_bench import call  # noqa: E402
+from main import app  # noqa: E402
+from schemas import message  # noqa: E402
+
+
+def baseline_app() -> FastAPI:
+    baseline = FastAPI()
+
+    @baseline.get("/", response_model=message.Message)
+    def read_root() -> message.Message:
+        return message.Message(hello="World")
+
+    @baseline.post("/", response_model=message.Message)
+    def write_root() -> message.Message:
+        return message.Message(hello="World")
+
+    return baseline
+
+
+async def requests_per_second(asgi_app, method: str, requests: int) -> float:
+    # ウォームアップ
+    for _ in range(min(requests, 500)):
+        await call(asgi_app, method, "/")
+    started = time.perf_counter()
+    for _ in range(requests):
+        await call(asgi_app, method, "/")
+    return requests / (time.perf_counter() - started)
+
+
+async def run(requests: int) -> None:
+    print(f"{'variant':<10} {'method':<6} {'req/s':>10} {'vs baseline':>12}")
+    for method in ("GET", "POST"):
+        baseline = await requests_per_second(baseline_app(), method, requests)
+        print(f"{'baseline':<10} {method:<6} {baseline:>10.0f} {'':>12}")
+        for renderer in responses.RENDERERS:
+            responses.configure(renderer)
+            rps = await requests_per_second(app, method, requests)
+            print(f"{renderer:<10} {method:<6} {rps:>10.0f} {rps / baseline:>11.2f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(run(args.requests))
+
+
+if __name__ == "__main__":
+    main()
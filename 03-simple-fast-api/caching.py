@@ -0,0 +1,144 @@
+"""
+ETag による条件付き GET と、レスポンスのインメモリキャッシュを行う ASGI ミドルウェア
+
+GET の 200 レスポンスには本文のハッシュから強い ETag を付け、If-None-Match が一致すれば
+本文なしの 304 を返す。@cacheable(ttl=...) を付けたルートのレスポンスはシリアライズ済みの
+まま LRU に保持し、TTL の間はアプリを呼ばずに返す。ストリーミングのレスポンスはそのまま流す。
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+_CACHE_TTL_ATTR = "__cache_ttl__"
+
+
+def cacheable(ttl: int = 60) -> Callable:
+    """ルートのレスポンスを ResponseCacheMiddleware にキャッシュさせる。@router.get() の下に付ける"""
+
+    def decorator(endpoint: Callable) -> Callable:
+        setattr(endpoint, _CACHE_TTL_ATTR, ttl)
+        return endpoint
+
+    return decorator
+
+
+def etag(body: bytes) -> bytes:
+    return b'"' + hashlib.blake2b(body, digest_size=16).hexdigest().encode() + b'"'
+
+
+def etag_matches(if_none_match: Optional[bytes], tag: bytes) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == b"*":
+        return True
+    # If-None-Match は弱い比較なので W/ を外して比べる
+    return any(candidate.strip().removeprefix(b"W/") == tag for candidate in if_none_match.split(b","))
+
+
+class CachedResponse:
+    def __init__(self, status: int, headers: list, body: bytes, expires: float) -> None:
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.tag = dict(headers).get(b"etag", b"")
+
+
+class ResponseCache:
+    """件数と合計バイト数で上限をかけた、TTL 付きの LRU"""
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: tuple) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def set(self, key: tuple, entry: CachedResponse) -> None:
+        if len(entry.body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: tuple) -> None:
+        self._bytes -= len(self._entries.pop(key).body)
+
+
+class ResponseCacheMiddleware:
+    def __init__(self, app, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.app = app
+        self.cache = ResponseCache(max_entries, max_bytes)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        if_none_match = None
+        for name, value in scope["headers"]:
+            if name == b"if-none-match":
+                if_none_match = value
+        key = (scope["path"], scope["query_string"])
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            await self._send(send, cached.status, cached.headers, cached.body, if_none_match, cached.tag)
+            return
+
+        start = None
+        buffered = False
+
+        async def wrapped_send(event) -> None:
+            nonlocal start, buffered
+            if event["type"] == "http.response.start":
+                # 本文を見て ETag を決めるまでヘッダーを送らない
+                start = event
+                return
+            if event["type"] != "http.response.body" or buffered:
+                await send(event)
+                return
+            buffered = True
+            if event.get("more_body", False) or start["status"] != 200:
+                await send(start)
+                await send(event)
+                return
+
+            body = event.get("body", b"")
+            tag = etag(body)
+            headers = [(name, value) for name, value in start["headers"] if name != b"etag"] + [(b"etag", tag)]
+            ttl = getattr(scope.get("endpoint"), _CACHE_TTL_ATTR, None)
+            if ttl is not None:
+                if not any(name == b"cache-control" for name, _ in headers):
+                    headers.append((b"cache-control", f"public, max-age={ttl}".encode()))
+                self.cache.set(key, CachedResponse(200, headers, body, time.monotonic() + ttl))
+            await self._send(send, 200, headers, body, if_none_match, tag)
+
+        await self.app(scope, receive, wrapped_send)
+
+    async def _send(self, send, status: int, headers: list, body: bytes, if_none_match, tag: bytes) -> None:
+        if etag_matches(if_none_match, tag):
+            # 304 には本文とその長さを付けない
+            headers = [(name, value) for name, value in headers if name not in (b"content-length", b"content-type")]
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
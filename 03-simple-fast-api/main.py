@@ -1,10 +1,36 @@
+import os
+
 import uvicorn
+from caching import ResponseCacheMiddleware
 from fastapi import FastAPI
+from responses import ModelResponse, configure
 from routers import root
 
-app = FastAPI()
+# レスポンスのシリアライズ方法: pydantic (model_dump_json) / orjson / default (jsonable_encoder + json.dumps)
+configure(os.getenv("JSON_RENDERER", "pydantic"))
+
+app = FastAPI(default_response_class=ModelResponse)
 
 app.include_router(root.router)
 
+# GET のレスポンスに ETag を付け、@cacheable のルートはシリアライズ済みのレスポンスをキャッシュする
+app.add_middleware(
+    ResponseCacheMiddleware,
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024)),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+)
+
+# 署名付きの X-Profile ヘッダーか PROFILE_SAMPLE_RATE で選ばれたリクエストだけをプロファイルする
+if os.getenv("PROFILER_SECRET") or float(os.getenv("PROFILE_SAMPLE_RATE", 0)):
+    from profiling import ProfilerMiddleware
+
+    app.add_middleware(
+        ProfilerMiddleware,
+        secret=os.getenv("PROFILER_SECRET"),
+        sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", 0)),
+        directory=os.getenv("PROFILE_DIR", "/tmp/profiles"),
+        window=int(os.getenv("PROFILE_WINDOW", 1000)),
+    )
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""
+リクエスト単位でサンプリングプロファイラ (pyinstrument) を有効にする ASGI ミドルウェア
+
+次のどちらかのときだけリクエストをプロファイルする。
+
+- X-Profile ヘッダーに署名付きトークンがある: レスポンスの代わりに speedscope 形式
+  (X-Profile-Format: html なら HTML) のプロファイルを返す
+- PROFILE_SAMPLE_RATE の確率で選ばれた: プロファイルを PROFILE_DIR に保存する
+
+プロファイルしたリクエストの CPU 時間はルートごとに直近 PROFILE_WINDOW 件を集計し、
+署名付きの GET /_profile/stats で返す。PROFILER_SECRET も PROFILE_SAMPLE_RATE も
+設定しなければミドルウェア自体を追加しないのでコストはかからない。
+
+トークンは "<有効期限の UNIX 時刻>.<HMAC-SHA256(secret, "<有効期限>:<パス>")>" で、make_token() で作れる。
+pyinstrument はイベントループのスレッドだけをサンプリングするので、def のルートの処理は
+スレッドプールを await している時間として現れる。
+"""
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Optional
+
+STATS_PATH = "/_profile/stats"
+
+
+def make_token(secret: str, path: str, ttl: int = 300) -> str:
+    expires = str(int(time.time()) + ttl)
+    signature = hmac.new(secret.encode(), f"{expires}:{path}".encode(), hashlib.sha256).hexdigest()
+    return f"{expires}.{signature}"
+
+
+def verify_token(secret: str, path: str, token: str) -> bool:
+    expires, _, signature = token.partition(".")
+    # ヘッダーは latin-1 でデコードされるので ASCII 以外も来る。isdigit() は "²" なども真になる
+    if not expires.isascii() or not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = hmac.new(secret.encode(), f"{expires}:{path}".encode(), hashlib.sha256).hexdigest()
+    # compare_digest は ASCII 以外を含む str で TypeError になるのでバイト列で比べる
+    return hmac.compare_digest(expected.encode(), signature.encode("utf-8"))
+
+
+class RouteStats:
+    """ルートごとに直近 window 件の CPU 時間と経過時間を保持する"""
+
+    def __init__(self, window: int = 1000) -> None:
+        self._samples: dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    def add(self, route: str, cpu_time: float, duration: float) -> None:
+        with self._lock:
+            self._samples[route].append((cpu_time, duration))
+
+    def summary(self) -> dict:
+        with self._lock:
+            samples = {route: list(values) for route, values in self._samples.items()}
+        result = {}
+        for route, values in samples.items():
+            cpu = sorted(cpu_time for cpu_time, _ in values)
+            result[route] = {
+                "samples": len(values),
+                "cpu_ms_mean": round(sum(cpu) / len(cpu) * 1000, 3),
+                "cpu_ms_p95": round(cpu[min(len(cpu) - 1, int(0.95 * len(cpu)))] * 1000, 3),
+                "wall_ms_mean": round(sum(duration for _, duration in values) / len(values) * 1000, 3),
+            }
+        return result
+
+
+class ProfilerMiddleware:
+    def __init__(
+        self,
+        app,
+        secret: Optional[str] = None,
+        sample_rate: float = 0.0,
+        directory: str = "/tmp/profiles",
+        interval: float = 0.001,
+        window: int = 1000,
+    ) -> None:
+        from pyinstrument import Profiler
+
+        self.app = app
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.interval = interval
+        self.stats = RouteStats(window)
+        self._profiler_class = Profiler
+        # pyinstrument のプロファイラは同じスレッドで同時に 1 つしか動かせない
+        self._running = threading.Lock()
+
+    def _token(self, scope) -> Optional[str]:
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                return value.decode("latin-1")
+        return None
+
+    def _format(self, scope) -> str:
+        for name, value in scope["headers"]:
+            if name == b"x-profile-format":
+                return value.decode("latin-1")
+        return "speedscope"
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = self._token(scope) if self.secret else None
+        signed = token is not None and verify_token(self.secret, scope["path"], token)
+        if signed and scope["path"] == STATS_PATH:
+            await self._send_body(send, 200, json.dumps(self.stats.summary()).encode(), b"application/json")
+            return
+        sampled = not signed and self.sample_rate and random.random() < self.sample_rate
+        if not (signed or sampled) or not self._running.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            profiler = self._profiler_class(interval=self.interval, async_mode="enabled")
+            status = 0
+
+            async def capture(event) -> None:
+                nonlocal status
+                if event["type"] == "http.response.start":
+                    status = event["status"]
+                # 署名付きのリクエストには元のレスポンスの代わりにプロファイルを返す
+                if not signed:
+                    await send(event)
+
+            profiler.start()
+            try:
+                await self.app(scope, receive, capture)
+            finally:
+                session = profiler.stop()
+        finally:
+            self._running.release()
+
+        route = scope.get("route")
+        route_name = f"{scope['method']} {getattr(route, 'path', scope['path'])}"
+        self.stats.add(route_name, session.cpu_time, session.duration)
+
+        if signed:
+            body, content_type = self._render(profiler, self._format(scope))
+            await self._send_body(send, 200, body, content_type, [(b"x-profile-status", str(status).encode())])
+        else:
+            self._store(profiler, route_name)
+
+    def _render(self, profiler, fmt: str) -> tuple[bytes, bytes]:
+        if fmt == "html":
+            return profiler.output_html().encode(), b"text/html; charset=utf-8"
+        from pyinstrument.renderers import SpeedscopeRenderer
+
+        return profiler.output(SpeedscopeRenderer()).encode(), b"application/json"
+
+    def _store(self, profiler, route_name: str) -> None:
+        from pyinstrument.renderers import SpeedscopeRenderer
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = "".join(c if c.isalnum() else "_" for c in route_name).strip("_")
+        path = os.path.join(self.directory, f"{int(time.time() * 1000)}-{name}.speedscope.json")
+        with open(path, "w") as f:
+            f.write(profiler.output(SpeedscopeRenderer()))
+
+    async def _send_body(self, send, status: int, body: bytes, content_type: bytes, headers=()) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode()), *headers],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,43 @@
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+RENDERERS = ("pydantic", "orjson", "default")
+
+
+class ModelResponse(JSONResponse):
+    """
+    Pydantic モデルを jsonable_encoder を通さずにそのままシリアライズするレスポンス
+
+    ルートがこのレスポンスを直接返すと、FastAPI は response_model による再検証と
+    jsonable_encoder をスキップする。response_model は OpenAPI のスキーマにだけ使われる。
+    """
+
+    renderer = "pydantic"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, BaseModel):
+            if self.renderer == "pydantic":
+                return content.model_dump_json(by_alias=True).encode("utf-8")
+            if self.renderer == "orjson":
+                content = content.model_dump(mode="json", by_alias=True)
+            else:
+                content = jsonable_encoder(content, by_alias=True)
+        if self.renderer == "orjson":
+            return orjson.dumps(content)
+        return super().render(content)
+
+
+def configure(renderer: str) -> None:
+    if renderer not in RENDERERS:
+        raise ValueError(f"Unknown JSON_RENDERER '{renderer}'. Please use one of {', '.join(RENDERERS)}")
+    if renderer == "orjson" and orjson is None:
+        raise RuntimeError("JSON_RENDERER=orjson requires the orjson package")
+    ModelResponse.renderer = renderer
@@ -1,12 +1,15 @@
+from caching import cacheable
 from fastapi import APIRouter
+from responses import ModelResponse
 from schemas import message
 
 router = APIRouter()
 
 @router.get("/", response_model=message.Message)
-def read_root() -> message.Message:
-    return message.Message(hello="World")
+@cacheable(ttl=60)
+def read_root() -> ModelResponse:
+    return ModelResponse(message.Message(hello="World"))
 
 @router.post("/", response_model=message.Message)
-def write_root() -> message.Message:
-    return message.Message(hello="World")
+def write_root() -> ModelResponse:
+    return ModelResponse(message.Message(hello="World"))
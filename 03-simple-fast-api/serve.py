@@ -0,0 +1,186 @@
+"""
+複数プロセスで main:app を起動するランチャー
+
+アプリは親プロセスで import してから fork するので、読み込んだモジュールはワーカー間で
+copy-on-write で共有される。SO_REUSEPORT を有効にするとワーカーごとに同じポートへ bind し、
+カーネルが接続を振り分ける。無効なら親が bind したソケットを全ワーカーで共有する。
+
+    WEB_CONCURRENCY=4 PORT=8080 python serve.py
+"""
+import bisect
+import gc
+import importlib.util
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import uvicorn
+
+
+def cpu_count() -> int:
+    # コンテナに割り当てられた CPU だけを数える
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker_count() -> int:
+    return int(os.getenv("WEB_CONCURRENCY", cpu_count()))
+
+
+def bind_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def config(app, host: str, port: int) -> uvicorn.Config:
+    # X-Forwarded-* を信頼する送信元は uvicorn のデフォルト通り環境変数 FORWARDED_ALLOW_IPS で指定する
+    return uvicorn.Config(
+        app,
+        host=host,
+        port=port,
+        # uvloop / httptools がインストールされていれば使う
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools" if importlib.util.find_spec("httptools") else "h11",
+        timeout_graceful_shutdown=int(os.getenv("GRACEFUL_TIMEOUT", 10)),
+    )
+
+
+def run_worker(app, host: str, port: int, reuse_port: bool, sock: socket.socket | None) -> bool:
+    """起動できたかどうかを返す"""
+    if sock is None:
+        sock = bind_socket(host, port, reuse_port)
+    # SIGTERM / SIGINT を受けると処理中のリクエストを終えてから終了する
+    server = uvicorn.Server(config(app, host, port))
+    server.run(sockets=[sock])
+    # lifespan の startup に失敗しても例外は出ずに戻ってくる
+    return server.started
+
+
+class Supervisor:
+    """
+    ワーカーを fork し、落ちたら起動し直し、SIGTERM / SIGINT で全ワーカーを止める
+
+    起動直後に落ちるワーカーは間隔を倍々に空けて起動し直し、それが MAX_CRASHES 回続いたら
+    全ワーカーを止めて終了コード 1 で終わる。
+    """
+
+    # これより短い時間で終了したワーカーは起動直後に落ちたとみなす
+    MIN_UPTIME = 10.0
+    MAX_CRASHES = 5
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, app, host: str, port: int, workers: int, reuse_port: bool) -> None:
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.sock = None if reuse_port else bind_socket(host, port, reuse_port=False)
+        # pid -> 起動した時刻
+        self.children: dict[int, float] = {}
+        # 起動し直す予定の時刻
+        self.respawns: list[float] = []
+        self.crashes = 0
+        self.exit_code = 0
+        self.stopping = False
+
+    def spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                started = run_worker(self.app, self.host, self.port, self.reuse_port, self.sock)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0 if started else 3)
+        self.children[pid] = time.monotonic()
+
+    def stop(self, signum, frame) -> None:
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self, pid: int, status: int) -> None:
+        started = self.children.pop(pid)
+        if self.stopping:
+            return
+        code = os.waitstatus_to_exitcode(status)
+        print(f"Worker {pid} exited with code {code}", file=sys.stderr)
+        now = time.monotonic()
+        if now - started < self.MIN_UPTIME:
+            self.crashes += 1
+        else:
+            self.crashes = 0
+        if self.crashes >= self.MAX_CRASHES:
+            print(f"Workers crashed {self.crashes} times in a row after starting, shutting down", file=sys.stderr)
+            self.exit_code = 1
+            self.stop(None, None)
+            return
+        # 続けて落ちるほど起動し直すまでの間隔を空ける (0.5 秒, 1 秒, 2 秒, ...)
+        delay = min(self.MAX_BACKOFF, 0.25 * 2**self.crashes) if self.crashes else 0.0
+        bisect.insort(self.respawns, now + delay)
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        # fork 前に既存のオブジェクトを GC の対象から外し、参照カウント以外でページがコピーされないようにする
+        gc.freeze()
+        for _ in range(self.workers):
+            self.spawn()
+
+        deadline = None
+        while self.children or (self.respawns and not self.stopping):
+            now = time.monotonic()
+            if self.stopping and deadline is None:
+                deadline = now + int(os.getenv("GRACEFUL_TIMEOUT", 10)) + 5
+            while self.respawns and self.respawns[0] <= now and not self.stopping:
+                self.respawns.pop(0)
+                self.spawn()
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG) if self.children else (0, 0)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                if deadline is not None and now > deadline:
+                    for child in self.children:
+                        os.kill(child, signal.SIGKILL)
+                time.sleep(0.1)
+                continue
+            self.reap(pid, status)
+        return self.exit_code
+
+
+def main() -> None:
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", 8080))
+    workers = worker_count()
+    reuse_port = os.getenv("REUSE_PORT", "true").lower() == "true" and hasattr(socket, "SO_REUSEPORT")
+
+    # fork する前にアプリを読み込む
+    from main import app
+
+    if workers <= 1:
+        if not run_worker(app, host, port, reuse_port=False, sock=None):
+            sys.exit(3)
+        return
+    print(f"Starting {workers} workers on {host}:{port} (SO_REUSEPORT={reuse_port})", file=sys.stderr)
+    sys.exit(Supervisor(app, host, port, workers, reuse_port).run())
+
+
+if __name__ == "__main__":
+    main()
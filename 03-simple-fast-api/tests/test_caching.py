@@ -0,0 +1,102 @@
+import unittest
+
+from caching import cacheable, etag, etag_matches, ResponseCacheMiddleware
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+
+def create_app(max_entries: int = 1024) -> tuple[FastAPI, dict]:
+    calls = {"cached": 0, "plain": 0}
+    app = FastAPI()
+
+    @app.get("/cached")
+    @cacheable(ttl=30)
+    def cached():
+        calls["cached"] += 1
+        return {"calls": calls["cached"]}
+
+    @app.get("/plain")
+    def plain():
+        calls["plain"] += 1
+        return {"hello": "World"}
+
+    @app.post("/plain")
+    def post_plain():
+        return {"hello": "World"}
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse(iter([b"a", b"b"]), media_type="text/plain")
+
+    @app.get("/missing")
+    def missing():
+        return PlainTextResponse("not found", status_code=404)
+
+    app.add_middleware(ResponseCacheMiddleware, max_entries=max_entries)
+    return app, calls
+
+
+class EtagMatchesTest(unittest.TestCase):
+    def test_matches(self):
+        tag = etag(b"body")
+        self.assertTrue(etag_matches(tag, tag))
+        self.assertTrue(etag_matches(b'"other", W/' + tag, tag))
+        self.assertTrue(etag_matches(b"*", tag))
+        self.assertFalse(etag_matches(b'"other"', tag))
+        self.assertFalse(etag_matches(None, tag))
+
+
+class ResponseCacheMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        app, self.calls = create_app()
+        self.client = TestClient(app)
+
+    def test_get_has_etag_of_body(self):
+        response = self.client.get("/plain")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["etag"], etag(response.content).decode())
+
+    def test_if_none_match_returns_304_without_body(self):
+        tag = self.client.get("/plain").headers["etag"]
+        response = self.client.get("/plain", headers={"If-None-Match": tag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertNotIn("content-length", response.headers)
+        self.assertEqual(response.headers["etag"], tag)
+        # ETag しか付けないルートは毎回アプリを呼ぶ
+        self.assertEqual(self.calls["plain"], 2)
+
+    def test_stale_etag_returns_200(self):
+        response = self.client.get("/plain", headers={"If-None-Match": '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"hello": "World"})
+
+    def test_cacheable_route_is_served_from_cache(self):
+        first = self.client.get("/cached")
+        second = self.client.get("/cached")
+        self.assertEqual(second.json(), {"calls": 1})
+        self.assertEqual(second.headers["etag"], first.headers["etag"])
+        self.assertEqual(second.headers["cache-control"], "public, max-age=30")
+        self.assertEqual(self.client.get("/cached", headers={"If-None-Match": first.headers["etag"]}).status_code, 304)
+        self.assertEqual(self.calls["cached"], 1)
+
+    def test_query_string_is_part_of_the_key(self):
+        self.client.get("/cached")
+        self.assertEqual(self.client.get("/cached?page=2").json(), {"calls": 2})
+
+    def test_max_entries_zero_disables_cache(self):
+        app, calls = create_app(max_entries=0)
+        client = TestClient(app)
+        client.get("/cached")
+        self.assertEqual(client.get("/cached").json(), {"calls": 2})
+        self.assertIn("etag", client.get("/cached").headers)
+
+    def test_post_streaming_and_errors_are_not_tagged(self):
+        self.assertNotIn("etag", self.client.post("/plain").headers)
+        stream = self.client.get("/stream")
+        self.assertEqual(stream.content, b"ab")
+        self.assertNotIn("etag", stream.headers)
+        missing = self.client.get("/missing")
+        self.assertEqual(missing.status_code, 404)
+        self.assertNotIn("etag", missing.headers)
@@ -0,0 +1,45 @@
+import time
+import unittest
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from profiling import make_token, ProfilerMiddleware, STATS_PATH, verify_token
+
+
+class VerifyTokenTest(unittest.TestCase):
+    def test_valid_token(self):
+        self.assertTrue(verify_token("secret", "/x", make_token("secret", "/x")))
+
+    def test_wrong_secret_path_or_expired(self):
+        self.assertFalse(verify_token("other", "/x", make_token("secret", "/x")))
+        self.assertFalse(verify_token("secret", "/y", make_token("secret", "/x")))
+        self.assertFalse(verify_token("secret", "/x", make_token("secret", "/x", ttl=-1)))
+
+    def test_malformed_tokens_are_rejected(self):
+        expires = int(time.time()) + 60
+        for token in ["", "garbage", f"{expires}", f"{expires}.\xe9", f"{expires}.é" * 3, "²³.abc", f"{expires}.あ"]:
+            with self.subTest(token=token):
+                self.assertFalse(verify_token("secret", "/x", token))
+
+
+class ProfilerMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+
+        @app.get("/x")
+        def read_x():
+            return {"hello": "World"}
+
+        app.add_middleware(ProfilerMiddleware, secret="secret")
+        self.client = TestClient(app)
+
+    def test_non_ascii_token_is_ignored(self):
+        expires = int(time.time()) + 60
+        response = self.client.get("/x", headers=[(b"x-profile", f"{expires}.".encode() + b"\xe9\xff")])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"hello": "World"})
+
+    def test_stats_need_a_signed_token(self):
+        self.assertEqual(self.client.get(STATS_PATH, headers={"X-Profile": "1.abc"}).status_code, 404)
+        response = self.client.get(STATS_PATH, headers={"X-Profile": make_token("secret", STATS_PATH)})
+        self.assertEqual(response.status_code, 200)
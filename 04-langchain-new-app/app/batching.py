@@ -0,0 +1,152 @@
+"""
+Managed batches that stay within the model's quota.
+
+Every batch item takes a slot from an AdaptiveLimiter shared by the whole process. The
+limiter halves its concurrency when the model answers 429 / RESOURCE_EXHAUSTED and adds
+back about one slot per limit's worth of successes, so batches settle near the highest
+concurrency the quota allows. Items that are rate limited or fail transiently are retried
+with jittered exponential backoff; items that still fail are reported on their own.
+"""
+import asyncio
+import os
+import random
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Optional, Union
+
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import get_config_list
+from langchain_core.runnables.utils import Input, Output
+
+from app.wrappers import RunnableWrapper
+
+# HTTP status codes worth retrying: rate limiting and transient server errors.
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+
+
+def error_code(error: BaseException) -> Optional[int]:
+    """Returns the HTTP status of an API error, from google.api_core's .code or an HTTP client's .status_code."""
+    for attr in ("code", "status_code"):
+        code = getattr(error, attr, None)
+        if isinstance(code, int):
+            return int(code)
+    return None
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    return error_code(error) == 429 or "RESOURCE_EXHAUSTED" in str(error)
+
+
+def is_retryable(error: BaseException) -> bool:
+    return is_rate_limited(error) or error_code(error) in RETRYABLE_CODES
+
+
+class AdaptiveLimiter:
+    """A concurrency limit that backs off multiplicatively on rate limiting and recovers additively."""
+
+    def __init__(self, maximum: int, minimum: int = 1, cooldown: float = 1.0) -> None:
+        self.maximum = maximum
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.stats: Counter = Counter()
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < max(self.minimum, int(self.limit)))
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(self) -> None:
+        self.stats["succeeded"] += 1
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_rate_limited(self) -> None:
+        self.stats["rate_limited"] += 1
+        now = time.monotonic()
+        # Calls already in flight when the quota ran out report it too; count that as one signal.
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+
+    def summary(self) -> dict:
+        return {"limit": round(self.limit, 2), "in_flight": self.in_flight, **self.stats}
+
+
+class ManagedBatchRunnable(RunnableWrapper[Input, Output]):
+    """Runs abatch() items under an AdaptiveLimiter and max_concurrency, retrying each item on its own."""
+
+    def __init__(
+        self,
+        bound: Runnable[Input, Output],
+        limiter: AdaptiveLimiter,
+        max_retries: int = 4,
+        backoff: float = 0.5,
+        max_backoff: float = 20.0,
+    ) -> None:
+        super().__init__(bound)
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    async def _ainvoke_item(self, input: Input, config: RunnableConfig, semaphore: asyncio.Semaphore, **kwargs: Any):
+        for attempt in range(self.max_retries + 1):
+            async with semaphore, self.limiter.slot():
+                try:
+                    output = await self.ainvoke(input, config, **kwargs)
+                except Exception as error:
+                    if is_rate_limited(error):
+                        self.limiter.on_rate_limited()
+                    if not is_retryable(error) or attempt == self.max_retries:
+                        self.limiter.stats["failed"] += 1
+                        raise
+                else:
+                    self.limiter.on_success()
+                    return output
+            self.limiter.stats["retried"] += 1
+            # Full jitter keeps retries of the same batch from arriving together.
+            await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    async def abatch(
+        self,
+        inputs: List[Input],
+        config: Optional[Union[RunnableConfig, List[RunnableConfig]]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Optional[Any],
+    ) -> List[Output]:
+        if not inputs:
+            return []
+        configs = get_config_list(config, len(inputs))
+        max_concurrency = configs[0].get("max_concurrency") or self.limiter.maximum
+        # /batch passes the client's config through unchecked, and Semaphore() rejects negative values.
+        semaphore = asyncio.Semaphore(max(1, min(max_concurrency, self.limiter.maximum)))
+        # Every item runs to completion even when another fails, so one bad prompt does not waste the rest.
+        outputs = await asyncio.gather(
+            *(self._ainvoke_item(input, config, semaphore, **kwargs) for input, config in zip(inputs, configs)),
+            return_exceptions=True,
+        )
+        if not return_exceptions:
+            for output in outputs:
+                if isinstance(output, BaseException):
+                    raise output
+        return outputs
+
+
+def managed_batch(runnable: Runnable, limiter: Optional[AdaptiveLimiter] = None) -> ManagedBatchRunnable:
+    """Wraps a chain served by add_routes() so /batch respects the model's quota."""
+    if limiter is None:
+        limiter = AdaptiveLimiter(int(os.getenv("BATCH_MAX_CONCURRENCY", 8)))
+    return ManagedBatchRunnable(runnable, limiter, max_retries=int(os.getenv("BATCH_MAX_RETRIES", 4)))
@@ -0,0 +1,246 @@
+"""
+Persistent exact-match cache for LLM chain responses.
+
+Entries are keyed by the route's namespace, the normalized prompt and the model
+parameters, and stored in SQLite with a TTL and LRU eviction by entry count and
+total size. Requests can skip the cache with ``Cache-Control: no-cache`` or
+``X-LLM-Cache: bypass``.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from langchain_core._api import suppress_langchain_beta_warning
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.load import dumps, loads
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.utils import Input, Output
+
+from app.wrappers import RunnableWrapper, aiter_once
+
+# Set on the run config by bypass_cache_config() when a request asks to skip the cache.
+BYPASS_METADATA_KEY = "llm_cache_bypass"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalizes Unicode, line endings and surrounding whitespace, which do not change the prompt's meaning."""
+    prompt = unicodedata.normalize("NFC", prompt).replace("\r\n", "\n")
+    return "\n".join(line.rstrip() for line in prompt.strip().split("\n"))
+
+
+def llm_params(llm: BaseLanguageModel) -> str:
+    """Returns the model parameters that affect the output, like LangChain's own llm_string."""
+    return json.dumps({"_type": llm._llm_type, **llm._identifying_params}, sort_keys=True, default=str)
+
+
+def cache_key(namespace: str, input: Any, params: str) -> str:
+    if isinstance(input, str):
+        prompt = normalize_prompt(input)
+    else:
+        prompt = dumps(input)
+    return hashlib.sha256(json.dumps([namespace, prompt, params]).encode("utf-8")).hexdigest()
+
+
+class SQLiteLLMCache:
+    """A size-bounded SQLite key-value store with per-entry expiry and least-recently-used eviction."""
+
+    def __init__(self, path: str, max_entries: int = 10000, max_bytes: int = 256 * 1024 * 1024) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats: defaultdict[str, Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+
+    def lookup(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def update(self, key: str, value: str, ttl: float) -> None:
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now + ttl, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("DELETE FROM llm_cache WHERE expires < ?", (now,))
+        entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        if entries > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed LIMIT ?)",
+                (entries - self.max_entries,),
+            )
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total > self.max_bytes:
+            # Drop the least recently used entries until the remaining ones fit.
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed DESC) AS kept FROM llm_cache) "
+                "WHERE kept > ?)",
+                (self.max_bytes,),
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+
+    def summary(self) -> dict:
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+        routes = {}
+        for namespace, counts in self.stats.items():
+            lookups = counts["hits"] + counts["misses"]
+            routes[namespace] = {**counts, "hit_rate": round(counts["hits"] / lookups, 4) if lookups else 0.0}
+        return {"entries": entries, "bytes": total, "routes": routes}
+
+
+class CachedRunnable(RunnableWrapper[Input, Output]):
+    """Serves a runnable's outputs from a SQLiteLLMCache, and stores them on a miss."""
+
+    def __init__(self, bound: Runnable[Input, Output], cache: SQLiteLLMCache, namespace: str, params: str, ttl: float):
+        super().__init__(bound)
+        self.cache = cache
+        self.namespace = namespace
+        self.params = params
+        self.ttl = ttl
+
+    def _key(self, input: Input, config: Optional[RunnableConfig]) -> Optional[str]:
+        if (config or {}).get("metadata", {}).get(BYPASS_METADATA_KEY):
+            self.cache.stats[self.namespace]["bypassed"] += 1
+            return None
+        return cache_key(self.namespace, input, self.params)
+
+    def _hit(self, value: Optional[str]) -> Optional[Any]:
+        self.cache.stats[self.namespace]["hits" if value is not None else "misses"] += 1
+        if value is None:
+            return None
+        with suppress_langchain_beta_warning():
+            return loads(value)
+
+    def _invoke(
+        self, input: Input, run_manager: CallbackManagerForChainRun, config: RunnableConfig, **kwargs: Any
+    ) -> Output:
+        key = self._key(input, config)
+        if key is not None:
+            cached = self._hit(self.cache.lookup(key))
+            if cached is not None:
+                return cached
+        output = super()._invoke(input, run_manager, config, **kwargs)
+        if key is not None:
+            self.cache.update(key, dumps(output), self.ttl)
+        return output
+
+    async def _ainvoke(
+        self, input: Input, run_manager: AsyncCallbackManagerForChainRun, config: RunnableConfig, **kwargs: Any
+    ) -> Output:
+        key = self._key(input, config)
+        if key is not None:
+            cached = self._hit(await asyncio.to_thread(self.cache.lookup, key))
+            if cached is not None:
+                return cached
+        output = await super()._ainvoke(input, run_manager, config, **kwargs)
+        if key is not None:
+            await asyncio.to_thread(self.cache.update, key, dumps(output), self.ttl)
+        return output
+
+    def _stream(
+        self, inputs: Iterator[Input], run_manager: CallbackManagerForChainRun, config: RunnableConfig, **kwargs: Any
+    ) -> Iterator[Output]:
+        input = next(inputs)
+        key = self._key(input, config)
+        if key is not None:
+            cached = self._hit(self.cache.lookup(key))
+            if cached is not None:
+                yield cached
+                return
+        final = None
+        for chunk in super()._stream(iter([input]), run_manager, config, **kwargs):
+            final = chunk if final is None else final + chunk
+            yield chunk
+        if key is not None and final is not None:
+            self.cache.update(key, dumps(final), self.ttl)
+
+    async def _astream(
+        self,
+        inputs: AsyncIterator[Input],
+        run_manager: AsyncCallbackManagerForChainRun,
+        config: RunnableConfig,
+        **kwargs: Any,
+    ) -> AsyncIterator[Output]:
+        input = await inputs.__anext__()
+        key = self._key(input, config)
+        if key is not None:
+            cached = self._hit(await asyncio.to_thread(self.cache.lookup, key))
+            if cached is not None:
+                yield cached
+                return
+        final = None
+        async for chunk in super()._astream(aiter_once(input), run_manager, config, **kwargs):
+            final = chunk if final is None else final + chunk
+            yield chunk
+        if key is not None and final is not None:
+            await asyncio.to_thread(self.cache.update, key, dumps(final), self.ttl)
+
+
+def with_cache(
+    runnable: Runnable,
+    cache: Optional[SQLiteLLMCache],
+    llm: BaseLanguageModel,
+    namespace: str = "default",
+    ttl: Optional[float] = None,
+) -> Runnable:
+    """Wraps a chain served by add_routes() so identical prompts to the same model are answered from cache."""
+    if cache is None:
+        return runnable
+    if ttl is None:
+        ttl = float(os.getenv("LLM_CACHE_TTL", 24 * 60 * 60))
+    return CachedRunnable(runnable, cache, namespace, llm_params(llm), ttl)
+
+
+def init_llm_cache() -> Optional[SQLiteLLMCache]:
+    if os.getenv("LLM_CACHE", "sqlite") == "none":
+        return None
+    return SQLiteLLMCache(
+        os.getenv("LLM_CACHE_PATH", "/tmp/llm_cache.sqlite3"),
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000)),
+        max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    )
+
+
+def bypass_cache_config(config: dict, request) -> dict:
+    """per_req_config_modifier for add_routes() that honours the cache bypass headers."""
+    if "no-cache" in request.headers.get("cache-control", "") or request.headers.get("x-llm-cache") == "bypass":
+        config = {**config, "metadata": {**config.get("metadata", {}), BYPASS_METADATA_KEY: True}}
+    return config
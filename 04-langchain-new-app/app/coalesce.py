@@ -0,0 +1,162 @@
+"""
+Single-flight coalescing of concurrent identical LLM calls.
+
+While a call for a prompt is in flight, identical async invoke and stream calls wait for it
+instead of calling the model again. Stream subscribers are sent the chunks produced so far
+and then each new chunk as it arrives, so every subscriber gets the whole output. The
+upstream call is cancelled only when every request waiting for it has gone away.
+"""
+import asyncio
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.utils import Input, Output
+
+from app.cache import BYPASS_METADATA_KEY, cache_key, llm_params
+from app.wrappers import RunnableWrapper, aiter_once
+
+
+class _Flight:
+    """An upstream call in progress, the chunks it has produced and the number of requests waiting for it."""
+
+    def __init__(self) -> None:
+        self.task: Optional[asyncio.Future] = None
+        self.waiters = 0
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: Any) -> None:
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self) -> None:
+        # Wake everyone waiting on the current event; later waits use a fresh one.
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class CoalescingRunnable(RunnableWrapper[Input, Output]):
+    """Shares one upstream call between concurrent async calls with the same prompt and model parameters."""
+
+    def __init__(self, bound: Runnable[Input, Output], namespace: str, params: str) -> None:
+        super().__init__(bound)
+        self.namespace = namespace
+        self.params = params
+        self.stats: Counter = Counter()
+        self._invocations: Dict[str, _Flight] = {}
+        self._streams: Dict[str, _Flight] = {}
+
+    def _key(self, input: Input, config: Optional[RunnableConfig]) -> Optional[str]:
+        # A request that skips the cache wants a fresh answer, so it does not join a call already in flight.
+        if (config or {}).get("metadata", {}).get(BYPASS_METADATA_KEY):
+            return None
+        return cache_key(self.namespace, input, self.params)
+
+    def _join(self, flights: Dict[str, _Flight], key: str) -> Optional[_Flight]:
+        flight = flights.get(key)
+        if flight is not None:
+            self.stats["coalesced"] += 1
+            flight.waiters += 1
+        return flight
+
+    def _start(self, flights: Dict[str, _Flight], key: str, flight: _Flight) -> _Flight:
+        self.stats["upstream"] += 1
+        flight.waiters += 1
+        flights[key] = flight
+        flight.task.add_done_callback(lambda _: self._forget(flights, key, flight))
+        return flight
+
+    def _leave(self, flights: Dict[str, _Flight], key: str, flight: _Flight) -> None:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            self._forget(flights, key, flight)
+            flight.task.cancel()
+
+    @staticmethod
+    def _forget(flights: Dict[str, _Flight], key: str, flight: _Flight) -> None:
+        if flights.get(key) is flight:
+            del flights[key]
+
+    async def _ainvoke(
+        self, input: Input, run_manager: AsyncCallbackManagerForChainRun, config: RunnableConfig, **kwargs: Any
+    ) -> Output:
+        key = self._key(input, config)
+        if key is None:
+            return await super()._ainvoke(input, run_manager, config, **kwargs)
+        flight = self._join(self._invocations, key)
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(super()._ainvoke(input, run_manager, config, **kwargs))
+            self._start(self._invocations, key, flight)
+        try:
+            # The call must outlive the request that started it while others are still waiting.
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(self._invocations, key, flight)
+
+    async def _astream(
+        self,
+        inputs: AsyncIterator[Input],
+        run_manager: AsyncCallbackManagerForChainRun,
+        config: RunnableConfig,
+        **kwargs: Any,
+    ) -> AsyncIterator[Output]:
+        input = await inputs.__anext__()
+        key = self._key(input, config)
+        if key is None:
+            async for chunk in super()._astream(aiter_once(input), run_manager, config, **kwargs):
+                yield chunk
+            return
+        flight = self._join(self._streams, key)
+        if flight is None:
+            flight = _Flight()
+            flight.task = asyncio.ensure_future(self._produce(flight, input, run_manager, config, **kwargs))
+            self._start(self._streams, key, flight)
+        try:
+            async for chunk in flight.subscribe():
+                yield chunk
+        finally:
+            self._leave(self._streams, key, flight)
+
+    async def _produce(
+        self,
+        flight: _Flight,
+        input: Input,
+        run_manager: AsyncCallbackManagerForChainRun,
+        config: RunnableConfig,
+        **kwargs: Any,
+    ) -> None:
+        try:
+            async for chunk in super()._astream(aiter_once(input), run_manager, config, **kwargs):
+                flight.publish(chunk)
+        except Exception as error:
+            flight.finish(error)
+        else:
+            flight.finish()
+
+
+def coalesce(runnable: Runnable, llm: BaseLanguageModel, namespace: str = "default") -> CoalescingRunnable:
+    """Wraps a chain served by add_routes() so concurrent identical prompts share one call to the model."""
+    return CoalescingRunnable(runnable, namespace, llm_params(llm))
@@ -0,0 +1,97 @@
+"""
+The model behind the chain.
+
+Set ``LLM=fake`` to serve FakeTokenLLM instead of Vertex AI, e.g. to run the server or
+benchmarks/latency_bench.py offline.
+"""
+import asyncio
+import hashlib
+import os
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+_WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+
+
+class FakeTokenLLM(LLM):
+    """Answers every prompt with the same `tokens` words for that prompt, one every `delay` seconds."""
+
+    tokens: int = 64
+    delay: float = 0.02
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-token"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"tokens": self.tokens, "delay": self.delay}
+
+    def _tokens(self, prompt: str) -> List[str]:
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        return [_WORDS[digest[i % len(digest)] % len(_WORDS)] + " " for i in range(self.tokens)]
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return "".join([chunk.text async for chunk in self._astream(prompt, stop, run_manager, **kwargs)])
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        for token in self._tokens(prompt):
+            time.sleep(self.delay)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        for token in self._tokens(prompt):
+            await asyncio.sleep(self.delay)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+def init_llm(max_retries: Optional[int] = None) -> BaseLanguageModel:
+    """Returns the model. max_retries overrides how often VertexAI retries a failed call itself."""
+    if os.getenv("LLM", "vertexai") == "fake":
+        return FakeTokenLLM(
+            tokens=int(os.getenv("FAKE_LLM_TOKENS", 64)),
+            delay=float(os.getenv("FAKE_LLM_DELAY", 0.02)),
+        )
+    from langchain_google_vertexai import VertexAI
+
+    if max_retries is None:
+        return VertexAI(model_name="gemini-1.0-pro-001")
+    return VertexAI(model_name="gemini-1.0-pro-001", max_retries=max_retries)
@@ -1,20 +1,68 @@
-from fastapi import FastAPI
+import os
+from typing import Any, List, Optional
+
+from fastapi import FastAPI, Request
 from fastapi.responses import RedirectResponse
 from langserve import add_routes
-from langchain_google_vertexai import VertexAI
+from langchain_core.load import dumpd
 from langchain_core.output_parsers import StrOutputParser
+from pydantic import BaseModel, Field
+
+from app.batching import managed_batch
+from app.cache import bypass_cache_config, init_llm_cache, with_cache
+from app.coalesce import coalesce
+from app.llm import init_llm
 
 app = FastAPI()
-llm = VertexAI(model_name="gemini-1.0-pro-001")
+# Batches retry rate-limited items themselves, and the limiter has to see the 429s to back off.
+llm = init_llm(max_retries=int(os.getenv("LLM_MAX_RETRIES", 1)))
 chain = (llm | StrOutputParser())
+llm_cache = init_llm_cache()
+coalesced_chain = coalesce(chain, llm)
+managed_chain = managed_batch(with_cache(coalesced_chain, llm_cache, llm))
 
 @app.get("/")
 async def redirect_root_to_docs():
     return RedirectResponse("/docs")
 
 
+@app.get("/cache/stats")
+async def cache_stats():
+    stats = llm_cache.summary() if llm_cache else {}
+    return {**stats, "coalescing": dict(coalesced_chain.stats), "batching": managed_chain.limiter.summary()}
+
+
+class ManagedBatchRequest(BaseModel):
+    inputs: List[Any]
+    max_concurrency: Optional[int] = Field(default=None, ge=1)
+
+
+@app.post("/batch/managed")
+async def batch_managed(body: ManagedBatchRequest, request: Request):
+    """Like /batch, but items that still fail after retries are reported in "errors" instead of failing the batch."""
+    config = bypass_cache_config({"max_concurrency": body.max_concurrency}, request)
+    outputs = await managed_chain.abatch(body.inputs, config, return_exceptions=True)
+    errors = [
+        {"index": index, "type": type(output).__name__, "message": str(output)}
+        for index, output in enumerate(outputs)
+        if isinstance(output, Exception)
+    ]
+    return {
+        "output": [None if isinstance(output, Exception) else dumpd(output) for output in outputs],
+        "errors": errors,
+    }
+
+
 # Edit this to add the chain you want to add
-add_routes(app, chain)
+# Identical prompts are answered from the LLM cache; send "Cache-Control: no-cache" to skip it.
+# Cache misses for a prompt that is already being answered wait for that call instead of making another.
+# Batches run under an adaptive concurrency limit; clients can lower it with config.max_concurrency.
+add_routes(
+    app,
+    managed_chain,
+    config_keys=("configurable", "max_concurrency"),
+    per_req_config_modifier=bypass_cache_config,
+)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,84 @@
+from typing import Any, AsyncIterator, Iterator, List, Optional, Type
+
+from langchain_core.callbacks import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
+from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import patch_config
+from langchain_core.runnables.utils import ConfigurableFieldSpec, Input, Output
+
+
+class RunnableWrapper(Runnable[Input, Output]):
+    """
+    Base class for runnables that wrap a chain served by add_routes().
+
+    Schemas and configurable fields come from the wrapped runnable. Each call opens
+    its own run, which LangServe needs for run ids, and subclasses override the
+    _invoke/_ainvoke/_stream/_astream hooks, which pass straight through by default.
+    """
+
+    def __init__(self, bound: Runnable[Input, Output]) -> None:
+        self.bound = bound
+
+    @property
+    def InputType(self) -> Type[Input]:
+        return self.bound.InputType
+
+    @property
+    def OutputType(self) -> Type[Output]:
+        return self.bound.OutputType
+
+    def get_input_schema(self, config: Optional[RunnableConfig] = None) -> Type[BaseModel]:
+        return self.bound.get_input_schema(config)
+
+    def get_output_schema(self, config: Optional[RunnableConfig] = None) -> Type[BaseModel]:
+        return self.bound.get_output_schema(config)
+
+    @property
+    def config_specs(self) -> List[ConfigurableFieldSpec]:
+        return self.bound.config_specs
+
+    def invoke(self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Output:
+        return self._call_with_config(self._invoke, input, config, **kwargs)
+
+    async def ainvoke(self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Output:
+        return await self._acall_with_config(self._ainvoke, input, config, **kwargs)
+
+    def stream(self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Output]:
+        yield from self._transform_stream_with_config(iter([input]), self._stream, config, **kwargs)
+
+    async def astream(
+        self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[Output]:
+        async for chunk in self._atransform_stream_with_config(aiter_once(input), self._astream, config, **kwargs):
+            yield chunk
+
+    def _invoke(
+        self, input: Input, run_manager: CallbackManagerForChainRun, config: RunnableConfig, **kwargs: Any
+    ) -> Output:
+        return self.bound.invoke(input, patch_config(config, callbacks=run_manager.get_child()), **kwargs)
+
+    async def _ainvoke(
+        self, input: Input, run_manager: AsyncCallbackManagerForChainRun, config: RunnableConfig, **kwargs: Any
+    ) -> Output:
+        return await self.bound.ainvoke(input, patch_config(config, callbacks=run_manager.get_child()), **kwargs)
+
+    def _stream(
+        self, inputs: Iterator[Input], run_manager: CallbackManagerForChainRun, config: RunnableConfig, **kwargs: Any
+    ) -> Iterator[Output]:
+        yield from self.bound.stream(next(inputs), patch_config(config, callbacks=run_manager.get_child()), **kwargs)
+
+    async def _astream(
+        self,
+        inputs: AsyncIterator[Input],
+        run_manager: AsyncCallbackManagerForChainRun,
+        config: RunnableConfig,
+        **kwargs: Any,
+    ) -> AsyncIterator[Output]:
+        input = await inputs.__anext__()
+        child_config = patch_config(config, callbacks=run_manager.get_child())
+        async for chunk in self.bound.astream(input, child_config, **kwargs):
+            yield chunk
+
+
+async def aiter_once(value: Any) -> AsyncIterator[Any]:
+    yield value
@@ -0,0 +1,157 @@
+"""
+Measures the overhead LangServe adds to the chain, without calling Vertex AI.
+
+The server is imported in process with LLM=fake and the LLM cache off, so the model is
+FakeTokenLLM emitting --tokens tokens --delay seconds apart. Every request uses a new
+prompt, so request coalescing never applies. Requests are sent straight to the ASGI app,
+with no sockets, for the chain called directly and for /invoke, /batch and /stream. For
+each target it reports:
+
+- ttft_ms: time to the first token, p50 and p99. Targets that don't stream only return
+  tokens with the full response.
+- tokens_per_s: tokens received per second of request latency, median.
+- cpu_ms: process CPU time per request. The fake model only sleeps, so this is the
+  serving overhead.
+
+    python -m benchmarks.latency_bench --concurrency 8 --requests 200 --tokens 64 --delay 0.01
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple
+
+# call() and percentile() come from the ASGI load generator in 03-simple-fast-api, which only needs the stdlib.
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "03-simple-fast-api" / "benchmarks"))
+import asgi_bench  # noqa: E402
+
+TARGETS = ["direct", "/invoke", "/batch", "/stream"]
+
+
+async def call(app, path: str, body: dict) -> Tuple[int, float, float, bytes]:
+    """Sends one POST to the ASGI app and returns the status, the time of the first body chunk
+    carrying a token, the time of the last body chunk and the whole body."""
+    first = last = 0.0
+
+    def on_body(data: bytes) -> None:
+        nonlocal first, last
+        last = time.perf_counter()
+        # The SSE metadata event comes before any token.
+        if not first and (not path.endswith("/stream") or b"event: data" in data):
+            first = last
+
+    status, data = await asgi_bench.call(app, "POST", path, json.dumps(body).encode(), on_body=on_body)
+    return status, first, last, data
+
+
+def count_tokens(text: str) -> int:
+    return len(text.split())
+
+
+def stream_tokens(body: bytes) -> int:
+    tokens = 0
+    for event in body.decode().replace("\r\n", "\n").split("\n\n"):
+        if event.startswith("event: data"):
+            tokens += count_tokens(json.loads(event.partition("data: ")[2]))
+    return tokens
+
+
+def request_for(server, target: str, batch_size: int) -> Callable[[str], Any]:
+    """Returns a coroutine function that sends one request for a prompt and returns (ttft, latency, tokens)."""
+
+    async def direct(prompt: str) -> Tuple[float, float, int]:
+        started = time.perf_counter()
+        first = None
+        text = ""
+        async for chunk in server.chain.astream(prompt):
+            first = first or time.perf_counter()
+            text += chunk
+        return first - started, time.perf_counter() - started, count_tokens(text)
+
+    async def http(prompt: str) -> Tuple[float, float, int]:
+        if target == "/batch":
+            body = {"inputs": [f"{prompt} #{i}" for i in range(batch_size)]}
+        else:
+            body = {"input": prompt}
+        started = time.perf_counter()
+        status, first, last, data = await call(server.app, target, body)
+        if status != 200:
+            raise RuntimeError(f"{target} returned {status}: {data[:200]!r}")
+        if target == "/stream":
+            tokens = stream_tokens(data)
+        elif target == "/batch":
+            tokens = sum(count_tokens(output) for output in json.loads(data)["output"])
+        else:
+            tokens = count_tokens(json.loads(data)["output"])
+        return first - started, last - started, tokens
+
+    return direct if target == "direct" else http
+
+
+async def bench_target(server, target: str, concurrency: int, requests: int, batch_size: int) -> dict:
+    send = request_for(server, target, batch_size)
+    prompts = (f"{target} prompt {i}" for i in itertools.count())
+    samples: List[Tuple[float, float, int]] = []
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        for _ in iter(lambda: next(remaining, None), None):
+            samples.append(await send(next(prompts)))
+
+    # Warm up imports, schema generation and the callback machinery.
+    await asyncio.gather(*(send(next(prompts)) for _ in range(concurrency)))
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+
+    ttfts = [ttft for ttft, _, _ in samples]
+    return {
+        "requests": len(samples),
+        "rps": round(len(samples) / seconds, 1),
+        "ttft_ms_p50": round(asgi_bench.percentile(ttfts, 50) * 1000, 2),
+        "ttft_ms_p99": round(asgi_bench.percentile(ttfts, 99) * 1000, 2),
+        "tokens_per_s": round(asgi_bench.percentile([tokens / latency for _, latency, tokens in samples], 50), 1),
+        "cpu_ms": round(cpu / len(samples) * 1000, 3),
+    }
+
+
+def load_server(tokens: int, delay: float) -> Any:
+    # The model and the cache are chosen when app.server is imported.
+    os.environ["LLM"] = "fake"
+    os.environ["FAKE_LLM_TOKENS"] = str(tokens)
+    os.environ["FAKE_LLM_DELAY"] = str(delay)
+    os.environ["LLM_CACHE"] = "none"
+    return importlib.import_module("app.server")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", action="append", choices=TARGETS, help="can be repeated (default: all)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="requests per target")
+    parser.add_argument("--batch-size", type=int, default=8, help="inputs per /batch request")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per fake response")
+    parser.add_argument("--delay", type=float, default=0.01, help="seconds between fake tokens")
+    args = parser.parse_args(argv)
+
+    server = load_server(args.tokens, args.delay)
+
+    async def run() -> None:
+        for target in args.target or TARGETS:
+            result = await bench_target(server, target, args.concurrency, args.requests, args.batch_size)
+            print(json.dumps({"target": target, "concurrency": args.concurrency, **result}))
+
+    asyncio.run(run())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+import asyncio
+import importlib
+import sys
+import types
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+from langchain_core.runnables import RunnableLambda
+
+from app.batching import AdaptiveLimiter, is_rate_limited, is_retryable, ManagedBatchRunnable
+from app.llm import init_llm
+
+
+class ApiError(Exception):
+    def __init__(self, code: int) -> None:
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class ErrorClassificationTest(unittest.TestCase):
+    def test_rate_limited(self):
+        self.assertTrue(is_rate_limited(ApiError(429)))
+        self.assertTrue(is_rate_limited(Exception("429 RESOURCE_EXHAUSTED: quota exceeded")))
+        self.assertFalse(is_rate_limited(ApiError(503)))
+
+    def test_retryable(self):
+        self.assertTrue(is_retryable(ApiError(503)))
+        self.assertFalse(is_retryable(ApiError(400)))
+        self.assertFalse(is_retryable(ValueError("bad prompt")))
+
+
+class AdaptiveLimiterTest(unittest.IsolatedAsyncioTestCase):
+    def test_halves_on_rate_limiting_once_per_cooldown(self):
+        limiter = AdaptiveLimiter(maximum=8, cooldown=60)
+        limiter.on_rate_limited()
+        limiter.on_rate_limited()
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.stats["rate_limited"], 2)
+
+    def test_never_drops_below_minimum(self):
+        limiter = AdaptiveLimiter(maximum=8, minimum=2, cooldown=0)
+        for _ in range(5):
+            limiter.on_rate_limited()
+        self.assertEqual(limiter.limit, 2)
+
+    def test_recovers_about_one_slot_per_limit_successes(self):
+        limiter = AdaptiveLimiter(maximum=8, cooldown=0)
+        limiter.on_rate_limited()
+        for _ in range(4):
+            limiter.on_success()
+        self.assertAlmostEqual(limiter.limit, 5, delta=0.1)
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(limiter.limit, 8)
+
+    async def test_slot_waits_for_the_limit(self):
+        limiter = AdaptiveLimiter(maximum=2)
+        peak = 0
+
+        async def work():
+            nonlocal peak
+            async with limiter.slot():
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(work() for _ in range(6)))
+        self.assertEqual(peak, 2)
+        self.assertEqual(limiter.in_flight, 0)
+
+
+class ManagedBatchTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.calls = []
+        self.failures = {"flaky": [ApiError(429)], "down": [ApiError(503)] * 10}
+
+        async def answer(prompt: str) -> str:
+            self.calls.append(prompt)
+            if prompt == "bad":
+                raise ValueError("bad prompt")
+            if self.failures.get(prompt):
+                raise self.failures[prompt].pop(0)
+            return prompt.upper()
+
+        self.limiter = AdaptiveLimiter(maximum=4)
+        self.batch = ManagedBatchRunnable(RunnableLambda(answer), self.limiter, max_retries=2, backoff=0)
+
+    async def test_failed_items_are_reported_on_their_own(self):
+        outputs = await self.batch.abatch(["a", "bad", "flaky", "down", "b"], return_exceptions=True)
+        self.assertEqual(outputs[0], "A")
+        self.assertIsInstance(outputs[1], ValueError)
+        self.assertEqual(outputs[2], "FLAKY")
+        self.assertIsInstance(outputs[3], ApiError)
+        self.assertEqual(outputs[4], "B")
+        # bad is not retried, flaky succeeds on its second try, down gives up after max_retries
+        self.assertEqual(self.calls.count("bad"), 1)
+        self.assertEqual(self.calls.count("flaky"), 2)
+        self.assertEqual(self.calls.count("down"), 3)
+        self.assertEqual(self.limiter.stats["failed"], 2)
+        self.assertEqual(self.limiter.stats["retried"], 3)
+        self.assertEqual(self.limiter.stats["rate_limited"], 1)
+
+    async def test_raises_after_every_item_has_run(self):
+        with self.assertRaises(ValueError):
+            await self.batch.abatch(["bad", "a", "b"])
+        self.assertEqual(sorted(self.calls), ["a", "b", "bad"])
+
+    async def test_respects_max_concurrency(self):
+        peak = 0
+        in_flight = 0
+
+        async def slow(prompt: str) -> str:
+            nonlocal peak, in_flight
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return prompt
+
+        batch = ManagedBatchRunnable(RunnableLambda(slow), AdaptiveLimiter(maximum=4))
+        outputs = await batch.abatch([str(i) for i in range(10)], {"max_concurrency": 2})
+        self.assertEqual(outputs, [str(i) for i in range(10)])
+        self.assertEqual(peak, 2)
+
+    async def test_non_positive_max_concurrency_runs_one_at_a_time(self):
+        outputs = await self.batch.abatch(["a", "b"], {"max_concurrency": -3})
+        self.assertEqual(outputs, ["A", "B"])
+
+    async def test_empty_batch(self):
+        self.assertEqual(await self.batch.abatch([]), [])
+
+
+class ManagedBatchEndpointTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The model and the cache are chosen when app.server is imported.
+        env = {"LLM": "fake", "FAKE_LLM_TOKENS": "2", "FAKE_LLM_DELAY": "0", "LLM_CACHE": "none"}
+        with mock.patch.dict("os.environ", env):
+            server = importlib.import_module("app.server")
+        cls.client = TestClient(server.app)
+
+    def test_runs_the_batch(self):
+        response = self.client.post("/batch/managed", json={"inputs": ["a", "b"], "max_concurrency": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["output"]), 2)
+        self.assertEqual(response.json()["errors"], [])
+
+    def test_rejects_max_concurrency_below_one(self):
+        for max_concurrency in (0, -1):
+            with self.subTest(max_concurrency=max_concurrency):
+                body = {"inputs": ["a"], "max_concurrency": max_concurrency}
+                self.assertEqual(self.client.post("/batch/managed", json=body).status_code, 422)
+
+
+class InitLlmTest(unittest.TestCase):
+    def test_passes_max_retries_to_vertexai(self):
+        vertexai = types.ModuleType("langchain_google_vertexai")
+        vertexai.VertexAI = mock.Mock()
+        with mock.patch.dict(sys.modules, {"langchain_google_vertexai": vertexai}), mock.patch.dict(
+            "os.environ", {"LLM": "vertexai"}
+        ):
+            init_llm(max_retries=1)
+            init_llm()
+        self.assertEqual(
+            vertexai.VertexAI.call_args_list,
+            [mock.call(model_name="gemini-1.0-pro-001", max_retries=1), mock.call(model_name="gemini-1.0-pro-001")],
+        )
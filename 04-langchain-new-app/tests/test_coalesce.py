@@ -0,0 +1,89 @@
+import asyncio
+import unittest
+
+from langchain_core.runnables import RunnableLambda
+
+from app.cache import BYPASS_METADATA_KEY
+from app.coalesce import CoalescingRunnable
+from app.llm import FakeTokenLLM
+
+
+class CoalesceInvokeTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.calls = []
+        self.release = asyncio.Event()
+
+        async def answer(prompt: str) -> str:
+            self.calls.append(prompt)
+            await self.release.wait()
+            if prompt == "bad":
+                raise ValueError("bad prompt")
+            return prompt.upper()
+
+        self.runnable = CoalescingRunnable(RunnableLambda(answer), "test", "params")
+
+    async def start(self, *prompts: str, config=None) -> list:
+        tasks = [asyncio.create_task(self.runnable.ainvoke(prompt, config)) for prompt in prompts]
+        await asyncio.sleep(0.01)
+        return tasks
+
+    async def test_identical_prompts_share_one_call(self):
+        tasks = await self.start("hello", "hello", "hello", "other")
+        self.release.set()
+        self.assertEqual(await asyncio.gather(*tasks), ["HELLO", "HELLO", "HELLO", "OTHER"])
+        self.assertEqual(sorted(self.calls), ["hello", "other"])
+        self.assertEqual(self.runnable.stats, {"upstream": 2, "coalesced": 2})
+        self.assertEqual(self.runnable._invocations, {})
+
+    async def test_finished_calls_are_not_reused(self):
+        self.release.set()
+        await self.runnable.ainvoke("hello")
+        await self.runnable.ainvoke("hello")
+        self.assertEqual(self.calls, ["hello", "hello"])
+
+    async def test_bypass_does_not_join(self):
+        tasks = await self.start("hello")
+        tasks += await self.start("hello", config={"metadata": {BYPASS_METADATA_KEY: True}})
+        self.release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(self.calls, ["hello", "hello"])
+
+    async def test_errors_reach_every_waiter(self):
+        tasks = await self.start("bad", "bad")
+        self.release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(self.calls, ["bad"])
+
+    async def test_call_outlives_the_request_that_started_it(self):
+        first, second = await self.start("hello", "hello")
+        first.cancel()
+        await asyncio.sleep(0)
+        self.release.set()
+        self.assertEqual(await second, "HELLO")
+        self.assertEqual(self.calls, ["hello"])
+
+    async def test_call_is_cancelled_when_every_waiter_leaves(self):
+        tasks = await self.start("hello", "hello")
+        flight = self.runnable._invocations[next(iter(self.runnable._invocations))]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+        self.assertTrue(flight.task.cancelled())
+        self.assertEqual(self.runnable._invocations, {})
+
+
+class CoalesceStreamTest(unittest.IsolatedAsyncioTestCase):
+    async def collect(self, runnable: CoalescingRunnable, prompt: str, delay: float = 0) -> str:
+        await asyncio.sleep(delay)
+        return "".join([chunk async for chunk in runnable.astream(prompt)])
+
+    async def test_late_subscribers_get_the_whole_output(self):
+        llm = FakeTokenLLM(tokens=10, delay=0.005)
+        runnable = CoalescingRunnable(llm, "test", "params")
+        outputs = await asyncio.gather(*(self.collect(runnable, "hello", delay) for delay in (0, 0.02, 0.04)))
+        expected = await llm.ainvoke("hello")
+        self.assertEqual(outputs, [expected] * 3)
+        self.assertEqual(runnable.stats, {"upstream": 1, "coalesced": 2})
+        self.assertEqual(runnable._streams, {})
@@ -1,20 +1,212 @@
+import asyncio
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
 from uuid import uuid4
 
-import psycopg2
 from fastapi import FastAPI, File, Request, Response, UploadFile, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
 from fastapi.security import HTTPBearer
 from fastapi.staticfiles import StaticFiles
+from google.auth import exceptions, jwt
 from google.auth.transport import requests
 from google.cloud import storage
-from google.oauth2 import id_token
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
+from starlette.concurrency import run_in_threadpool
 
-app = FastAPI()
+IAP_CERTS_URL = "https://www.gstatic.com/iap/verify/public_key"
+
+
+class IapJwtVerifier:
+    """
+    IAP の JWT を検証する。
+    公開鍵はレスポンスの Cache-Control の max-age の間キャッシュし、
+    検証済みのトークンはハッシュをキーにして exp まで LRU に保持する。
+    公開鍵の取得に失敗したら min_refresh_interval の間は取り直さず、
+    期限切れから stale_grace 秒までは前の鍵を使い続ける
+    """
+
+    def __init__(self, certs_url, max_entries=10000, default_ttl=3600, min_refresh_interval=60, stale_grace=3600):
+        self.certs_url = certs_url
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.stale_grace = stale_grace
+        self._request = requests.Request()
+        self._certs = None
+        self._certs_expires = 0
+        self._certs_fetched = 0
+        self._certs_failed = 0
+        self._certs_lock = threading.Lock()
+        # 公開鍵の取得は同時に 1 つだけにする
+        self._refresh_lock = threading.Lock()
+        self._verified = OrderedDict()
+        self._verified_lock = threading.Lock()
+
+    def refresh_certs(self):
+        """
+        公開鍵を取得し、キャッシュしてよい秒数を返す
+        """
+        with self._refresh_lock:
+            return self._fetch_certs()
+
+    def _fetch_certs(self):
+        try:
+            response = self._request(self.certs_url, method="GET")
+            if response.status != 200:
+                raise exceptions.TransportError(f"Could not fetch certificates at {self.certs_url}")
+        except Exception:
+            with self._certs_lock:
+                self._certs_failed = time.time()
+            raise
+
+        ttl = self.default_ttl
+        match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+        if match:
+            # CDN にキャッシュされていた時間を差し引く
+            ttl = max(int(match.group(1)) - int(response.headers.get("age", 0)), 0)
+
+        with self._certs_lock:
+            self._certs = json.loads(response.data.decode("utf-8"))
+            self._certs_fetched = time.time()
+            self._certs_expires = self._certs_fetched + ttl
+        return ttl
+
+    def certs(self, kid=None):
+        with self._certs_lock:
+            certs = self._certs
+            expired = certs is None or time.time() >= self._certs_expires
+            # 知らない kid は鍵のローテーション直後かもしれないので取り直す。ただし取り直しすぎない
+            rotated = (
+                certs is not None
+                and kid not in certs
+                and time.time() - self._certs_fetched >= self.min_refresh_interval
+            )
+            fetched = self._certs_fetched
+            failed = self._certs_failed
+        if not (expired or rotated):
+            return certs
+        if time.time() - failed < self.min_refresh_interval:
+            # 取得に失敗した直後は取り直さない
+            return self._stale_certs(certs)
+        # 同時に期限切れに気づいたリクエストは、先に取りに行ったスレッドの結果を使う
+        with self._refresh_lock:
+            if self._certs_fetched != fetched:
+                return self._certs
+            if self._certs_failed != failed:
+                return self._stale_certs(certs)
+            try:
+                self._fetch_certs()
+            except Exception:
+                return self._stale_certs(certs)
+            return self._certs
+
+    def _stale_certs(self, certs):
+        """
+        取得に失敗したときに使う前の鍵を返す。猶予を過ぎていたら例外にする
+        """
+        with self._certs_lock:
+            usable = certs is not None and time.time() < self._certs_expires + self.stale_grace
+        if not usable:
+            raise exceptions.TransportError(f"Could not fetch certificates at {self.certs_url}")
+        return certs
+
+    def _key(self, token, audience):
+        return hashlib.sha256(f"{audience}\0{token}".encode()).digest()
+
+    def cached(self, token, audience):
+        """
+        検証済みでまだ有効なトークンならデコード結果を返す。ネットワークにも署名の検証にも行かない
+        """
+        key = self._key(token, audience)
+        with self._verified_lock:
+            entry = self._verified.get(key)
+            if entry is None:
+                return None
+            decoded_jwt, expires = entry
+            if expires <= time.time():
+                del self._verified[key]
+                return None
+            self._verified.move_to_end(key)
+            return decoded_jwt
+
+    def verify(self, token, audience):
+        decoded_jwt = self.cached(token, audience)
+        if decoded_jwt is not None:
+            return decoded_jwt
+
+        kid = jwt.decode_header(token).get("kid")
+        decoded_jwt = jwt.decode(token, certs=self.certs(kid), audience=audience)
+
+        with self._verified_lock:
+            self._verified[self._key(token, audience)] = (decoded_jwt, decoded_jwt["exp"])
+            while len(self._verified) > self.max_entries:
+                self._verified.popitem(last=False)
+        return decoded_jwt
+
+
+iap_verifier = IapJwtVerifier(IAP_CERTS_URL, max_entries=int(os.getenv("IAP_JWT_CACHE_SIZE", 10000)))
+
+
+async def refresh_iap_certs():
+    """
+    公開鍵を期限が切れる少し前に取り直し、リクエストの処理中に取りに行かないようにする
+    """
+    while True:
+        try:
+            ttl = await asyncio.to_thread(iap_verifier.refresh_certs)
+            delay = max(ttl - 60, 30)
+        except Exception as e:
+            print(f"**ERROR: IAP public key fetch error {e}**")
+            delay = 30
+        await asyncio.sleep(delay)
+
+
+def create_db_pool():
+    """
+    PostgreSQL のコネクションプールを作成する。接続は open() で開く
+    """
+    conninfo = make_conninfo(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT", 5432),
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASS"),
+    )
+    return AsyncConnectionPool(
+        conninfo,
+        min_size=int(os.getenv("DB_POOL_MIN_SIZE", 1)),
+        max_size=int(os.getenv("DB_POOL_MAX_SIZE", 10)),
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        open=False,
+    )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # 起動時にプールを開き、停止時に閉じる。
+    # DB に繋がらなくても起動は止めず、プールがバックグラウンドで接続を再試行する
+    app.state.db_pool = create_db_pool()
+    await app.state.db_pool.open()
+    refresh_task = asyncio.create_task(refresh_iap_certs())
+    yield
+    refresh_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await refresh_task
+    await app.state.db_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
 security = HTTPBearer()
 
 
@@ -42,15 +234,20 @@ def validate_iap_jwt(iap_jwt, expected_audience):
       (user_id, user_email, error_str).
     """
     try:
-        decoded_jwt = id_token.verify_token(
-            iap_jwt,
-            requests.Request(),
-            audience=expected_audience,
-            certs_url="https://www.gstatic.com/iap/verify/public_key",
-        )
-        return (decoded_jwt["gcip"]["sub"], decoded_jwt["gcip"]["email"], "")
+        decoded_jwt = iap_verifier.verify(iap_jwt, expected_audience)
     except Exception as e:
         return (None, None, f"**ERROR: JWT validation error {e}**")
+    return iap_identity(decoded_jwt)
+
+
+def iap_identity(decoded_jwt):
+    """
+    検証済みの JWT から (user_id, user_email, error_str) を取り出す
+    """
+    try:
+        return (decoded_jwt["gcip"]["sub"], decoded_jwt["gcip"]["email"], "")
+    except (KeyError, TypeError) as e:
+        return (None, None, f"**ERROR: JWT validation error missing claim {e}**")
 
 
 @app.middleware("http")
@@ -65,7 +262,13 @@ async def jwt_authentication_middleware(request: Request, call_next):
 
     expected_audience = f"/projects/{os.getenv('PROJECT_NUMBER')}/global/backendServices/{os.getenv('BACKEND_SERVICE_ID')}"
 
-    id, email, err = validate_iap_jwt(assertion, expected_audience)
+    decoded_jwt = iap_verifier.cached(assertion, expected_audience)
+    if decoded_jwt is not None:
+        # 検証済みのトークンはキャッシュにあるデコード結果をそのまま使う
+        id, email, err = iap_identity(decoded_jwt)
+    else:
+        # 公開鍵の取得と署名の検証はブロックするのでスレッドプールで行う
+        id, email, err = await run_in_threadpool(validate_iap_jwt, assertion, expected_audience)
     if err != "":
         print(err)
         return Response(status_code=status.HTTP_403_FORBIDDEN)
@@ -113,18 +316,26 @@ async def save_incidents(request: Request):
         return Response(status_code=status.HTTP_400_BAD_REQUEST)
 
     # 2. Move Object data from tmp bucket to persistible　bucket
-    move_object(request_data["image_path"])
+    # Cloud Storage と SendGrid のクライアントはブロックするのでスレッドプールで呼ぶ
+    await run_in_threadpool(move_object, request_data["image_path"])
 
     # 3. Save request data to PostgreSQL
-    save_to_db(request_data)
+    await save_to_db(request.app.state.db_pool, request_data)
 
     # 4. Send email (to approvers etc) by using SendGrid API Key
-    send_email(request_data)
+    await run_in_threadpool(send_email, request_data)
 
     # 5. Return success response
     return Response(status_code=status.HTTP_201_CREATED)
 
 
+@app.get("/db-pool/stats")
+async def db_pool_stats(request: Request):
+    # コネクションプールの状態 (接続数、待ち行列、待ち時間など)
+    # /api の外に置き、ミドルウェアで IAP の JWT を検証させる
+    return request.app.state.db_pool.get_stats()
+
+
 def validate_request_data(data):
     # TODO: Implement request data validation
     return
@@ -151,103 +362,84 @@ def move_object(object_path):
     source_blob.delete()
 
 
-def save_to_db(data):
-    """
-    Save data to PostgreSQL.
-    """
-    # データベースに接続
-    conn = psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT", 5432),
-        database=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASS"),
+# incidents テーブルに挿入する SQL
+INCIDENTS_SQL = """
+    INSERT INTO incidents (
+        title,
+        submit_date,
+        location_id,
+        department_id,
+        type,
+        occurred_at,
+        occurred_place_id,
+        occurred_place_detail,
+        cause_id,
+        witness_id,
+        witness_manager_id,
+        reporter_id,
+        reporter_phone_number,
+        manager_id,
+        worker_id,
+        work_members,
+        disaster_type_id,
+        injury_classification_id,
+        injured_part_id,
+        injury_description
     )
-    cur = conn.cursor()
-
-    # トランザクションを開始
-    cur.execute("BEGIN TRANSACTION;")
-
-    # データを挿入
-    try:
-        # incidents テーブルにデータを挿入
-        incidents_sql = """
-            INSERT INTO incidents (
-                title,
-                submit_date,
-                location_id,
-                department_id,
-                type,
-                occurred_at,
-                occurred_place_id,
-                occurred_place_detail,
-                cause_id,
-                witness_id,
-                witness_manager_id,
-                reporter_id,
-                reporter_phone_number,
-                manager_id,
-                worker_id,
-                work_members,
-                disaster_type_id,
-                injury_classification_id,
-                injured_part_id,
-                injury_description
-            )
-            VALUES (
-                %(title)s,
-                %(submit_date)s,
-                %(location_id)s,
-                %(department_id)s,
-                %(type)s,
-                %(occurred_at)s,
-                %(occurred_place_id)s,
-                %(occurred_place_detail)s,
-                %(cause_id)s,
-                %(witness_id)s,
-                %(witness_manager_id)s,
-                %(reporter_id)s,
-                %(reporter_phone_number)s,
-                %(manager_id)s,
-                %(worker_id)s,
-                %(work_members)s,
-                %(disaster_type_id)s,
-                %(injury_classification_id)s,
-                %(injured_part_id)s,
-                %(injury_description)s
-            )
-            RETURNING id;
-        """
-        cur.execute(incidents_sql, data)
-        incident_id = cur.fetchone()[0]
-
-        # incident_occurrences テーブルにデータを挿入
-        incident_occurrences_sql = """
-            INSERT INTO incident_occurrences (
-                incident_id,
-                description,
-                image_path
-            )
-            VALUES (
-                %(incident_id)s,
-                %(description)s,
-                %(image_path)s
-            );
-        """
-        data["incident_id"] = incident_id
-        cur.execute(incident_occurrences_sql, data)
+    VALUES (
+        %(title)s,
+        %(submit_date)s,
+        %(location_id)s,
+        %(department_id)s,
+        %(type)s,
+        %(occurred_at)s,
+        %(occurred_place_id)s,
+        %(occurred_place_detail)s,
+        %(cause_id)s,
+        %(witness_id)s,
+        %(witness_manager_id)s,
+        %(reporter_id)s,
+        %(reporter_phone_number)s,
+        %(manager_id)s,
+        %(worker_id)s,
+        %(work_members)s,
+        %(disaster_type_id)s,
+        %(injury_classification_id)s,
+        %(injured_part_id)s,
+        %(injury_description)s
+    )
+    RETURNING id;
+"""
+
+# incident_occurrences テーブルに挿入する SQL
+INCIDENT_OCCURRENCES_SQL = """
+    INSERT INTO incident_occurrences (
+        incident_id,
+        description,
+        image_path
+    )
+    VALUES (
+        %(incident_id)s,
+        %(description)s,
+        %(image_path)s
+    );
+"""
 
-        conn.commit()
 
-    except Exception as e:
-        # エラーが発生した場合はロールバック
-        conn.rollback()
-        raise e
-
-    finally:
-        # カーソルと接続を閉じる
-        cur.close()
-        conn.close()
+async def save_to_db(pool, data):
+    """
+    Save data to PostgreSQL.
+    """
+    # プールから接続を借りて、トランザクションの中で挿入する。例外が起きたらロールバックされる
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            async with conn.cursor() as cur:
+                # prepare=True で接続ごとにサーバー側でプリペアし、2 回目以降は解析を省く
+                await cur.execute(INCIDENTS_SQL, data, prepare=True)
+                incident_id = (await cur.fetchone())[0]
+
+                data["incident_id"] = incident_id
+                await cur.execute(INCIDENT_OCCURRENCES_SQL, data, prepare=True)
 
 
 def send_email(data):
@@ -0,0 +1,240 @@
+import datetime
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from fastapi.testclient import TestClient
+from google.auth import crypt, jwt
+
+import main
+
+AUDIENCE = "/projects/1/global/backendServices/2"
+
+
+def create_key(kid):
+    """
+    署名用の鍵と、IAP の公開鍵一覧と同じ形の {kid: 証明書} を作る
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "iap-test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    private_pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    signer = crypt.RSASigner.from_string(private_pem, key_id=kid)
+    return signer, {kid: cert.public_bytes(serialization.Encoding.PEM).decode()}
+
+
+class FakeResponse:
+    def __init__(self, certs, headers, status=200):
+        self.status = status
+        self.data = json.dumps(certs).encode("utf-8")
+        self.headers = headers
+
+
+class FakeRequest:
+    """
+    公開鍵の取得を数えるだけの requests.Request の代わり
+    """
+
+    def __init__(self, certs, headers=None):
+        self.certs = certs
+        self.headers = headers or {"cache-control": "public, max-age=3600"}
+        self.status = 200
+        self.calls = 0
+
+    def __call__(self, url, method):
+        self.calls += 1
+        time.sleep(0.01)
+        return FakeResponse(self.certs, self.headers, self.status)
+
+
+class IapJwtVerifierTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.signer, cls.certs = create_key("key-1")
+
+    def setUp(self):
+        self.verifier = main.IapJwtVerifier("https://example.com/certs", max_entries=2)
+        self.request = FakeRequest(self.certs)
+        self.verifier._request = self.request
+
+    def token(self, lifetime=600, audience=AUDIENCE, subject="user"):
+        now = int(time.time())
+        payload = {"aud": audience, "iat": now, "exp": now + lifetime, "gcip": {"sub": subject, "email": "a@b.c"}}
+        return jwt.encode(self.signer, payload).decode()
+
+    def test_verified_token_is_cached(self):
+        token = self.token()
+        self.assertIsNone(self.verifier.cached(token, AUDIENCE))
+        self.assertEqual(self.verifier.verify(token, AUDIENCE)["gcip"]["sub"], "user")
+        with mock.patch.object(main.jwt, "decode", side_effect=AssertionError("not cached")):
+            self.assertEqual(self.verifier.verify(token, AUDIENCE)["gcip"]["sub"], "user")
+        self.assertEqual(self.request.calls, 1)
+
+    def test_cache_entry_expires_with_the_token(self):
+        token = self.token(lifetime=600)
+        decoded_jwt = self.verifier.verify(token, AUDIENCE)
+        with mock.patch.object(main.time, "time", return_value=decoded_jwt["exp"]):
+            self.assertIsNone(self.verifier.cached(token, AUDIENCE))
+        self.assertEqual(len(self.verifier._verified), 0)
+
+    def test_cache_is_keyed_by_audience(self):
+        token = self.token()
+        self.verifier.verify(token, AUDIENCE)
+        other_audience = "/projects/1/global/backendServices/3"
+        self.assertIsNone(self.verifier.cached(token, other_audience))
+        with self.assertRaises(Exception):
+            self.verifier.verify(token, other_audience)
+        self.assertEqual(len(self.verifier._verified), 1)
+
+    def test_least_recently_used_token_is_evicted(self):
+        tokens = [self.token(subject=f"user{i}") for i in range(3)]
+        self.verifier.verify(tokens[0], AUDIENCE)
+        self.verifier.verify(tokens[1], AUDIENCE)
+        self.verifier.cached(tokens[0], AUDIENCE)
+        self.verifier.verify(tokens[2], AUDIENCE)
+        self.assertIsNotNone(self.verifier.cached(tokens[0], AUDIENCE))
+        self.assertIsNone(self.verifier.cached(tokens[1], AUDIENCE))
+
+    def test_certs_expire_after_max_age_minus_age(self):
+        self.request.headers = {"cache-control": "public, max-age=3600", "age": "600"}
+        self.assertEqual(self.verifier.refresh_certs(), 3000)
+        with mock.patch.object(main.time, "time", return_value=time.time() + 3001):
+            self.verifier.certs("key-1")
+        self.assertEqual(self.request.calls, 2)
+
+    def test_unknown_kid_refreshes_at_most_once_per_interval(self):
+        self.verifier.certs("key-1")
+        self.verifier.certs("rotated")
+        self.assertEqual(self.request.calls, 1)
+        with mock.patch.object(main.time, "time", return_value=time.time() + 61):
+            self.verifier.certs("rotated")
+        self.assertEqual(self.request.calls, 2)
+
+    def certs_concurrently(self, now=None):
+        errors = []
+
+        def certs():
+            try:
+                self.verifier.certs("key-1")
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(main.time, "time", return_value=now or time.time()):
+            threads = [threading.Thread(target=certs) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return errors
+
+    def test_concurrent_cold_start_fetches_once(self):
+        self.assertEqual(self.certs_concurrently(), [])
+        self.assertEqual(self.request.calls, 1)
+
+    def test_failed_refresh_keeps_previous_keys(self):
+        self.verifier.certs("key-1")
+        self.request.status = 503
+        expired = time.time() + 3601
+        self.assertEqual(self.certs_concurrently(expired), [])
+        self.assertEqual(self.request.calls, 2)
+
+        # 失敗から min_refresh_interval たつまでは取り直さない
+        with mock.patch.object(main.time, "time", return_value=expired + 59):
+            self.assertEqual(self.verifier.certs("key-1"), self.certs)
+        self.assertEqual(self.request.calls, 2)
+
+        self.request.status = 200
+        with mock.patch.object(main.time, "time", return_value=expired + 61):
+            self.verifier.certs("key-1")
+        self.assertEqual(self.request.calls, 3)
+
+    def test_previous_keys_are_dropped_after_grace_period(self):
+        self.verifier.certs("key-1")
+        self.request.status = 503
+        with mock.patch.object(main.time, "time", return_value=time.time() + 3600 + 3601):
+            with self.assertRaises(main.exceptions.TransportError):
+                self.verifier.certs("key-1")
+
+    def test_failed_cold_start_is_not_retried_by_every_waiter(self):
+        self.request.status = 503
+        errors = self.certs_concurrently()
+        self.assertEqual(len(errors), 10)
+        self.assertEqual(self.request.calls, 1)
+
+
+class JwtAuthenticationMiddlewareTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.signer, cls.certs = create_key("key-1")
+
+    def setUp(self):
+        self.verifier = main.IapJwtVerifier("https://example.com/certs")
+        self.verifier._request = FakeRequest(self.certs)
+        patches = [
+            mock.patch.object(main, "iap_verifier", self.verifier),
+            mock.patch.dict(main.os.environ, {"PROJECT_NUMBER": "1", "BACKEND_SERVICE_ID": "2"}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # lifespan は動かさないので DB にも公開鍵の URL にも繋がない
+        self.client = TestClient(main.app)
+        now = int(time.time())
+        payload = {"aud": AUDIENCE, "iat": now, "exp": now + 600, "gcip": {"sub": "user", "email": "a@b.c"}}
+        self.token = jwt.encode(self.signer, payload).decode()
+
+    def get(self):
+        return self.client.get("/", headers={"X-Goog-IAP-JWT-Assertion": self.token})
+
+    def test_first_request_is_verified_on_the_threadpool(self):
+        threads = {"cached": [], "validate": []}
+        cached, validate_iap_jwt = self.verifier.cached, main.validate_iap_jwt
+
+        def record_thread(name, function):
+            def wrapper(*args):
+                threads[name].append(threading.get_ident())
+                return function(*args)
+
+            return wrapper
+
+        with (
+            mock.patch.object(self.verifier, "cached", record_thread("cached", cached)),
+            mock.patch.object(main, "validate_iap_jwt", record_thread("validate", validate_iap_jwt)),
+        ):
+            self.assertEqual(self.get().status_code, 200)
+        # cached() はミドルウェアがイベントループで呼ぶ。署名の検証は別のスレッドで行う
+        [loop_thread, *_] = threads["cached"]
+        self.assertEqual(len(threads["validate"]), 1)
+        self.assertNotEqual(threads["validate"][0], loop_thread)
+        self.assertIsNotNone(self.verifier.cached(self.token, AUDIENCE))
+
+    def test_cached_token_uses_cached_claims(self):
+        self.verifier.verify(self.token, AUDIENCE)
+        with mock.patch.object(main, "validate_iap_jwt", side_effect=AssertionError("verified again")):
+            self.assertEqual(self.get().status_code, 200)
+
+    def test_cached_token_without_claims_is_rejected(self):
+        with self.verifier._verified_lock:
+            self.verifier._verified[self.verifier._key(self.token, AUDIENCE)] = ({"sub": "user"}, time.time() + 600)
+        self.assertEqual(self.get().status_code, 403)
+
+    def test_missing_assertion_is_rejected(self):
+        self.assertEqual(self.client.get("/").status_code, 403)
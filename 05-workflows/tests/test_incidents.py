@@ -0,0 +1,122 @@
+import threading
+import unittest
+from contextlib import asynccontextmanager
+from unittest import mock
+
+from fastapi.testclient import TestClient
+from psycopg import errors
+
+import main
+
+INCIDENT = {
+    "title": "転倒",
+    "occurred_at": "2024-04-01T09:00:00",
+    "occurred_place_detail": "倉庫",
+    "description": "床が濡れていた",
+    "image_path": "a.png",
+}
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def execute(self, sql, params, prepare=None):
+        if "incident_occurrences" in sql and self.connection.pool.fail_occurrence:
+            raise errors.ForeignKeyViolation("incident_id is not present in incidents")
+        self.connection.pending.append(sql.split()[2])
+
+    async def fetchone(self):
+        return (1,)
+
+
+class FakeConnection:
+    """
+    psycopg と同じく、transaction() を抜けるときに例外が無ければコミットし、あればロールバックする
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        try:
+            yield
+        except BaseException:
+            self.pool.rollbacks += 1
+            self.pending.clear()
+            raise
+        self.pool.committed.extend(self.pending)
+        self.pending.clear()
+
+    @asynccontextmanager
+    async def cursor(self):
+        yield FakeCursor(self)
+
+
+class FakePool:
+    def __init__(self):
+        self.committed = []
+        self.rollbacks = 0
+        self.fail_occurrence = False
+        self.opened = False
+        self.closed = False
+
+    async def open(self):
+        self.opened = True
+
+    async def close(self):
+        self.closed = True
+
+    @asynccontextmanager
+    async def connection(self):
+        yield FakeConnection(self)
+
+
+async def no_refresh():
+    return
+
+
+class SaveIncidentsTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = FakePool()
+        self.threads = []
+
+        def record_thread(*args):
+            self.threads.append(threading.get_ident())
+
+        patches = [
+            mock.patch.object(main, "create_db_pool", return_value=self.pool),
+            mock.patch.object(main, "refresh_iap_certs", no_refresh),
+            mock.patch.object(main, "move_object", side_effect=record_thread),
+            mock.patch.object(main, "send_email", side_effect=record_thread),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def post(self):
+        # with で lifespan を動かし、プールの開閉も通す
+        with TestClient(main.app, raise_server_exceptions=False) as client:
+            self.loop_thread = client.portal.call(threading.get_ident)
+            return client.post("/api/incidents", json=INCIDENT)
+
+    def test_saves_both_rows_in_one_transaction(self):
+        response = self.post()
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(self.pool.opened)
+        self.assertTrue(self.pool.closed)
+        self.assertEqual(self.pool.committed, ["incidents", "incident_occurrences"])
+        # Cloud Storage と SendGrid はイベントループのスレッドで呼ばない
+        self.assertEqual(len(self.threads), 2)
+        self.assertNotIn(self.loop_thread, self.threads)
+
+    def test_rolls_back_when_second_insert_fails(self):
+        self.pool.fail_occurrence = True
+        response = self.post()
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.pool.committed, [])
+        self.assertEqual(self.pool.rollbacks, 1)
+        # 保存に失敗したらメールは送らない
+        main.send_email.assert_not_called()